@@ -0,0 +1,100 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Static int8 activation scales calibrated on representative prompts.
+
+calibrate_activation_scales runs the prefill of the prompts with per token
+activation quantization and records the absolute max of the inputs of every
+int8 x int8 matmul, see layers.quantize_activation_int8. With the saved
+scales (QuantizationConfig.activation_scales_path) the activations are
+quantized per tensor without any reduction.
+"""
+
+import functools
+import json
+from typing import Any, Dict, Iterable, Sequence
+
+import jax
+
+from jetstream_pt import kv_calibration, torchjax
+
+
+def _activation_modules(model):
+  return [
+      (name, mod)
+      for name, mod in model.named_modules()
+      if hasattr(mod, "activation_observer")
+  ]
+
+
+def _observe(record, input_name, x):
+  amax = torchjax.from_torch(x.abs().max().float())
+  # Called while tracing, the value is sent back to the host when it runs
+  jax.debug.callback(functools.partial(record, input_name), amax)
+
+
+def calibrate_activation_scales(
+    engine, params: Any, prompts: Iterable[Sequence[int]]
+) -> Dict[str, Dict[str, float]]:
+  """Returns the static activation scales by module name and input name.
+
+  The prompts are sequences of token ids, see kv_calibration.prefill_prompts.
+  The engine must quantize activations per token and must not have compiled
+  prefill yet, since the observers run while prefill is traced.
+  """
+  amax = {}
+
+  def record(module_name, input_name, value):
+    key = (module_name, input_name)
+    amax[key] = max(amax.get(key, 0.0), float(value))
+
+  modules = _activation_modules(engine.pt_model)
+  for name, mod in modules:
+    mod.activation_observer = functools.partial(
+        _observe, functools.partial(record, name)
+    )
+  try:
+    for prefix, _ in kv_calibration.prefill_prompts(engine, params, prompts):
+      jax.block_until_ready(prefix)
+    jax.effects_barrier()
+  finally:
+    for _, mod in modules:
+      mod.activation_observer = None
+  if not amax:
+    raise ValueError("No activation quantized while calibrating")
+
+  scales = {}
+  for (module_name, input_name), value in sorted(amax.items()):
+    scales.setdefault(module_name, {})[input_name] = (
+        value / 127 if value > 0 else 1.0
+    )
+  return scales
+
+
+def apply_activation_scales(model, scales: Dict[str, Dict[str, float]]):
+  """Sets the static activation scales of the modules of model."""
+  for name, mod in _activation_modules(model):
+    mod.static_activation_scales = dict(scales.get(name, {}))
+
+
+def save_activation_scales(path: str, scales: Dict[str, Dict[str, float]]):
+  """Saves the scales of calibrate_activation_scales."""
+  with open(path, "w", encoding="utf-8") as f:
+    json.dump(scales, f, indent=2, sort_keys=True)
+
+
+def load_activation_scales(path: str) -> Dict[str, Dict[str, float]]:
+  """Loads the scales saved by save_activation_scales."""
+  with open(path, encoding="utf-8") as f:
+    return json.load(f)
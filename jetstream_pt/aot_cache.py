@@ -0,0 +1,344 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ahead of time compilation of the engine entry points.
+
+aot_warmup enumerates the shapes the engine sees while serving: prefill and
+insert for every prefill bucket up to max_input_sequence_length, and generate.
+It compiles them in parallel and serializes the executables in a directory
+keyed by a hash of the model, the environment, the jetstream_pt sources and
+the jax version, next to a manifest listing them. A restart with the same
+configuration deserializes the executables instead of tracing and compiling
+the model again.
+"""
+
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import os
+import pickle
+from typing import Any, Dict, Optional
+
+import jax
+from jax import numpy as jnp
+from jax.experimental import serialize_executable
+import jaxlib
+
+MANIFEST_FILE = "manifest.json"
+
+# Engine attributes that are compiled ahead of time when they are jitted
+_ENTRY_POINTS = ("prefill", "insert", "generate")
+
+# The default prefill lengths of token_utils.pad_tokens
+_PREFILL_BUCKETS = (
+    16,
+    32,
+    64,
+    128,
+    256,
+    512,
+    1024,
+    2048,
+    4096,
+    8192,
+    16384,
+    32768,
+)
+
+
+def prefill_buckets(max_input_length: int):
+  """Returns the lengths prompts are padded to, like token_utils.pad_tokens."""
+  buckets = [b for b in _PREFILL_BUCKETS if b < max_input_length]
+  return buckets + [max_input_length]
+
+
+def _attribute(engine, entry_point) -> str:
+  """The engine attribute holding the jitted entry point."""
+  # With the prefix cache on, engine.prefill looks up the cache and calls the
+  # jitted engine._prefill
+  if (
+      entry_point == "prefill"
+      and getattr(engine, "prefix_cache", None) is not None
+  ):
+    return "_prefill"
+  return entry_point
+
+
+def _call_key(args, kwargs):
+  """The tree structure, shapes, dtypes and shardings of a call."""
+  leaves, treedef = jax.tree_util.tree_flatten((args, kwargs))
+  avals = tuple(
+      (
+          (type(leaf),)
+          if isinstance(leaf, (bool, int, float))
+          else (leaf.shape, leaf.dtype, getattr(leaf, "sharding", None))
+      )
+      for leaf in leaves
+  )
+  return treedef, avals
+
+
+def signature(args, kwargs) -> str:
+  """Hash of the tree structure, shapes, dtypes and shardings of a call."""
+  treedef, avals = _call_key(args, kwargs)
+  avals = [
+      (
+          aval[0].__name__
+          if len(aval) == 1
+          else (tuple(aval[0]), str(aval[1]), str(aval[2]))
+      )
+      for aval in avals
+  ]
+  return hashlib.sha256(repr((str(treedef), avals)).encode()).hexdigest()
+
+
+def source_hash() -> str:
+  """Hash of the jetstream_pt sources, which the traced programs come from."""
+  package_dir = os.path.dirname(os.path.abspath(__file__))
+  digest = hashlib.sha256()
+  for root, dirs, files in os.walk(package_dir):
+    dirs.sort()
+    for file_name in sorted(files):
+      if file_name.endswith(".py"):
+        path = os.path.join(root, file_name)
+        digest.update(os.path.relpath(path, package_dir).encode())
+        with open(path, "rb") as f:
+          digest.update(f.read())
+  return digest.hexdigest()
+
+
+def config_hash(engine, params) -> str:
+  """Hash of everything the compiled executables depend on."""
+  weights = [
+      (jax.tree_util.keystr(path), value.shape, str(value.dtype))
+      for path, value in jax.tree_util.tree_flatten_with_path(params)[0]
+  ]
+  devices = jax.devices()
+  state = {
+      "model": type(engine.pt_model).__module__
+      + "."
+      + type(engine.pt_model).__qualname__,
+      # pylint: disable-next=protected-access
+      "env": dataclasses.asdict(engine.env._data),
+      "weights": weights,
+      "jetstream_pt": source_hash(),
+      "jax": jax.__version__,
+      "jaxlib": jaxlib.__version__,
+      "devices": (len(devices), devices[0].device_kind),
+  }
+  state = json.dumps(state, sort_keys=True, default=str)
+  return hashlib.sha256(state.encode()).hexdigest()[:16]
+
+
+class AotFunction:
+  """Calls the executable compiled for the signature of the call if there is
+  one, the jitted function otherwise.
+
+  executables are keyed by the signature hash, which is saved in the
+  manifest. The hash is only computed the first time a call key is seen,
+  later calls with the same shapes are a dict lookup.
+  """
+
+  def __init__(self, fn):
+    self.fn = fn
+    self.executables = {}
+    self._by_call_key = {}
+
+  def __call__(self, *args, **kwargs):
+    # Omitted and None keyword arguments compile to the same executable
+    kwargs = {k: v for k, v in kwargs.items() if v is not None}
+    key = _call_key(args, kwargs)
+    if key not in self._by_call_key:
+      self._by_call_key[key] = self.executables.get(signature(args, kwargs))
+    executable = self._by_call_key[key]
+    if executable is None:
+      return self.fn(*args, **kwargs)
+    return executable(*args, **kwargs)
+
+  def add_executable(self, key: str, executable):
+    """Registers the executable compiled for the signature key."""
+    self.executables[key] = executable
+    self._by_call_key.clear()
+
+  def lower(self, *args, **kwargs):
+    """Lowers the jitted function, None keyword arguments are dropped."""
+    kwargs = {k: v for k, v in kwargs.items() if v is not None}
+    return self.fn.lower(*args, **kwargs)
+
+
+def _write_manifest(cache_path, manifest):
+  os.makedirs(cache_path, exist_ok=True)
+  tmp_path = os.path.join(cache_path, MANIFEST_FILE + ".tmp")
+  with open(tmp_path, "w", encoding="utf-8") as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  os.replace(tmp_path, os.path.join(cache_path, MANIFEST_FILE))
+
+
+def _load(engine, cache_path) -> Dict[str, Any]:
+  """Installs the serialized executables listed in the manifest."""
+  manifest_path = os.path.join(cache_path, MANIFEST_FILE)
+  if not os.path.exists(manifest_path):
+    return {}
+  with open(manifest_path, encoding="utf-8") as f:
+    entries = json.load(f)["entries"]
+  loaded = {}
+  for name, entry in entries.items():
+    fn = getattr(engine, _attribute(engine, entry["entry_point"]), None)
+    if not isinstance(fn, AotFunction) or "file" not in entry:
+      continue
+    try:
+      with open(os.path.join(cache_path, entry["file"]), "rb") as f:
+        payload, in_tree, out_tree = pickle.load(f)
+      executable = serialize_executable.deserialize_and_load(
+          payload, in_tree, out_tree
+      )
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      print(f"WARNING: recompiling {name}, failed to load it: {e}")
+      continue
+    fn.add_executable(entry["signature"], executable)
+    loaded[name] = entry
+  return loaded
+
+
+def _compile(engine, pending, entries, cache_path, max_workers):
+  """Lowers the pending calls, compiles them in parallel and saves them."""
+  # Tracing runs the torch model, so it stays on this thread. XLA compilation
+  # releases the GIL.
+  lowered = {}
+  for name, (entry_point, args, kwargs) in pending.items():
+    fn = getattr(engine, _attribute(engine, entry_point))
+    lowered[name] = (entry_point, fn.lower(*args, **kwargs))
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    futures = {
+        name: executor.submit(lowering.compile)
+        for name, (_, lowering) in lowered.items()
+    }
+  for name, (entry_point, args, kwargs) in pending.items():
+    executable = futures[name].result()
+    key = signature(args, {k: v for k, v in kwargs.items() if v is not None})
+    getattr(engine, _attribute(engine, entry_point)).add_executable(
+        key, executable
+    )
+    entry = {"entry_point": entry_point, "signature": key}
+    if cache_path is not None:
+      file_name = name.replace("/", "_") + ".pkl"
+      try:
+        serialized = serialize_executable.serialize(executable)
+        with open(os.path.join(cache_path, file_name), "wb") as f:
+          pickle.dump(serialized, f)
+        entry["file"] = file_name
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        print(f"WARNING: could not serialize {name}: {e}")
+    entries[name] = entry
+
+
+def _insert_calls(engine, params, buckets, decode_states, entries):
+  """The insert calls to compile, of the prefixes of every bucket."""
+  pending = {}
+  for bucket in buckets:
+    names = [f"insert/{bucket}{suffix}" for suffix in decode_states]
+    if all(name in entries for name in names):
+      continue
+    prefix, _ = getattr(engine, _attribute(engine, "prefill"))(
+        params=params,
+        padded_tokens=jnp.zeros((bucket,), dtype=jnp.int32),
+        true_length=1,
+    )
+    for name, decode_state in zip(names, decode_states.values()):
+      if name not in entries:
+        pending[name] = ("insert", (prefix, decode_state), {"slot": 0})
+  return pending
+
+
+def aot_warmup(
+    engine,
+    params: Any,
+    cache_dir: str = "",
+    max_workers: Optional[int] = None,
+) -> Dict[str, Any]:
+  """Compiles the engine entry points for every shape they serve.
+
+  The jitted engine.prefill, engine.insert and engine.generate are replaced
+  by AotFunction wrappers holding the executables; with page attention
+  insert and generate are python functions and only prefill is compiled.
+  With the prefix cache on, the jitted prefill behind the cache lookup is
+  replaced.
+  Calls with other shapes (chunked prefill, prefill with an existing prefix)
+  still go through jit. Executables are picked by the shapes and shardings of
+  the call: insert and generate are compiled for the decode state they
+  return, and for the one init_decode_state returns if it's placed
+  differently.
+
+  If cache_dir is set, executables are loaded from and saved to
+  cache_dir/<config_hash>. Returns the manifest.
+  """
+  for entry_point in _ENTRY_POINTS:
+    name = _attribute(engine, entry_point)
+    fn = getattr(engine, name)
+    if not isinstance(fn, AotFunction) and hasattr(fn, "lower"):
+      setattr(engine, name, AotFunction(fn))
+
+  manifest = {"config_hash": config_hash(engine, params), "entries": {}}
+  cache_path = None
+  if cache_dir:
+    cache_path = os.path.join(
+        os.path.expanduser(cache_dir), manifest["config_hash"]
+    )
+    os.makedirs(cache_path, exist_ok=True)
+    manifest["entries"] = _load(engine, cache_path)
+  entries = manifest["entries"]
+
+  buckets = prefill_buckets(engine.env.max_input_sequence_length)
+  init_state = engine.init_decode_state()
+  decode_states = {
+      "": jax.device_put(init_state, engine.get_decode_state_sharding())
+  }
+  if signature((init_state,), {}) != signature((decode_states[""],), {}):
+    decode_states["/init"] = init_state
+
+  def padded_tokens(bucket):
+    return jnp.zeros((bucket,), dtype=jnp.int32)
+
+  pending = {}
+  for bucket in buckets:
+    if f"prefill/{bucket}" not in entries:
+      pending[f"prefill/{bucket}"] = (
+          "prefill",
+          (),
+          {
+              "params": params,
+              "padded_tokens": padded_tokens(bucket),
+              "true_length": 1,
+          },
+      )
+  if isinstance(engine.generate, AotFunction):
+    for suffix, decode_state in decode_states.items():
+      if f"generate{suffix}" not in entries:
+        pending[f"generate{suffix}"] = (
+            "generate",
+            (params, decode_state),
+            {},
+        )
+  _compile(engine, pending, entries, cache_path, max_workers)
+
+  # Insert is compiled for the prefixes prefill returns, so it goes second
+  pending = {}
+  if isinstance(engine.insert, AotFunction):
+    pending = _insert_calls(engine, params, buckets, decode_states, entries)
+  _compile(engine, pending, entries, cache_path, max_workers)
+
+  if cache_path is not None:
+    _write_manifest(cache_path, manifest)
+  return manifest
@@ -8,12 +8,13 @@ import jax.numpy as jnp
 from jax.experimental import pallas as pl
 from jax.experimental.pallas import tpu as pltpu
 from jax.experimental.pallas.ops.tpu.paged_attention.paged_attention_kernel import paged_attention
+from jax.experimental.pallas.ops.tpu.paged_attention import quantization_utils
 from jax.experimental.shard_map import shard_map
 import numpy as np
 import torch
 import torch.nn.functional as F
 from jetstream_pt import torchjax
-
+from jetstream_pt.quantize import unpack_int4
 
 DEFAULT_MASK_VALUE = -0.7 * float(np.finfo(np.dtype("float32")).max)
 P = jax.sharding.PartitionSpec
@@ -271,6 +272,7 @@ def ragged_mqa_kernel_reference(
     mask_value: float,
     normalize_var: bool,
     quantized: bool,
+    kv_int4: bool = False,
 ):
   """Pallas kernel for ragged attention."""
   b, i = pl.program_id(0), pl.program_id(1)
@@ -289,8 +291,11 @@ def ragged_mqa_kernel_reference(
   @pl.when(i * bk < length)
   def run():
     q = q_ref[...].astype(jnp.float32)
-    k = k_ref[...].astype(jnp.float32)
-    v = v_ref[...].astype(jnp.float32)
+    k, v = k_ref[...], v_ref[...]
+    if kv_int4:
+      k, v = unpack_int4(k, -1), unpack_int4(v, -1)
+    k = k.astype(jnp.float32)
+    v = v.astype(jnp.float32)
     m_prev, l_prev = m_ref[...], l_ref[...]
 
     qk = jax.lax.dot_general(
@@ -299,8 +304,8 @@ def ragged_mqa_kernel_reference(
 
     if normalize_var:
       qk = qk / math.sqrt(k.shape[-1])  # Align with meta llama
-    # Quantized
-    if quantized:
+    # Quantized, int4 key scales are per channel and already applied to q
+    if quantized and not kv_int4:
       qk = qk * k_scaler_ref[...]
 
     mask = i * bk + jax.lax.broadcasted_iota(jnp.int32, qk.shape, 1) < length
@@ -337,6 +342,7 @@ def ragged_mqa_kernel_reference(
         "normalize_var",
         "testing",
         "quantized",
+        "kv_int4",
     ],
 )
 def ragged_mqa_reference(
@@ -355,9 +361,15 @@ def ragged_mqa_reference(
     normalize_var: bool = True,
     testing: bool = False,
     quantized: bool = False,
+    kv_int4: bool = False,
 ) -> tuple[jax.Array, tuple[jax.Array, jax.Array]]:
-  """Ragged multi query attention."""
+  """Ragged multi query attention.
+
+  With kv_int4, k and v are int4 packed along head_dim, see
+  cache_manager.Int4KVCacheGenerate, and unpacked block by block in the kernel.
+  """
   batch_size, time, head_dim = q.shape
+  kv_dim = k.shape[-1]
   # assert end.shape == (batch_size,)
   seq_len = k.shape[-2]
 
@@ -396,10 +408,10 @@ def ragged_mqa_reference(
     return b_next, 0, i_next
 
   if stacked:
-    kv_bp = (None, None, bk, head_dim)
+    kv_bp = (None, None, bk, kv_dim)
     ks_bp = (None, None, 1, bk)
   else:
-    kv_bp = (None, bk, head_dim)
+    kv_bp = (None, bk, kv_dim)
     ks_bp = (None, 1, bk)
 
   in_specs = [
@@ -434,6 +446,7 @@ def ragged_mqa_reference(
           mask_value=mask_value,
           normalize_var=normalize_var,
           quantized=quantized,
+          kv_int4=kv_int4,
       ),
       grid_spec=pltpu.PrefetchScalarGridSpec(
           num_scalar_prefetch=6,
@@ -475,6 +488,7 @@ def ragged_mqa_reference(
         "q_shard_axis",
         "kv_shard_axis",
         "testing",
+        "kv_int4",
     ],
 )
 def ragged_mha(
@@ -494,6 +508,7 @@ def ragged_mha(
     q_shard_axis: int = 0,
     kv_shard_axis: int = 0,
     testing: bool = False,
+    kv_int4: bool = False,
 ) -> tuple[jax.Array, tuple[jax.Array, jax.Array]]:
   """Ragged multi head attention.
   Args:
@@ -504,6 +519,10 @@ def ragged_mha(
       PartitionQuantizedTensor.
     start: A i32[batch_size] jax.Array
     end: A i32[batch_size] jax.Array
+    k_scaler: Per token scales, or with kv_int4 per channel scales
+      [batch_size, num_heads, 1, head_dim].
+    v_scaler: Per token scales, [batch_size, num_heads, seq_len, 1] with
+      kv_int4.
     bk: An integer that is the sequence block size.
     logit_cap: An optional float that caps logits via tanh. By default there is
       no logit capping.
@@ -522,7 +541,7 @@ def ragged_mha(
   hkv = k.shape[-3]
   tk = k.shape[-2]
 
-  assert k.shape[-1] == q.shape[-1]
+  assert k.shape[-1] * (2 if kv_int4 else 1) == q.shape[-1]
   assert k.shape[-4] == q.shape[-4]
 
   rep = hq // hkv
@@ -530,8 +549,16 @@ def ragged_mha(
     q = q.reshape(bq, hkv, rep, tq, dq).reshape(bq, hkv, rep * tq, dq)
   stacked = k.ndim == 5
 
-  replicated_in_axes = 7
-  if k_scaler is None:
+  scale_in_axes = None
+  if kv_int4:
+    # q.k = (q * k_scale).k_int for per channel key scales, so the keys are
+    # never dequantized. The value scales are per head and mapped with k and
+    # v, the kernel skips the key scales.
+    quantized = True
+    q = (q * k_scaler).astype(q.dtype)
+    k_scale = v_scale = jnp.swapaxes(v_scaler, -1, -2)
+    scale_in_axes = kv_shard_axis
+  elif k_scaler is None:
     quantized = False
     if k.ndim == 5:
       kv_scale_shape = (k.shape[0], bq, 1, tk)
@@ -544,17 +571,12 @@ def ragged_mha(
     k_scale = jnp.squeeze(k_scaler, -1)
     v_scale = jnp.squeeze(v_scaler, -1)
 
-  if stacked:
+  if kv_int4:
+    assert k_scale.shape == (bq, hkv, 1, tk)
+  elif stacked:
     assert k_scale.shape == (k.shape[0], bq, 1, tk)
   else:
     assert k_scale.shape == (bq, 1, tk)
-
-  replicated_inputs = (
-      ragged_batch_index,
-      ragged_block_index,
-      k_scale,
-      v_scale,
-  )
   # New cache has t=1
 
   with jax.named_scope("ragged_mha_vmap"):
@@ -567,16 +589,30 @@ def ragged_mha(
             normalize_var=normalize_var,
             testing=testing,
             quantized=quantized,
+            kv_int4=kv_int4,
             # out_dtype=out_dtype,
         ),
         in_axes=(
             q_shard_axis,
             kv_shard_axis,
             kv_shard_axis,
-            *([None] * replicated_in_axes),
+            *([None] * 5),
+            scale_in_axes,
+            scale_in_axes,
         ),
         out_axes=q_shard_axis,
-    )(q, k, v, layer, start, end, *replicated_inputs)
+    )(
+        q,
+        k,
+        v,
+        layer,
+        start,
+        end,
+        ragged_batch_index,
+        ragged_block_index,
+        k_scale,
+        v_scale,
+    )
   return out, (m, l)
 
 
@@ -602,21 +638,35 @@ def reshape_outputs(rep, o, m=None, d=None):
   return o, (m, d)
 
 
-def _dense_attention(xq, keys, values, k_scaler=None, v_scaler=None, mask=None):
+def _unpack_int4_kv(keys, values):
+  """Unpacks int4 keys and values, see cache_manager.Int4KVCacheGenerate."""
+  return torchjax.call_jax(unpack_int4, keys, -1), torchjax.call_jax(
+      unpack_int4, values, -1
+  )
+
+
+def _dense_attention(
+    xq, keys, values, k_scaler=None, v_scaler=None, mask=None, kv_int4=False
+):
   """The vanilla attention kernel implementation."""
 
   bsz, _, _, head_dim = xq.shape
+  if kv_int4:
+    # Per channel key scales are applied to the query instead of the keys
+    xq = (xq * k_scaler).type_as(xq)
+    keys, values = _unpack_int4_kv(keys, values)
+    keys, values = keys.type_as(xq), values.type_as(xq)
   with jax.named_scope("attn_mat1"):
     ## Attention start
     scores = torch.einsum("ikjl,ikml->ikjm", xq, keys) / math.sqrt(head_dim)
-    if k_scaler is not None:
+    if k_scaler is not None and not kv_int4:
       scores = scores * (k_scaler.reshape(bsz, 1, 1, keys.shape[2]))
     if mask is not None:
       scores = scores + mask  # (bs, n_local_heads, seqlen, max_seqlen
   with jax.named_scope("attn_soft"):
     scores = F.softmax(scores.float(), dim=-1).type_as(xq)
     if v_scaler is not None:
-      scores = scores * v_scaler.reshape((bsz, 1, 1, keys.shape[2]))
+      scores = scores * v_scaler.reshape((bsz, -1, 1, keys.shape[2]))
 
   with jax.named_scope("attn_mat2"):
     output = torch.einsum(
@@ -625,10 +675,12 @@ def _dense_attention(xq, keys, values, k_scaler=None, v_scaler=None, mask=None):
   return output
 
 
-def dense_attention(xq, keys, values, k_scaler=None, v_scaler=None, mask=None):
+def dense_attention(
+    xq, keys, values, k_scaler=None, v_scaler=None, mask=None, kv_int4=False
+):
   """The vanilla attention kernel implementation."""
   xq, rep = reshape_heads(xq, keys)
-  output = _dense_attention(xq, keys, values, k_scaler, v_scaler, mask)
+  output = _dense_attention(xq, keys, values, k_scaler, v_scaler, mask, kv_int4)
   output, _ = reshape_outputs(rep, output)
   return output
 
@@ -642,6 +694,7 @@ def _flash_attention(
     v_scaler=None,
     mask=None,
     normalize_var=True,
+    kv_int4=False,
 ):
   """Flash attention kernel."""
   if keys.ndim == 5:
@@ -650,14 +703,17 @@ def _flash_attention(
     k_scaler = k_scaler[layer] if k_scaler is not None else None
     v_scaler = v_scaler[layer] if v_scaler is not None else None
 
-  logits = torch.einsum(
-      "bhqd,bhkd->bhqk", xq.type(torch.float32), keys.type(torch.float32)
-  )
+  xq_scaled = xq.type(torch.float32)
+  if kv_int4:
+    # Per channel key scales are applied to the query instead of the keys
+    xq_scaled = xq_scaled * k_scaler.type(torch.float32)
+    keys, values = _unpack_int4_kv(keys, values)
+  logits = torch.einsum("bhqd,bhkd->bhqk", xq_scaled, keys.type(torch.float32))
 
   if normalize_var:
     logits = logits / math.sqrt(keys.shape[-1])  # Align with meta llama
   # Quantized
-  if k_scaler is not None:
+  if k_scaler is not None and not kv_int4:
     logits = logits * k_scaler.reshape(
         k_scaler.shape[-4], 1, 1, k_scaler.shape[-2]
     )
@@ -675,7 +731,7 @@ def _flash_attention(
   denominator = unnormalized.sum(axis=-1, keepdim=True)
   if v_scaler is not None:
     unnormalized = unnormalized * v_scaler.reshape(
-        v_scaler.shape[-4], 1, 1, v_scaler.shape[-2]
+        v_scaler.shape[-4], -1, 1, v_scaler.shape[-2]
     )
   o = (
       torch.einsum("bhqk,bhkd->bhqd", unnormalized.type_as(xq), values)
@@ -694,8 +750,14 @@ def flash_attention(
     v_scaler=None,
     mask=None,
     normalize_var=True,
+    kv_int4=False,
 ):
-  """Flash attention kernel."""
+  """Flash attention kernel.
+
+  With kv_int4, keys and values are int4 packed along head_dim with per
+  channel key scales and per token value scales, see
+  cache_manager.Int4KVCacheGenerate.
+  """
   xq, rep = reshape_heads(xq, keys)
   o, (logits_max, denominator) = _flash_attention(
       xq=xq,
@@ -706,6 +768,7 @@ def flash_attention(
       v_scaler=v_scaler,
       mask=mask,
       normalize_var=normalize_var,
+      kv_int4=kv_int4,
   )
   return reshape_outputs(rep, o, logits_max, denominator)
 
@@ -714,7 +777,13 @@ class RaggedAttentionKernel:
   """Ragged attention kernel."""
 
   def __init__(
-      self, env, input_specs, output_specs, q_shard_axis, kv_shard_axis
+      self,
+      env,
+      input_specs,
+      output_specs,
+      q_shard_axis,
+      kv_shard_axis,
+      kv_int4=False,
   ):
     self.binded_ragged_mha = functools.partial(
         ragged_mha,
@@ -722,6 +791,7 @@ class RaggedAttentionKernel:
         q_shard_axis=q_shard_axis,
         kv_shard_axis=kv_shard_axis,
         testing=env.testing,
+        kv_int4=kv_int4,
     )
     self.binded_ragged_mha = shard_map(
         self.binded_ragged_mha,
@@ -786,11 +856,21 @@ def shard_kv_heads(
   )
 
 
-def call_paged_attention(env, xq, keys, values, seq_lens, page_indices):
-  """Paged attention kernel."""
+def call_paged_attention(
+    env, xq, keys, values, seq_lens, page_indices, k_scaler=None, v_scaler=None
+):
+  """Paged attention kernel.
+
+  With k_scaler and v_scaler, keys and values are int8 pages dequantized in
+  the kernel, see page_attention_manager.quantize_kv_pages.
+  """
   xq, keys, values, seq_lens, page_indices = torchjax.from_torch(
       (xq, keys, values, seq_lens, page_indices)
   )
+  if k_scaler is not None:
+    k_scaler, v_scaler = torchjax.from_torch((k_scaler, v_scaler))
+    keys = quantization_utils.QuantizedTensor(keys, k_scaler)
+    values = quantization_utils.QuantizedTensor(values, v_scaler)
   paged_attention_impl = functools.partial(
       paged_attention,
       pages_per_compute_block=env.block_size // env.paged_attention_page_size,
@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# pylint: disable=too-many-lines
+# One cache class per kv cache layout and quantization is reasonable here.
+
 import jax
 import jax.numpy as jnp
 from jax.experimental.shard_map import shard_map
@@ -19,7 +22,11 @@ import torch
 import torch_xla2
 
 from jetstream_pt import torchjax
-from jetstream_pt.page_attention_manager import PageAttentionManager
+from jetstream_pt.quantize import pack_int4_jax, unpack_int4
+from jetstream_pt.page_attention_manager import (
+    PageAttentionManager,
+    quantize_kv_pages,
+)
 
 
 # pylint: disable-next=all
@@ -42,14 +49,44 @@ class CacheInterface:
 class KVCachePrefill:
   """Prefill kv cache"""
 
-  def __init__(self, kv_quantize=False, stacked=False):
+  def __init__(
+      self,
+      kv_quantize=False,
+      stacked=False,
+      cache_k=None,
+      cache_v=None,
+      start=None,
+  ):
     self.kv_quantize = kv_quantize
-    self.cache_k = None
-    self.cache_v = None
+    # Cache of the previous prefill chunks, if any (chunked prefill)
+    self.cache_k = cache_k
+    self.cache_v = cache_v
+    # Position of the new kv in a preallocated cache_k and cache_v
+    self.start = start
     self.stacked = stacked
 
   def update(self, key, value, layer_id):
-    """This cache just remembers the stuff."""
+    """This cache just remembers the stuff.
+
+    If the cache already holds the kv of previous chunks, the new
+    key and value are written at start of the preallocated cache, or
+    appended along the sequence dimension without start.
+    """
+    if self.start is not None:
+      caches, new = torchjax.from_torch(
+          ((self.cache_k, self.cache_v), (key, value))
+      )
+      key, value = torchjax.to_torch(
+          tuple(
+              jax.lax.dynamic_update_slice_in_dim(
+                  c, x.astype(c.dtype), self.start, axis=2
+              )
+              for c, x in zip(caches, new)
+          )
+      )
+    elif self.cache_k is not None:
+      key = torch.cat([self.cache_k, key], dim=-2)
+      value = torch.cat([self.cache_v, value], dim=-2)
     self.cache_k = key
     self.cache_v = value
     if self.kv_quantize:  # pretend to be quantized
@@ -90,8 +127,21 @@ jax.tree_util.register_pytree_node(
 )
 
 
+def quantize_kv_static(x, scale):
+  """Quantizes keys or values, [..., heads, seqlen, head_dim], to int8 with
+  the static per head scales, [heads], of kv_calibration."""
+  scale = scale.reshape(-1, 1, 1)
+  vals = jnp.clip(jnp.rint(x / scale), -127, 127)
+  return vals.astype(jnp.int8)
+
+
 class KVCacheGenerate:
-  """Kvache generator without quantization"""
+  """Kvache generator without quantization, or int8 with static scales.
+
+  With env.kv_quantize_static the cache holds int8 keys and values quantized
+  with the per layer, per head scales of env.static_kv_scales, so updates do
+  no reduction and there are no scaler tensors.
+  """
 
   # pylint: disable=too-many-instance-attributes
   # More than 7 is reasonable in this case.
@@ -122,10 +172,13 @@ class KVCacheGenerate:
         if self.env.new_cache_stacked:
           layer, batch, heads, _, dim = self.cache_k.shape
           new_dim = (layer, batch, heads, 1, dim)
+          new_dtype = (
+              jnp.int8 if self.env.kv_quantize_static else self.env.default_type
+          )
           self.new_ks, self.new_vs = torchjax.to_torch(
               (
-                  jnp.zeros(new_dim, dtype=self.env.default_type),
-                  jnp.zeros(new_dim, dtype=self.env.default_type),
+                  jnp.zeros(new_dim, dtype=new_dtype),
+                  jnp.zeros(new_dim, dtype=new_dtype),
               )
           )
         else:
@@ -226,6 +279,15 @@ class KVCacheGenerate:
 
   def update(self, key, value, layer_id: int):
     """Update kv cache"""
+    if self.env.kv_quantize_static:
+      k_scales, v_scales = self.env.static_kv_scales
+      keyj, valuej = torchjax.from_torch((key, value))
+      key, value = torchjax.to_torch(
+          (
+              quantize_kv_static(keyj, k_scales[layer_id]),
+              quantize_kv_static(valuej, v_scales[layer_id]),
+          )
+      )
     keyj, valuej = torchjax.to_torch((key, value))
     if self.env.lazy_cache_update:
       if self.env.new_cache_stacked:
@@ -263,16 +325,18 @@ class KVCacheGenerate:
 
     # Non lazy cache update, non ring buffer, generate cache stacked
     if self.env.generate_cache_stacked:
+      # The layer id is a tensor when the layers are scanned
+      layer_index = torchjax.from_torch(layer_id)
       # pylint: disable-next=all
       self.cache_k._elem = (
           self.cache_k.jax()
-          .at[layer_id, self.batch, :, self.input_pos, :]
+          .at[layer_index, self.batch, :, self.input_pos, :]
           .set(keyj.squeeze(2))
       )
       # pylint: disable-next=all
       self.cache_v._elem = (
           self.cache_v.jax()
-          .at[layer_id, self.batch, :, self.input_pos, :]
+          .at[layer_index, self.batch, :, self.input_pos, :]
           .set(valuej.squeeze(2))
       )
       return self.cache_k[layer_id], self.cache_v[layer_id]
@@ -309,6 +373,8 @@ class KVCacheGenerate:
     else:
       k = jnp.zeros(in_shape, device=device, dtype=default_dtype)
       v = jnp.zeros(in_shape, device=device, dtype=default_dtype)
+    if env.kv_quantize_static:
+      k, v = k.astype(jnp.int8), v.astype(jnp.int8)
     k, v = torchjax.to_torch((k, v))
     return cls(k, v, 0, device, env=env)
 
@@ -657,9 +723,193 @@ class Int8KVCacheGenerate:
         )
 
 
+def quantize_keys_int4(keys, scale=None, length=None):
+  """Quantizes keys, [..., seqlen, head_dim], to int4 per channel.
+
+  Without scale, the scale of every channel is computed over the first length
+  positions of the sequence, all of them if length is None, which is how the
+  keys of the prompt are quantized. Decode keys reuse the scale of their slot,
+  see grow_key_scales_int4.
+
+  Returns the values packed two per byte along head_dim and the scales,
+  [..., 1, head_dim].
+  """
+  if scale is None:
+    abs_keys = jnp.abs(keys)
+    if length is not None:
+      # Padding tokens don't count in the range of the prompt
+      positions = jnp.arange(keys.shape[-2]).reshape(-1, 1)
+      abs_keys = jnp.where(positions < length, abs_keys, 0)
+    amax = jnp.max(abs_keys, axis=-2, keepdims=True)
+    scale = jnp.where(amax == 0, 1, amax) / 7
+  vals = jnp.clip(jnp.rint(keys / scale), -8, 7)
+  return pack_int4_jax(vals, -1), scale.astype(keys.dtype)
+
+
+def grow_key_scales_int4(cache_k, scale, keys):
+  """Grows the per channel key scales that new keys don't fit in.
+
+  The scales of a slot come from its prompt, a short prompt gives a narrow
+  range that later keys would be clipped to. When a key of keys,
+  [batch, heads, 1, head_dim], exceeds its channel's range, the scale grows to
+  fit it and the cached keys of the channel are requantized to the new scale.
+
+  Returns the cache and the scales.
+  """
+  amax = jnp.max(jnp.abs(keys), axis=-2, keepdims=True)
+  new_scale = jnp.maximum(scale, (amax / 7).astype(scale.dtype))
+
+  def requantize(cache_k):
+    ratio = (scale / new_scale).astype(jnp.float32)
+    vals = jnp.rint(unpack_int4(cache_k, -1) * ratio)
+    return pack_int4_jax(vals, -1)
+
+  cache_k = jax.lax.cond(
+      jnp.any(new_scale > scale), requantize, lambda c: c, cache_k
+  )
+  return cache_k, new_scale
+
+
+def quantize_values_int4(values):
+  """Quantizes values, [..., seqlen, head_dim], to int4 per token.
+
+  Returns the values packed two per byte along head_dim and the scales,
+  [..., seqlen, 1].
+  """
+  amax = jnp.max(jnp.abs(values), axis=-1, keepdims=True)
+  scale = jnp.where(amax == 0, 1, amax) / 7
+  vals = jnp.clip(jnp.rint(values / scale), -8, 7)
+  return pack_int4_jax(vals, -1), scale.astype(values.dtype)
+
+
+class Int4KVCacheGenerate:
+  """Int4 quantized kvache, per channel keys and per token values (KIVI).
+
+  Keys and values are packed two per byte along head_dim. Key scales are
+  [batch, heads, 1, head_dim], set from the prompt at insert and grown when a
+  decode key exceeds them, value scales are [batch, heads, seqlen, 1]. The
+  cache is never dequantized, the attention kernels fold the key scales into
+  the query and the value scales into the probabilities.
+  """
+
+  # pylint: disable=too-many-instance-attributes
+  # More than 7 is reasonable in this case.
+  def __init__(
+      self,
+      cache_k,
+      cache_v,
+      cache_k_scaler,
+      cache_v_scaler,
+      input_pos,  # used to write cache
+      sharding=None,
+      env=None,
+  ):
+    self.cache_k = cache_k
+    self.cache_v = cache_v
+    self.k_scaler = cache_k_scaler
+    self.v_scaler = cache_v_scaler
+    self.new_ks = None
+    self.new_vs = None
+    self.new_v_scaler = None
+    self.batch = jnp.arange(env.batch_size)
+    self.input_pos = input_pos
+    self.sharding = sharding
+    self.env = env
+    assert not env.generate_cache_stacked, "int4 kv cache is per layer"
+    self.stacked = False
+
+  def _write(self, k_quant, v_quant, vscale):
+    cache_k, cache_v, v_scaler = torchjax.from_torch(
+        (self.cache_k, self.cache_v, self.v_scaler)
+    )
+    pos = self.input_pos
+    if isinstance(pos, torch.Tensor):
+      pos = torchjax.from_torch(pos)
+
+    def write(cache, x):
+      if self.env.ring_buffer:
+        return cache.at[:, :, pos, :].set(x)
+      return cache.at[self.batch, :, pos, :].set(x.squeeze(2))
+
+    self.cache_k, self.cache_v, self.v_scaler = torchjax.to_torch(
+        (
+            write(cache_k, k_quant),
+            write(cache_v, v_quant),
+            write(v_scaler, vscale),
+        )
+    )
+
+  def update(self, xk, xv, layer_id: int):
+    """Update kv cache"""
+    keyj, valuej, cache_k, k_scalerj = torchjax.from_torch(
+        (xk, xv, self.cache_k, self.k_scaler)
+    )
+    cache_k, k_scalerj = grow_key_scales_int4(cache_k, k_scalerj, keyj)
+    self.cache_k, self.k_scaler = torchjax.to_torch((cache_k, k_scalerj))
+    k_quant, _ = quantize_keys_int4(keyj, k_scalerj)
+    v_quant, vscale = quantize_values_int4(valuej)
+    if self.env.lazy_cache_update:
+      self.new_ks, self.new_vs, self.new_v_scaler = k_quant, v_quant, vscale
+      # The new token is attended in full precision
+      return (
+          self.cache_k,
+          self.cache_v,
+          xk,
+          xv,
+          self.k_scaler,
+          self.v_scaler,
+          None,
+          None,
+      )
+    self._write(k_quant, v_quant, vscale)
+    return (
+        self.cache_k,
+        self.cache_v,
+        None,
+        None,
+        self.k_scaler,
+        self.v_scaler,
+        None,
+        None,
+    )
+
+  def finalize(self):
+    """Finalize the cache operation and updates the cache."""
+    if not self.env.lazy_cache_update:
+      return
+    self._write(self.new_ks, self.new_vs, self.new_v_scaler)
+
+  def state(self):
+    """Get kv cache state"""
+    return torchjax.from_torch((self.cache_k, self.cache_v))
+
+  def scalers(self):
+    """Get kv cache scalers"""
+    return torchjax.from_torch((self.k_scaler, self.v_scaler))
+
+  @classmethod
+  # pylint: disable-next=all
+  def empty(cls, shape, device, env):
+    """Create empty kv caches"""
+    default_dtype = jnp.bfloat16 if env.bf16_enable else jnp.float32
+    batch, heads, seqlen, head_dim = shape
+    packed_shape = (batch, heads, seqlen, head_dim // 2)
+    cache_k = jnp.zeros(packed_shape, device=device, dtype=jnp.int8)
+    cache_v = jnp.zeros(packed_shape, device=device, dtype=jnp.int8)
+    kscaler = jnp.ones((batch, heads, 1, head_dim), dtype=default_dtype)
+    vscaler = jnp.ones((batch, heads, seqlen, 1), dtype=default_dtype)
+
+    cache_k, cache_v, kscaler, vscaler = torchjax.to_torch(
+        (cache_k, cache_v, kscaler, vscaler)
+    )
+    return cls(cache_k, cache_v, kscaler, vscaler, 0, device, env=env)
+
+
 class PageKVCacheGenerate:
   """Page attention kvache generator without quantization"""
 
+  # pylint: disable=too-many-instance-attributes
+  # More than 7 is reasonable in this case.
   def __init__(
       self,
       cache_k: torch.Tensor,  # previous cache
@@ -668,43 +918,51 @@ class PageKVCacheGenerate:
       page_token_indices: torch.Tensor,  # page and token indices for the cache
       sharding,
       env=None,
+      page_indices: torch.Tensor = None,  # [batch_size, max_pages_per_seq]
+      lengths: torch.Tensor = None,  # [batch_size] attended length per slot
   ):
     super().__init__()
     self.cache_k = cache_k
     self.cache_v = cache_v
     self.page_attention_manager = page_attention_manager
     self.page_token_indices = page_token_indices
+    # Page table used by the attention kernel, defaults to the manager's
+    if page_indices is None and page_attention_manager is not None:
+      page_indices = page_attention_manager.page_indices
+    if lengths is None and page_attention_manager is not None:
+      lengths = page_attention_manager.lengths
+    self.page_indices = page_indices
+    self.lengths = lengths
     self.sharding = sharding
     self.env = env
     self.stacked = False
 
   def update(self, key, value, layer_id=0):
     """Update kv cache"""
-    keyj, valuej, page_token_indicesj = torchjax.from_torch(
-        (key, value, self.page_token_indices)
-    )
-
-    def _update(cache, x):
-      x = x.squeeze(2).transpose((1, 0, 2))
-      x = x[:, page_token_indicesj[2], :]
-      head, _, paged_attention_page_size, dim = cache.shape
-      selected_cache = cache[:, page_token_indicesj[0], :, :]
-      selected_cache = selected_cache.reshape((head, -1, dim))
-
-      selected_cache = selected_cache.at[:, page_token_indicesj[1], :].set(x)
-      selected_cache = selected_cache.reshape(
-          (head, -1, paged_attention_page_size, dim)
-      )
-
-      cache = cache.at[:, page_token_indicesj[0], :, :].set(selected_cache)
-      return cache
-
+    keyj, valuej = torchjax.from_torch((key, value))
     # pylint: disable-next=all
-    self.cache_k._elem = _update(self.cache_k._elem, keyj)
+    self.cache_k._elem = self._update(self.cache_k._elem, keyj)
     # pylint: disable-next=all
-    self.cache_v._elem = _update(self.cache_v._elem, valuej)
+    self.cache_v._elem = self._update(self.cache_v._elem, valuej)
     return self.cache_k, self.cache_v
 
+  def _update(self, cache, x):
+    """Writes x, [batch, heads, 1, dim], to the page token of each slot."""
+    page_token_indicesj = torchjax.from_torch(self.page_token_indices)
+    x = x.squeeze(2).transpose((1, 0, 2))
+    x = x[:, page_token_indicesj[2], :]
+    head, _, paged_attention_page_size, dim = cache.shape
+    selected_cache = cache[:, page_token_indicesj[0], :, :]
+    selected_cache = selected_cache.reshape((head, -1, dim))
+
+    selected_cache = selected_cache.at[:, page_token_indicesj[1], :].set(x)
+    selected_cache = selected_cache.reshape(
+        (head, -1, paged_attention_page_size, dim)
+    )
+
+    cache = cache.at[:, page_token_indicesj[0], :, :].set(selected_cache)
+    return cache
+
   def state(self):
     """Get kv cache state"""
     # pylint: disable-next=all
@@ -722,3 +980,76 @@ class PageKVCacheGenerate:
     v = jnp.zeros(shape, device=device, dtype=default_dtype)
     k, v = torchjax.to_torch((k, v))
     return cls(k, v, None, None, device, env=env)
+
+
+class PageInt8KVCacheGenerate(PageKVCacheGenerate):
+  """Page attention kvache quantized to int8 per token and head.
+
+  The scalers are [num_heads, total_num_pages, page_size, 1], in the
+  convention of the paged attention kernel, see quantize_kv_pages.
+  """
+
+  def __init__(
+      self,
+      cache_k: torch.Tensor,
+      cache_v: torch.Tensor,
+      cache_k_scaler: torch.Tensor,
+      cache_v_scaler: torch.Tensor,
+      page_attention_manager: PageAttentionManager,
+      page_token_indices: torch.Tensor,
+      sharding,
+      env=None,
+      page_indices: torch.Tensor = None,
+      lengths: torch.Tensor = None,
+  ):
+    super().__init__(
+        cache_k,
+        cache_v,
+        page_attention_manager,
+        page_token_indices,
+        sharding,
+        env=env,
+        page_indices=page_indices,
+        lengths=lengths,
+    )
+    self.k_scaler = cache_k_scaler
+    self.v_scaler = cache_v_scaler
+
+  def update(self, key, value, layer_id=0):
+    """Quantize and update kv cache"""
+    keyj, valuej = torchjax.from_torch((key, value))
+    k_quant, kscale = quantize_kv_pages(keyj)
+    v_quant, vscale = quantize_kv_pages(valuej)
+    # pylint: disable=protected-access
+    self.cache_k._elem = self._update(self.cache_k._elem, k_quant)
+    self.cache_v._elem = self._update(self.cache_v._elem, v_quant)
+    self.k_scaler._elem = self._update(self.k_scaler._elem, kscale)
+    self.v_scaler._elem = self._update(self.v_scaler._elem, vscale)
+    # pylint: enable=protected-access
+    # Same as Int8KVCacheGenerate, the new kv is already in the cache
+    return (
+        self.cache_k,
+        self.cache_v,
+        None,
+        None,
+        self.k_scaler,
+        self.v_scaler,
+        None,
+        None,
+    )
+
+  def scalers(self):
+    """Get kv cache scalers"""
+    return torchjax.from_torch((self.k_scaler, self.v_scaler))
+
+  @classmethod
+  def empty(cls, shape, device, env):
+    """Create empty kv caches"""
+    default_dtype = jnp.bfloat16 if env.bf16_enable else jnp.float32
+    k = jnp.zeros(shape, device=device, dtype=jnp.int8)
+    v = jnp.zeros(shape, device=device, dtype=jnp.int8)
+    s_shape = (*shape[:-1], 1)
+    kscaler = jnp.ones(s_shape, device=device, dtype=default_dtype)
+    vscaler = jnp.ones(s_shape, device=device, dtype=default_dtype)
+    k, v, kscaler, vscaler = torchjax.to_torch((k, v, kscaler, vscaler))
+    return cls(k, v, kscaler, vscaler, None, None, device, env=env)
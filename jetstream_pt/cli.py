@@ -1,8 +1,10 @@
+import dataclasses
 import os
 from typing import List
 import random
 import sys
 import time
+
 # import torch_xla2 first!
 import torch_xla2  # pylint: disable
 import jax
@@ -17,12 +19,27 @@ from transformers import AutoTokenizer
 
 from jetstream_pt import fetch_models
 from jetstream_pt import environment, engine, quantize_model, torchjax
-from jetstream_pt import config
-
+from jetstream_pt import aot_cache, config, safetensors_loader, speculative
+from jetstream_pt import activation_calibration, kv_calibration
+from jetstream_pt import quantization_planner
 
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string("model_id", "", "")
+flags.DEFINE_string(
+    "draft_model_id",
+    "",
+    "if set, use this model as the draft model for speculative decoding",
+)
+flags.DEFINE_integer(
+    "num_speculative_tokens", 4, "number of tokens the draft model proposes"
+)
+flags.DEFINE_integer(
+    "prompt_lookup_max_ngram_size",
+    0,
+    "if positive and there is no draft model, speculate with prompt lookup"
+    " over n-grams up to this size",
+)
 flags.DEFINE_integer("override_batch_size", 32, "The batch size")
 flags.DEFINE_integer("max_input_length", 1024, "The batch size")
 flags.DEFINE_integer("max_output_length", 1024, "The batch size")
@@ -38,7 +55,25 @@ flags.DEFINE_bool(
     "internal_use_local_tokenizer", 0, "Use local tokenizer if set to True"
 )
 flags.DEFINE_bool("enable_model_warmup", False, "enable model warmup")
-
+flags.DEFINE_string(
+    "quantized_checkpoint_dir",
+    "",
+    "export_quantized saves the quantized weights to this dir, if set the"
+    " other commands load them instead of quantizing the model weights",
+)
+flags.DEFINE_string(
+    "calibration_prompts_file",
+    "",
+    "calibrate_kv and calibrate_activations calibrate the scales and"
+    " plan_quantization measures the layer errors on the prompts of this"
+    " file, one per line",
+)
+flags.DEFINE_float(
+    "quantization_plan_max_error",
+    1e-3,
+    "plan_quantization keeps the mean over the linear layers of the relative"
+    " output error under this",
+)
 
 
 def shard_weights(env, weights, weight_shardings):
@@ -56,38 +91,300 @@ def shard_weights(env, weights, weight_shardings):
   return sharded
 
 
-def create_engine(devices):
-  """Create Pytorch engine from flags"""
-  torch.set_default_dtype(torch.bfloat16)
-  quant_config = config.create_quantization_config_from_flags()
-  config.set_jax_compilation_cache_config()
+def _create_env(model_id, quant_config=None):
   env_data = fetch_models.construct_env_data_from_model_id(
-      FLAGS.model_id,
+      model_id,
       FLAGS.override_batch_size,
       FLAGS.max_input_length,
       FLAGS.max_output_length,
   )
+  if quant_config is not None:
+    # The kv cache layout is derived from the environment, only the weight
+    # quantization is applied after the float model is constructed
+    env_data.quant_config = dataclasses.replace(
+        env_data.quant_config,
+        enable_kv_quantization=quant_config.enable_kv_quantization,
+        num_bits_kv=quant_config.num_bits_kv,
+        kv_scales_path=quant_config.kv_scales_path,
+    )
+  env_data.prefill_chunk_size = FLAGS.prefill_chunk_size
+  env_data.prefix_cache_max_bytes = FLAGS.prefix_cache_max_bytes
+  env_data.prefix_cache_block_size = FLAGS.prefix_cache_block_size
+  env_data.moe_capacity_factor = FLAGS.moe_capacity_factor
+  env_data.moe_expert_parallel = FLAGS.moe_expert_parallel
+  env_data.moe_routing_stats_path = FLAGS.moe_routing_stats_path
+  env_data.moe_routing_stats_interval = FLAGS.moe_routing_stats_interval
+  env_data.scan_layers = FLAGS.scan_layers
+  if FLAGS.paged_attention_total_num_pages > 0:
+    _, num_kv_heads, _, head_dim = env_data.cache_shape
+    env_data.paged_attention_total_num_pages = (
+        FLAGS.paged_attention_total_num_pages
+    )
+    env_data.paged_attention_page_size = FLAGS.paged_attention_page_size
+    env_data.paged_attention_device_reservation = (
+        FLAGS.paged_attention_device_reservation
+    )
+    if FLAGS.paged_attention_preemption:
+      # A paused slot generates invalid tokens, which the JetStream
+      # orchestrator takes as the end of its request
+      raise ValueError(
+          "paged_attention_preemption is only supported through the engine "
+          "API, the JetStream orchestrator would end the preempted requests"
+      )
+    env_data.cache_shape = (
+        num_kv_heads,
+        FLAGS.paged_attention_total_num_pages,
+        FLAGS.paged_attention_page_size,
+        head_dim,
+    )
   env = environment.JetEngineEnvironment(env_data)
   if FLAGS.internal_use_local_tokenizer:
     tokenizer = AutoTokenizer.from_pretrained(env_data.checkpoint_path)
   else:
-    tokenizer = AutoTokenizer.from_pretrained(FLAGS.model_id)
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
   env.hf_tokenizer = tokenizer
-  model = fetch_models.instantiate_model_from_repo_id(FLAGS.model_id, env)
+  return env
+
+
+def _set_quant_config(env, quant_config):
+  """Sets the quantization config of env and of the data it was built from."""
+  env.quant_config = quant_config
+  # make_caches_generate and the aot cache hash read the env data
+  # pylint: disable-next=protected-access
+  env._data.quant_config = quant_config
+
+
+def _create_quantized_model(model_id, env, quant_config):
+  model = fetch_models.instantiate_model_from_repo_id(model_id, env)
   # NOTE: this is assigned later because, the model should be constructed
   # as a float model first then quantized
   env.quant_config = quant_config
   if quant_config.enable_weight_quantization:
     quantize_model.quantize_model(model, quant_config)
+  _set_quant_config(env, quant_config)
+  return model
+
+
+def _load_quantized_weights(env, model, path):
+  """Loads the weights saved by export_quantized straight to the devices."""
   weight_shardings = model.get_sharding_annotations()
-  sharded_weights = shard_weights(env, model.state_dict(), weight_shardings)
-  env_data.quant_config = quant_config
 
-  return engine.PyTorchEngine(
+  def sharding(key):
+    return env.sharding_by_axis(weight_shardings.get(key, -1))
+
+  checkpoint = safetensors_loader.SafetensorsCheckpoint(path)
+  state_dict = model.state_dict()
+  missing = [
+      key for key in state_dict if key not in checkpoint and key != "freqs_cis"
+  ]
+  if missing:
+    raise ValueError(f"Weights {missing} not found in {path}")
+  keys = [key for key in state_dict if key in checkpoint]
+  for key in keys:
+    if tuple(checkpoint.get_tensor(key).shape) != tuple(state_dict[key].shape):
+      raise ValueError(
+          f"Weight {key} has shape {checkpoint.get_tensor(key).shape} in"
+          f" {path}, the model expects {tuple(state_dict[key].shape)}"
+      )
+  weights = safetensors_loader.load_sharded(checkpoint, keys, sharding)
+  with jax.default_device(jax.devices("cpu")[0]):
+    freqs_cis = torch_xla2.tensor.t2j(model.freqs_cis)
+  weights["freqs_cis"] = jax.device_put(freqs_cis, sharding("freqs_cis"))
+  return weights
+
+
+def _create_pytorch_engine(model_id, quant_config, quantized_checkpoint_dir=""):
+  env = _create_env(model_id, quant_config)
+  if quantized_checkpoint_dir:
+    # The weights are quantized already, so the model is constructed with
+    # quantized layers and loads them as they are.
+    quant_config = quantize_model.load_quantization_config(
+        quantized_checkpoint_dir, quant_config
+    )
+    _set_quant_config(env, quant_config)
+    model = fetch_models.instantiate_model_from_repo_id(
+        model_id, env, load_weights=False
+    )
+    weights = _load_quantized_weights(env, model, quantized_checkpoint_dir)
+    quantize_model.load_activation_scales(model, quant_config)
+  else:
+    model = _create_quantized_model(model_id, env, quant_config)
+    weight_shardings = model.get_sharding_annotations()
+    sharded_weights = shard_weights(env, model.state_dict(), weight_shardings)
+    weights = torchjax.from_torch_with_copy(sharded_weights)
+
+  pt_engine = engine.PyTorchEngine(
       pt_model=model,
       env=env,
-      weights=torchjax.from_torch_with_copy(sharded_weights),
+      weights=weights,
+  )
+  if FLAGS.aot_warmup:
+    start = time.perf_counter()
+    manifest = aot_cache.aot_warmup(
+        pt_engine, pt_engine.load_params(), FLAGS.aot_cache_dir
+    )
+    print(
+        f"AOT warmup of {len(manifest['entries'])} executables took"
+        f" {time.perf_counter() - start:.1f}s"
+    )
+  return pt_engine
+
+
+def create_engine(devices):
+  """Create Pytorch engine from flags"""
+  torch.set_default_dtype(torch.bfloat16)
+  quant_config = config.create_quantization_config_from_flags()
+  config.set_jax_compilation_cache_config()
+  target = _create_pytorch_engine(
+      FLAGS.model_id, quant_config, FLAGS.quantized_checkpoint_dir
+  )
+  if FLAGS.draft_model_id:
+    draft = _create_pytorch_engine(FLAGS.draft_model_id, quant_config)
+    return speculative.SpeculativeEngine(
+        target, draft, num_speculative_tokens=FLAGS.num_speculative_tokens
+    )
+  if FLAGS.prompt_lookup_max_ngram_size > 0:
+    return speculative.SpeculativeEngine(
+        target,
+        num_speculative_tokens=FLAGS.num_speculative_tokens,
+        max_ngram_size=FLAGS.prompt_lookup_max_ngram_size,
+    )
+  return target
+
+
+def export_quantized():
+  """Quantize the model weights and save them for quantized_checkpoint_dir."""
+  _check_model_id()
+  if not FLAGS.quantized_checkpoint_dir:
+    print("Please specify the output dir with --quantized_checkpoint_dir")
+    sys.exit(1)
+  torch.set_default_dtype(torch.bfloat16)
+  quant_config = config.create_quantization_config_from_flags()
+  if not quant_config.enable_weight_quantization:
+    print("Please enable weight quantization with --quantize_weights")
+    sys.exit(1)
+  env = _create_env(FLAGS.model_id)
+  model = _create_quantized_model(FLAGS.model_id, env, quant_config)
+  quantize_model.save_quantized_checkpoint(
+      model, quant_config, FLAGS.quantized_checkpoint_dir
+  )
+  print(f"Saved quantized weights to {FLAGS.quantized_checkpoint_dir}")
+
+
+def calibrate_kv():
+  """Calibrate static int8 kv cache scales and save them for kv_scales_path."""
+  _check_model_id()
+  if not FLAGS.kv_scales_path:
+    print("Please specify the output file with --kv_scales_path")
+    sys.exit(1)
+  if not FLAGS.calibration_prompts_file:
+    print("Please specify the prompts with --calibration_prompts_file")
+    sys.exit(1)
+  torch.set_default_dtype(torch.bfloat16)
+  # Calibrate on the float kv cache of the quantized weights
+  quant_config = dataclasses.replace(
+      config.create_quantization_config_from_flags(),
+      enable_kv_quantization=False,
+      kv_scales_path="",
+  )
+  pt_engine = _create_pytorch_engine(
+      FLAGS.model_id, quant_config, FLAGS.quantized_checkpoint_dir
+  )
+  params = pt_engine.load_params()
+  token_ids = _calibration_token_ids(pt_engine)
+  k_scales, v_scales = kv_calibration.calibrate_kv_scales(
+      pt_engine, params, token_ids
+  )
+  kv_calibration.save_kv_scales(FLAGS.kv_scales_path, k_scales, v_scales)
+  print(
+      f"Saved the kv scales of {len(token_ids)} prompts to"
+      f" {FLAGS.kv_scales_path}"
+  )
+
+
+def calibrate_activations():
+  """Calibrate static activation scales and save them for
+  activation_scales_path."""
+  _check_model_id()
+  if not FLAGS.activation_scales_path:
+    print("Please specify the output file with --activation_scales_path")
+    sys.exit(1)
+  if not FLAGS.calibration_prompts_file:
+    print("Please specify the prompts with --calibration_prompts_file")
+    sys.exit(1)
+  torch.set_default_dtype(torch.bfloat16)
+  # Calibrate with per token activation scales
+  quant_config = dataclasses.replace(
+      config.create_quantization_config_from_flags(),
+      activation_scales_path="",
   )
+  if not quant_config.enable_activation_quantization:
+    print(
+        "Please enable activation quantization with --quantize_weights"
+        " --quantize_activation"
+    )
+    sys.exit(1)
+  pt_engine = _create_pytorch_engine(
+      FLAGS.model_id, quant_config, FLAGS.quantized_checkpoint_dir
+  )
+  params = pt_engine.load_params()
+  token_ids = _calibration_token_ids(pt_engine)
+  scales = activation_calibration.calibrate_activation_scales(
+      pt_engine, params, token_ids
+  )
+  activation_calibration.save_activation_scales(
+      FLAGS.activation_scales_path, scales
+  )
+  print(
+      f"Saved the activation scales of {len(token_ids)} prompts to"
+      f" {FLAGS.activation_scales_path}"
+  )
+
+
+def plan_quantization():
+  """Plan the per layer weight quantization and save it for
+  quantization_plan_path."""
+  _check_model_id()
+  if not FLAGS.quantization_plan_path:
+    print("Please specify the output file with --quantization_plan_path")
+    sys.exit(1)
+  if not FLAGS.calibration_prompts_file:
+    print("Please specify the prompts with --calibration_prompts_file")
+    sys.exit(1)
+  torch.set_default_dtype(torch.bfloat16)
+  # The layer errors are measured against the float weights
+  quant_config = environment.QuantizationConfig()
+  pt_engine = _create_pytorch_engine(FLAGS.model_id, quant_config)
+  params = pt_engine.load_params()
+  token_ids = _calibration_token_ids(pt_engine)
+  plan = quantization_planner.plan_quantization(
+      pt_engine,
+      params,
+      token_ids,
+      FLAGS.quantization_plan_max_error,
+      block_size=quant_config.block_size_weight,
+  )
+  quantization_planner.save_plan(FLAGS.quantization_plan_path, plan)
+  print(
+      f"Saved the plan of {len(plan.layer_settings)} layers to"
+      f" {FLAGS.quantization_plan_path}: {plan.weight_bytes / 2**30:.2f} GiB"
+      f" of linear weights instead of {plan.float_weight_bytes / 2**30:.2f}"
+      f" GiB, mean error {plan.mean_error:.2e}"
+  )
+
+
+def _calibration_token_ids(pt_engine):
+  """Token ids of the prompts of calibration_prompts_file."""
+  tokenizer = pt_engine.build_tokenizer(pt_engine.get_tokenizer())
+  with open(FLAGS.calibration_prompts_file, encoding="utf-8") as f:
+    prompts = [line for line in f.read().splitlines() if line.strip()]
+  token_ids = []
+  for prompt in prompts:
+    tokens, true_length = tokenizer.encode(
+        prompt, is_bos=True, prefill_lengths=[FLAGS.max_input_length]
+    )
+    token_ids.append(np.asarray(tokens)[:true_length])
+  return token_ids
 
 
 def list_model():
@@ -383,6 +680,14 @@ def main():
       interactive()
     elif argv[1] == "benchmark_offline":
       benchmark_offline()
+    elif argv[1] == "export_quantized":
+      export_quantized()
+    elif argv[1] == "calibrate_kv":
+      calibrate_kv()
+    elif argv[1] == "calibrate_activations":
+      calibrate_activations()
+    elif argv[1] == "plan_quantization":
+      plan_quantization()
     else:
       print(
           "Invalid arguments. please specify 'list', 'serve', or 'interactive'."
@@ -16,6 +16,7 @@
 import os
 from absl import flags
 import jax
+from jetstream_pt import quantization_planner
 from jetstream_pt.environment import QuantizationConfig
 
 FLAGS = flags.FLAGS
@@ -45,23 +46,48 @@ flags.DEFINE_bool(
     False,
     "Quantize Q,K,V projection and FeedForward activation. Defaults to False",
 )
+flags.DEFINE_string(
+    "activation_scales_path",
+    "",
+    "if set, quantize the activations with the static scales saved to this"
+    " file by calibrate_activations",
+)
 flags.DEFINE_string(
     "quantize_type", "int8_per_channel", "Type of quantization."
 )
 flags.DEFINE_bool(
     "quantize_kv_cache", None, "defaults to the same value as quantize_weights"
 )
+flags.DEFINE_integer(
+    "quantize_kv_cache_bits",
+    8,
+    "8 for an int8 kv cache, 4 for an int4 kv cache with per channel keys and"
+    " per token values",
+)
+flags.DEFINE_string(
+    "kv_scales_path",
+    "",
+    "if set, quantize the int8 kv cache with the static scales saved to this"
+    " file by calibrate_kv",
+)
 flags.DEFINE_multi_string(
     "quantize_exclude_layers",
     None,
     "List of layer names to exclude from quantization",
 )
+flags.DEFINE_string(
+    "quantization_plan_path",
+    "",
+    "if set, quantize the linear layers with the per layer settings saved to"
+    " this file by plan_quantization, the other layers with quantize_type",
+)
 
 _VALID_QUANTIZATION_TYPE = {
     "int8_per_channel",
     "int4_per_channel",
     "int8_blockwise",
     "int4_blockwise",
+    "int4_blockwise_packed",
 }
 
 flags.register_validator(
@@ -120,6 +146,59 @@ flags.DEFINE_bool(
     "Only takes effect at test mode",
     required=False,
 )
+flags.DEFINE_integer(
+    "prefill_chunk_size",
+    0,
+    "Number of prompt tokens processed per step in chunked prefill, "
+    "so long prompts can be interleaved with generate steps. "
+    "0 disables chunked prefill.",
+    required=False,
+)
+flags.DEFINE_integer(
+    "prefix_cache_max_bytes",
+    0,
+    "Memory budget in bytes of the kv cache of shared prompt prefixes, "
+    "prefill only computes the prompt tokens after the longest cached "
+    "prefix. Least recently used prefixes are evicted first. 0 disables it.",
+    required=False,
+)
+flags.DEFINE_integer(
+    "prefix_cache_block_size",
+    64,
+    "Number of tokens per block of the shared prompt prefix cache",
+    required=False,
+)
+flags.DEFINE_float(
+    "moe_capacity_factor",
+    0.0,
+    "If positive, mixture of experts prefill runs only the activated experts "
+    "of every token, with this many times the expert slots of a uniform "
+    "routing; tokens routed to a full expert skip it. 0 runs every expert "
+    "on every prefill token.",
+    required=False,
+)
+flags.DEFINE_bool(
+    "moe_expert_parallel",
+    False,
+    "Whether to shard the experts of mixture of experts layers over the "
+    "devices and dispatch the tokens to them with an all to all, instead of "
+    "sharding the intermediate dim of every expert",
+    required=False,
+)
+flags.DEFINE_string(
+    "moe_routing_stats_path",
+    "",
+    "If set, record the tokens per expert and the router entropy of every "
+    "mixture of experts layer in generate and append them to this file as "
+    "json lines every moe_routing_stats_interval seconds",
+    required=False,
+)
+flags.DEFINE_float(
+    "moe_routing_stats_interval",
+    60.0,
+    "Seconds between the exports of the routing stats",
+    required=False,
+)
 flags.DEFINE_float(
     "temperature",
     1.0,
@@ -155,6 +234,39 @@ flags.DEFINE_integer(
     64,
     "page size per page",
 )
+flags.DEFINE_bool(
+    "paged_attention_device_reservation",
+    False,
+    "Whether to reserve the pages of each decode step on device, "
+    "so page attention generate steps don't wait for a host sync",
+)
+flags.DEFINE_bool(
+    "paged_attention_preemption",
+    False,
+    "Whether to swap the kv pages of running slots out to host memory "
+    "when page attention runs out of pages, instead of failing. Not "
+    "supported by the commands, the JetStream orchestrator would end the "
+    "preempted requests",
+)
+flags.DEFINE_bool(
+    "scan_layers",
+    False,
+    "Whether to run the model layers with a scan over stacked weights, "
+    "which cuts compile time and executable size. Needs the stacked "
+    "generate cache of ring_buffer=False",
+)
+flags.DEFINE_bool(
+    "aot_warmup",
+    False,
+    "Whether to compile prefill for every bucket, insert and generate ahead "
+    "of time before serving",
+)
+flags.DEFINE_string(
+    "aot_cache_dir",
+    "~/jetstream_pt_aot_cache",
+    "Directory the ahead of time compiled executables are saved to and "
+    "loaded from, empty to keep them in memory only",
+)
 flags.DEFINE_string(
     "internal_jax_compilation_cache_dir",
     "~/jax_cache",
@@ -183,14 +295,22 @@ def create_quantization_config_from_flags():
 
   config.num_bits_weight = 8 if "int8" in quantize_type else 4
   config.is_blockwise_weight = "blockwise" in quantize_type
+  config.pack_weight = quantize_type.endswith("_packed")
 
   config.enable_activation_quantization = FLAGS.quantize_activation
+  config.activation_scales_path = FLAGS.activation_scales_path
   config.exclude_layers = FLAGS.quantize_exclude_layers
+  if FLAGS.quantization_plan_path:
+    config.layer_configs = quantization_planner.load_layer_configs(
+        FLAGS.quantization_plan_path
+    )
   config.enable_kv_quantization = (
       FLAGS.quantize_kv_cache
       if FLAGS.quantize_kv_cache is not None
       else FLAGS.quantize_weights
   )
+  config.num_bits_kv = FLAGS.quantize_kv_cache_bits
+  config.kv_scales_path = FLAGS.kv_scales_path
   return config
 
 
@@ -14,17 +14,19 @@
 
 """Implement Jet Engine API."""
 
-from typing import Any, List, Optional, Tuple, Union, Callable
+import dataclasses
+from typing import Any, Iterator, List, Optional, Tuple, Union, Callable
 import threading
 import functools
+import json
 import os
+import time
 
 import glob
 from etils import epath
 from flax import struct
 import jax
 from jax import numpy as jnp
-from safetensors import safe_open
 import torch
 import numpy as np
 
@@ -34,11 +36,15 @@ import torch_xla2
 from torch.utils import _pytree as pytree
 
 from jetstream_pt import cache_manager
+from jetstream_pt import moe
 from jetstream_pt import quantize
+from jetstream_pt import safetensors_loader
+from jetstream_pt import scan_layers
 from jetstream_pt import torchjax
 from jetstream_pt.hf_tokenizer import HFTokenizerAdapter
 from jetstream_pt.environment import JetEngineEnvironment, JetEngineEnvironmentData, QuantizationConfig
 from jetstream_pt.page_attention_manager import PageAttentionManager
+from jetstream_pt.prefix_cache import PrefixCache
 from jetstream_pt.third_party.llama import model_exportable as llama_model, model_args
 from jetstream_pt.third_party.gemma import config as gemma_config, model as gemma_model
 from jetstream_pt.third_party.mixtral import config as mixtral_config, model as mixtral_model
@@ -62,6 +68,30 @@ class Prefix:
   seq_len: int  # true seqlen front pad
 
 
+@dataclasses.dataclass
+class SwappedSlot:
+  """Host copy of a preempted page attention slot."""
+
+  slot: int
+  seq_len: int
+  # [kv_heads, num_pages, page_size, head_dim] per layer, in host memory
+  caches: List[Tuple[np.ndarray, np.ndarray]]
+  # The slot's rows of the decode state: tokens, lens, start, input_pos, mask
+  state: Tuple[np.ndarray, ...]
+  # [kv_heads, num_pages, page_size, 1] per layer, with kv quantization
+  cache_scales: List[Tuple[np.ndarray, np.ndarray]] = dataclasses.field(
+      default_factory=list
+  )
+
+
+@struct.dataclass
+# pylint: disable-next=all
+class PageTable:
+  page_indices: jax.Array  # [batch_size, max_pages_per_sequence]
+  pool: jax.Array  # [pool_size] pages reserved for the device to hand out
+  pool_head: jax.Array  # next unused pool entry
+
+
 @struct.dataclass
 # pylint: disable-next=all
 class DecodeState:
@@ -94,6 +124,30 @@ class PyTorchEngine(engine_api.Engine):
     self.env = env
     self.default_dtype = jnp.bfloat16 if env.bf16_enable else jnp.float32
     self.rng = jax.random.PRNGKey(0)
+    if env.scan_layers:
+      if env.quant_config.enable_kv_quantization or env.page_attention:
+        raise ValueError(
+            "scan_layers doesn't support kv quantization or page attention"
+        )
+      if not env.generate_cache_stacked:
+        # Per layer caches would be stacked and copied every decode step
+        raise ValueError("scan_layers needs generate_cache_stacked")
+      if env.lazy_cache_update and not env.new_cache_stacked:
+        raise ValueError(
+            "scan_layers with generate_cache_stacked needs new_cache_stacked"
+        )
+      if weights is not None:
+        weights = scan_layers.stack_layer_weights(weights, env.num_layers)
+    if env.kv_quantize_int4 and env.page_attention:
+      raise ValueError("int4 kv cache doesn't support page attention")
+    if (
+        env.quant_config.kv_scales_path
+        and env.quant_config.enable_kv_quantization
+    ):
+      if env.quant_config.num_bits_kv != 8 or env.page_attention:
+        raise ValueError(
+            "Static kv scales need an int8 kv cache without page attention"
+        )
     self.weights = weights
 
     self.y_sharding = env.sharding_by_axis(1)
@@ -105,10 +159,20 @@ class PyTorchEngine(engine_api.Engine):
     jax.config.update("jax_enable_x64", False)
 
     self.prefill_cache_sharding = self.env.prefill_cache_sharding
-    self.prefill = jax.jit(
+    self._prefill = jax.jit(
         self.prefill,
         out_shardings=(self.get_prefix_destination_sharding(), None),
     )
+    self.prefill = self._prefill
+    self.prefill_batch = self._jit_prefill_batch(self.prefill_batch)
+    self.prefix_cache = None
+    if self.env.prefix_cache_max_bytes > 0:
+      self.prefix_cache = PrefixCache(
+          block_size=self.env.prefix_cache_block_size,
+          max_bytes=self.env.prefix_cache_max_bytes,
+      )
+      # Prompts go through the prefix cache, the jitted prefill is _prefill
+      self.prefill = self.prefill_with_prefix_cache
     self.insert = jax.jit(
         self.insert,
         donate_argnums=(0, 1),
@@ -119,6 +183,12 @@ class PyTorchEngine(engine_api.Engine):
         donate_argnums=(1,),
         out_shardings=(self.get_decode_state_sharding(), None),
     )
+    self.generate_multi_step = jax.jit(
+        self.generate_multi_step,
+        static_argnums=(2,),
+        donate_argnums=(1,),
+        out_shardings=(self.get_decode_state_sharding(), None),
+    )
 
     if self.env.page_attention:
       max_pages_per_sequence = (
@@ -143,6 +213,28 @@ class PyTorchEngine(engine_api.Engine):
           donate_argnums=(0, 1),
           out_shardings=self.get_decode_state_sharding(),
       )
+      self._copy_pages_jit = jax.jit(
+          self._copy_pages,
+          donate_argnums=(0,),
+          out_shardings=self.get_decode_state_sharding(),
+      )
+      self._fork_slot_jit = jax.jit(
+          self._fork_slot,
+          donate_argnums=(0,),
+          out_shardings=self.get_decode_state_sharding(),
+      )
+      # Slots swapped out to host memory, oldest first
+      self.preempted_slots = []
+      self._pause_slot_jit = jax.jit(
+          self._pause_slot,
+          donate_argnums=(0,),
+          out_shardings=self.get_decode_state_sharding(),
+      )
+      self._restore_slot_jit = jax.jit(
+          self._restore_slot,
+          donate_argnums=(0,),
+          out_shardings=self.get_decode_state_sharding(),
+      )
       self.insert = self.insert_page_attention_with_reservation
       self.generate_jit = jax.jit(
           self.generate_impl,
@@ -151,6 +243,24 @@ class PyTorchEngine(engine_api.Engine):
       )
 
       self.generate = self.generate_page_attention
+      if self.env.paged_attention_device_reservation:
+        if self.env.paged_attention_preemption:
+          raise ValueError(
+              "paged_attention_preemption is not supported with "
+              "paged_attention_device_reservation"
+          )
+        self.page_table = None
+        # Host copy of decode_state.input_pos, to count the pool pages the
+        # device takes without reading them back
+        self._host_input_pos = np.zeros(self.env.batch_size, dtype=np.int32)
+        self._set_page_pool(np.zeros((0,), dtype=np.int32))
+        self._refill_page_pool(0)
+        self._generate_page_attention_on_device_jit = jax.jit(
+            self._generate_page_attention_on_device,
+            donate_argnums=(1, 2),
+            out_shardings=(self.get_decode_state_sharding(), None, None),
+        )
+        self.generate = self.generate_page_attention_on_device
     # self._insert_wrap = jax.jit(self._insert_wrap, donate_argnums=(0, 1),
     #                              out_shardings=self.get_decode_state_sharding())
 
@@ -159,6 +269,10 @@ class PyTorchEngine(engine_api.Engine):
     #      donate_argnums=(0, 1),
     #      out_shardings=self.get_decode_state_sharding())
     self._lock = threading.RLock()
+    self.routing_stats = None
+    self._routing_stats_thread = None
+    if self.env.moe_routing_stats_path:
+      self._init_routing_stats()
 
   def init_decode_state(
       self,
@@ -166,7 +280,10 @@ class PyTorchEngine(engine_api.Engine):
     caches_obj = self.env.make_caches_generate()
     caches = [c.state() for c in caches_obj]
     scalers = []
-    if self.env.quant_config.enable_kv_quantization:
+    if (
+        self.env.quant_config.enable_kv_quantization
+        and not self.env.kv_quantize_static
+    ):
       scalers = [c.scalers() for c in caches_obj]
     return DecodeState(
         jnp.zeros((self.env.batch_size, 1), dtype=jnp.int32),
@@ -197,8 +314,40 @@ class PyTorchEngine(engine_api.Engine):
       ragged_batch_index,
       ragged_block_index,
       page_token_indices,
+      page_indices=None,
+      page_lengths=None,
   ):
-    if self.env.quant_config.enable_kv_quantization:
+    if self.env.quant_config.enable_kv_quantization and self.env.page_attention:
+      caches_obj = [
+          cache_manager.PageInt8KVCacheGenerate(
+              k,
+              v,
+              ks,
+              vs,
+              self.page_attention_manager,
+              page_token_indices,
+              self.cache_sharding,
+              env=self.env,
+              page_indices=page_indices,
+              lengths=page_lengths,
+          )
+          for (k, v), (ks, vs) in torchjax.to_torch(
+              list(zip(caches, cache_scales))
+          )
+      ]
+    elif self.env.kv_quantize_int4:
+      caches_obj = [
+          cache_manager.Int4KVCacheGenerate(
+              k, v, ks, vs, input_indexes, env=self.env
+          )
+          for (k, v), (ks, vs) in torchjax.to_torch(
+              list(zip(caches, cache_scales))
+          )
+      ]
+    elif (
+        self.env.quant_config.enable_kv_quantization
+        and not self.env.kv_quantize_static
+    ):
       caches_obj = [
           cache_manager.Int8KVCacheGenerate(
               k, v, ks, vs, input_indexes, env=self.env
@@ -216,6 +365,8 @@ class PyTorchEngine(engine_api.Engine):
               page_token_indices,
               self.cache_sharding,
               env=self.env,
+              page_indices=page_indices,
+              lengths=page_lengths,
           )
           for k, v in torchjax.to_torch(caches)
       ]
@@ -226,7 +377,8 @@ class PyTorchEngine(engine_api.Engine):
           )
           for k, v in torchjax.to_torch(caches)
       ]
-    mask = jnp.expand_dims(mask, (1, 2))
+    if mask.ndim == 2:
+      mask = jnp.expand_dims(mask, (1, 2))
 
     args = (
         tokens,
@@ -237,18 +389,25 @@ class PyTorchEngine(engine_api.Engine):
         ragged_batch_index,
         ragged_block_index,
     )
-    paramst, argst = torchjax.to_torch((weights, args))
+    weights, layer_weights = scan_layers.split_scanned_weights(weights)
+    kwargs = {}
+    if layer_weights is not None:
+      kwargs["layer_weights"] = layer_weights
+    paramst, argst, kwargst = torchjax.to_torch((weights, args, kwargs))
     with self._lock:
       with torch_xla2.default_env():
         # The mode is needed so that tensors created inside of
         # the model (such as via torch.ones etc) also have the right type
-        res = torch.func.functional_call(self.pt_model, paramst, argst)
+        res = torch.func.functional_call(self.pt_model, paramst, argst, kwargst)
     updated_caches = []
     for c in caches_obj:
       c.finalize()
       updated_caches.append(c.state())
     scales = []
-    if self.env.quant_config.enable_kv_quantization:
+    if (
+        self.env.quant_config.enable_kv_quantization
+        and not self.env.kv_quantize_static
+    ):
       scales = [c.scalers() for c in caches_obj]
     return torchjax.from_torch((res, updated_caches, scales))
 
@@ -256,27 +415,67 @@ class PyTorchEngine(engine_api.Engine):
       jax.jit,
       static_argnums=(0,),
   )
-  def _call_model_prefill(self, weights, tokens, input_indexes):
-    caches = [
-        cache_manager.KVCachePrefill(
-            self.env.quant_config.enable_kv_quantization
-        )
-        for _ in self.pt_model.layers
-    ]
-    mask = jnp.full(
-        (1, self.env.n_reps, tokens.shape[1], tokens.shape[1]),
-        float("-inf"),
-        dtype=self.default_dtype,
+  def _call_model_prefill(
+      self,
+      weights,
+      tokens,
+      input_indexes,
+      existing_caches=None,
+      output_positions=None,
+      cache_start=None,
+  ):
+    # With static scales the prefill kv is quantized on insert
+    kv_quantize = (
+        self.env.quant_config.enable_kv_quantization
+        and not self.env.kv_quantize_static
     )
-    mask = jnp.triu(mask, k=1)
-    mask = mask.reshape(1, 1, -1, tokens.shape[1])
-    start = jnp.zeros((tokens.shape[0],), dtype=jnp.int32)
+    if existing_caches is None:
+      existing_len = 0
+      caches = [
+          cache_manager.KVCachePrefill(kv_quantize)
+          for _ in self.pt_model.layers
+      ]
+    else:
+      # Chunked prefill: attend to the kv of the previous chunks as well
+      existing_len = existing_caches[0][0].shape[-2]
+      caches = [
+          cache_manager.KVCachePrefill(
+              kv_quantize,
+              cache_k=k,
+              cache_v=v,
+              start=cache_start,
+          )
+          for k, v in torchjax.to_torch(existing_caches)
+      ]
+    if cache_start is None:
+      kv_len = existing_len + tokens.shape[1]
+      cache_start = existing_len
+    else:
+      # The new kv is written at cache_start of the preallocated caches
+      kv_len = existing_len
+    # Every token attends to the kv up to its own position
+    rows = jnp.arange(tokens.shape[1])[:, None]
+    cols = jnp.arange(kv_len)[None, :]
+    mask = jnp.where(cols <= rows + cache_start, 0, float("-inf"))
+    mask = jnp.broadcast_to(
+        mask.astype(self.default_dtype),
+        (1, self.env.n_reps, tokens.shape[1], kv_len),
+    )
+    mask = mask.reshape(1, 1, -1, kv_len)
+    start = jnp.zeros((tokens.shape[0], 1), dtype=jnp.int32)
     args = (tokens, input_indexes, caches, mask, start)
-
-    paramst, argst = torchjax.to_torch((weights, args))
+    # [batch, n] positions to compute logits at, instead of the whole prompt
+    kwargs = {}
+    if output_positions is not None:
+      kwargs["output_positions"] = output_positions
+    weights, layer_weights = scan_layers.split_scanned_weights(weights)
+    if layer_weights is not None:
+      kwargs["layer_weights"] = layer_weights
+
+    paramst, argst, kwargst = torchjax.to_torch((weights, args, kwargs))
     with self._lock:
       with torch_xla2.default_env():
-        res = torch.func.functional_call(self.pt_model, paramst, argst)[0]
+        res = torch.func.functional_call(self.pt_model, paramst, argst, kwargst)
     caches_res = [c.state() for c in caches]
     return torchjax.from_torch((res, caches_res))
 
@@ -296,6 +495,18 @@ class PyTorchEngine(engine_api.Engine):
         .astype(jnp.int32)
     )
 
+  def _sample_prefill_logits(self, logits, sampler=None):
+    if sampler:
+      return sampler(logits)
+    return sampling_utils.sampling(
+        logits,
+        self.rng,
+        self.env.sampling_algorithm,
+        self.env.topk,
+        self.env.nucleus_topp,
+        self.env.temperature,
+    )
+
   def prefill(
       self,
       *,
@@ -314,24 +525,247 @@ class PyTorchEngine(engine_api.Engine):
       )
     seq_len = padded_tokens.shape[0]
     input_indexes = jnp.arange(0, seq_len)
+    existing_caches = None
+    if existing_prefix is not None:
+      # The padded tokens are the next chunk of the prompt
+      input_indexes = input_indexes + existing_prefix.seq_len
+      existing_caches = existing_prefix.caches
     logits, updated_caches = self._call_model_prefill(
         params,
         batched_token,
         input_indexes,
+        existing_caches,
+        output_positions=jnp.reshape(true_length - 1, (1, 1)),
     )
-    if len(logits.shape) == 3:  # b, seqlen, num words
-      logits = logits[0]  # seqlen, num words
+    # Only the last true token has logits: 1, 1, num words
+    token = self._sample_prefill_logits(logits.reshape(-1), sampler)
+    result = self._prefill_result_tokens(token)
+    # truncate to true_length didnt work need to be out side of jit
+    # caches = [
+    #   (jax.lax.dynamic_slice_in_dim(
+    #       k, seq_len - true_length, true_length, axis=2),
+    #    jax.lax.dynamic_slice_in_dim(
+    #       v, seq_len - true_length, true_length, axis=2))
+    #   for k, v in updated_caches
+    # ]
+    if existing_prefix is not None:
+      true_length = existing_prefix.seq_len + true_length
+    return Prefix(token, updated_caches, true_length), result
+
+  def prefill_batch(
+      self,
+      *,
+      params: Any,  # Weights
+      padded_tokens: PrefillInputs,  # [num_prompts, seqlen]
+      true_lengths: jax.Array,  # [num_prompts]
+      sampler: Optional[Callable[[Any], Any]] = None,
+  ) -> Tuple[List[Prefix], List[engine_api.ResultTokens]]:
+    """Prefills several prompts of the same padded length in one forward pass.
+
+    All prompts must be padded to the same prefill bucket. Each row gets its
+    own Prefix (with a batch 1 kv cache) and first token, so the results can be
+    inserted into decode slots exactly like the output of `prefill`.
+    """
+    if not isinstance(padded_tokens, jax.Array):
+      raise TypeError(
+          "Input tokens should be of type Jax Array, but receiving:"
+          f" {padded_tokens} of type {type(padded_tokens)}"
+      )
+    if padded_tokens.ndim != 2:
+      raise ValueError(
+          "Batched prefill expects tokens of shape [num_prompts, seqlen], "
+          f"but receiving: {padded_tokens.shape}"
+      )
+    num_prompts, seq_len = padded_tokens.shape
+    true_lengths = jnp.asarray(true_lengths, dtype=jnp.int32)
+    input_indexes = jnp.broadcast_to(
+        jnp.arange(0, seq_len), (num_prompts, seq_len)
+    )
+    logits, updated_caches = self._call_model_prefill(
+        params,
+        padded_tokens,
+        input_indexes,
+        output_positions=(true_lengths - 1)[:, None],
+    )
+    # b, num words
+    last_logits = logits[:, 0]
     if sampler:
-      token = sampler(logits[true_length - 1])
+      tokens = sampler(last_logits)
     else:
-      token = sampling_utils.sampling(
-          logits[true_length - 1],
+      tokens = sampling_utils.sampling(
+          last_logits,
           self.rng,
           self.env.sampling_algorithm,
           self.env.topk,
           self.env.nucleus_topp,
           self.env.temperature,
       )
+
+    prefixes = []
+    results = []
+    for i in range(num_prompts):
+      caches = [
+          (k[i : i + 1], v[i : i + 1])  # Keep the batch dimension of 1
+          for k, v in updated_caches
+      ]
+      prefixes.append(Prefix(tokens[i], caches, true_lengths[i]))
+      results.append(self._prefill_result_tokens(tokens[i]))
+    return prefixes, results
+
+  def _jit_prefill_batch(self, prefill_batch):
+    """Jits prefill_batch with the out_shardings of prefill for every prompt.
+
+    The prefixes are a list with one entry per prompt, so there is one jitted
+    function per number of prompts.
+    """
+    jitted = {}
+
+    def call(*, padded_tokens, **kwargs):
+      num_prompts = (
+          np.shape(padded_tokens)[0] if np.ndim(padded_tokens) == 2 else 0
+      )
+      if num_prompts not in jitted:
+        jitted[num_prompts] = jax.jit(
+            prefill_batch,
+            out_shardings=(
+                [self.get_prefix_destination_sharding()] * num_prompts,
+                None,
+            ),
+        )
+      return jitted[num_prompts](padded_tokens=padded_tokens, **kwargs)
+
+    return call
+
+  def prefill_chunked(
+      self,
+      *,
+      params: Any,  # Weights
+      padded_tokens: PrefillInputs,  # PrefillInputs[jax.Array],
+      true_length: int,
+      chunk_size: Optional[int] = None,
+      sampler: Optional[Callable[[Any], Any]] = None,
+  ) -> Iterator[Tuple[Prefix, engine_api.ResultTokens]]:
+    """Prefills a long prompt chunk by chunk.
+
+    Each chunk of `chunk_size` tokens attends to the kv cache of the previous
+    chunks and writes its own kv to it. The cache is preallocated for the
+    padded prompt after the first chunk, so all the later chunks run the same
+    executable at the same cost. One (prefix, result) pair is yielded
+    per chunk so the caller can run generate steps between chunks and keep the
+    decode latency of the running slots bounded. Only the last yielded pair
+    covers the whole prompt and should be passed to `insert`.
+    """
+    chunk_size = chunk_size or self.env.prefill_chunk_size
+    if chunk_size <= 0:
+      raise ValueError(
+          f"Chunked prefill needs a positive chunk size, got {chunk_size}"
+      )
+    padded_length = padded_tokens.shape[0]
+    # Whole chunks, so no chunk is written past the end of the caches
+    cache_length = -(-padded_length // chunk_size) * chunk_size
+    caches = None
+    for start in range(0, true_length, chunk_size):
+      chunk = padded_tokens[start : start + chunk_size]
+      if chunk.shape[0] < chunk_size:
+        chunk = jnp.pad(chunk, (0, chunk_size - chunk.shape[0]))
+      chunk_length = min(chunk_size, true_length - start)
+      input_indexes = jnp.arange(start, start + chunk_size)
+      output_positions = jnp.reshape(chunk_length - 1, (1, 1))
+      if caches is None:
+        logits, caches = self._call_model_prefill(
+            params,
+            chunk.reshape(1, -1),
+            input_indexes,
+            output_positions=output_positions,
+        )
+        # Preallocated once, the later chunks share one executable
+        caches = [
+            tuple(
+                jnp.pad(
+                    x, ((0, 0), (0, 0), (0, cache_length - chunk_size), (0, 0))
+                )
+                for x in cache
+            )
+            for cache in caches
+        ]
+      else:
+        logits, caches = self._call_model_prefill(
+            params,
+            chunk.reshape(1, -1),
+            input_indexes,
+            caches,
+            output_positions=output_positions,
+            cache_start=jnp.int32(start),
+        )
+      token = self._sample_prefill_logits(logits.reshape(-1), sampler)
+      prefix_caches = caches
+      if start + chunk_size >= true_length:
+        # The caches of the last chunk have the padded length, as in prefill
+        prefix_caches = [
+            tuple(x[:, :, :padded_length] for x in cache) for cache in caches
+        ]
+      yield (
+          Prefix(token, prefix_caches, start + chunk_length),
+          self._prefill_result_tokens(token),
+      )
+
+  def prefill_with_prefix_cache(
+      self,
+      *,
+      params: Any,  # Weights
+      existing_prefix: Optional[Prefix] = None,
+      padded_tokens: PrefillInputs,  # PrefillInputs[jax.Array],
+      true_length: int,
+      sampler: Optional[Callable[[Any], Any]] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Prefill that reuses the kv of a previously seen prompt prefix.
+
+    The longest cached prefix of the prompt is passed to `prefill` as
+    existing_prefix so only the remaining tokens are computed. The full blocks
+    of the prompt are then added to the prefix cache. This is `prefill` when
+    the prefix cache is enabled. Falls back to a regular prefill if the prefix
+    cache is disabled or an existing_prefix is given.
+    """
+    if self.prefix_cache is None or existing_prefix is not None:
+      return self._prefill(
+          params=params,
+          existing_prefix=existing_prefix,
+          padded_tokens=padded_tokens,
+          true_length=true_length,
+          sampler=sampler,
+      )
+    tokens = np.asarray(padded_tokens[:true_length])
+    # Keep at least one token to compute, to get the logits of the prompt
+    cached_length, cached_caches = self.prefix_cache.lookup(tokens[:-1])
+    if cached_length == 0:
+      prefix, result = self._prefill(
+          params=params,
+          padded_tokens=padded_tokens,
+          true_length=true_length,
+          sampler=sampler,
+      )
+    else:
+      existing_prefix = Prefix(
+          jnp.zeros((), dtype=jnp.int32), cached_caches, cached_length
+      )
+      suffix = tokens[cached_length:]
+      # Pad the suffix to full blocks to bound the number of compiled shapes
+      block_size = self.prefix_cache.block_size
+      padded_length = -(-len(suffix) // block_size) * block_size
+      prefix, result = self._prefill(
+          params=params,
+          existing_prefix=existing_prefix,
+          padded_tokens=jnp.asarray(
+              np.pad(suffix, (0, padded_length - len(suffix)))
+          ),
+          true_length=len(suffix),
+          sampler=sampler,
+      )
+    self.prefix_cache.insert(tokens, prefix.caches)
+    return prefix, result
+
+  def _prefill_result_tokens(self, token) -> engine_api.ResultTokens:
+    """Wraps the first generated token into ResultTokens."""
     token_out = jnp.reshape(token, (1, 1))
     data = jnp.concatenate(
         [
@@ -342,22 +776,13 @@ class PyTorchEngine(engine_api.Engine):
         axis=-1,
     )
     length = token_out.shape[1]
-    result = engine_api.ResultTokens(
+    return engine_api.ResultTokens(
         data=data,
         tokens_idx=(0, length),
         valid_idx=(length, 2 * length),
         length_idx=(2 * length, 2 * length + 1),
         samples_per_slot=1,
     )
-    # truncate to true_length didnt work need to be out side of jit
-    # caches = [
-    #   (jax.lax.dynamic_slice_in_dim(
-    #       k, seq_len - true_length, true_length, axis=2),
-    #    jax.lax.dynamic_slice_in_dim(
-    #       v, seq_len - true_length, true_length, axis=2))
-    #   for k, v in updated_caches
-    # ]
-    return Prefix(token, updated_caches, true_length), result
 
   def shrink_prefix(
       self,
@@ -392,7 +817,10 @@ class PyTorchEngine(engine_api.Engine):
         pos % self.env.cache_sequence_length
     )
     input_pos = decode_state.input_pos.at[slot].set(prefix.seq_len)
-    if not self.env.quant_config.enable_kv_quantization:
+    if (
+        not self.env.quant_config.enable_kv_quantization
+        or self.env.kv_quantize_static
+    ):
 
       @functools.partial(jax.jit, donate_argnums=(0, 1), inline=True)
       def insert(cache, new_entry, update_index):
@@ -422,6 +850,29 @@ class PyTorchEngine(engine_api.Engine):
             (insert(k, newk, update_index), insert(v, newv, update_index))
             for (k, v), (newk, newv) in zip(decode_state.caches, prefix.caches)
         ]
+    elif self.env.kv_quantize_int4:
+
+      @functools.partial(jax.jit, donate_argnums=(0, 1, 2, 3), inline=True)
+      def insert(k, v, kscaler, vscaler, newk, newv):
+        update_index = [slot, 0, pos, 0]
+        newk, newks = cache_manager.quantize_keys_int4(
+            newk, length=prefix.seq_len
+        )
+        newv, newvs = cache_manager.quantize_values_int4(newv)
+        k = jax.lax.dynamic_update_slice(k, newk, update_index)
+        v = jax.lax.dynamic_update_slice(v, newv, update_index)
+        kscaler = jax.lax.dynamic_update_slice(kscaler, newks, [slot, 0, 0, 0])
+        vscaler = jax.lax.dynamic_update_slice(vscaler, newvs, update_index)
+        return jax.lax.with_sharding_constraint(
+            ((k, v), (kscaler, vscaler)), self.cache_sharding
+        )
+
+      for (k, v), (kscaler, vscaler), (newk, newv) in zip(
+          decode_state.caches, decode_state.cache_scales, prefix.caches
+      ):
+        cache, scale = insert(k, v, kscaler, vscaler, newk, newv)
+        caches.append(cache)
+        scales.append(scale)
     else:
 
       @functools.partial(jax.jit, donate_argnums=(0, 1), inline=True)
@@ -529,7 +980,10 @@ class PyTorchEngine(engine_api.Engine):
 
     scales = []
     caches = []
-    if not self.env.quant_config.enable_kv_quantization:
+    if (
+        not self.env.quant_config.enable_kv_quantization
+        or self.env.kv_quantize_static
+    ):
 
       @functools.partial(jax.jit, donate_argnums=(0, 1), inline=True)
       def insert(cache, new_entry):
@@ -542,6 +996,33 @@ class PyTorchEngine(engine_api.Engine):
           (insert(k, newk), insert(v, newv))
           for (k, v), (newk, newv) in zip(old_caches, cache_inserts)
       ]
+    elif self.env.kv_quantize_int4:
+
+      @functools.partial(jax.jit, donate_argnums=(0, 1, 2, 3), inline=True)
+      def insert(k, v, kscaler, vscaler, newk, newv):
+        newk, newks = cache_manager.quantize_keys_int4(
+            newk, length=prefix.seq_len
+        )
+        newv, newvs = cache_manager.quantize_values_int4(newv)
+
+        def set_tokens(cache, new_entry):
+          new_entry = jnp.transpose(new_entry.squeeze(0), (1, 0, 2))
+          return cache.at[slot, :, update_indexes, :].set(new_entry)
+
+        k = set_tokens(k, newk)
+        v = set_tokens(v, newv)
+        kscaler = kscaler.at[slot].set(newks.squeeze(0))
+        vscaler = set_tokens(vscaler, newvs)
+        return jax.lax.with_sharding_constraint(
+            ((k, v), (kscaler, vscaler)), self.cache_sharding
+        )
+
+      for (k, v), (kscaler, vscaler), (newk, newv) in zip(
+          old_caches, old_scales, cache_inserts
+      ):
+        cache, scale = insert(k, v, kscaler, vscaler, newk, newv)
+        caches.append(cache)
+        scales.append(scale)
     else:
 
       @functools.partial(jax.jit, donate_argnums=(0, 1), inline=True)
@@ -589,13 +1070,26 @@ class PyTorchEngine(engine_api.Engine):
       update_indexes: jax.Array,
       tep_kv: jax.Array,
   ):
-    caches = self.page_attention_manager.insert_prefill_cache(
-        prefill_caches=prefix.caches,
-        decode_caches=decode_state.caches,
-        update_indexes=update_indexes,
-        tep_kv=tep_kv,
-        sharding=self.cache_sharding,
-    )
+    if self.env.quant_config.enable_kv_quantization:
+      caches, scales = (
+          self.page_attention_manager.insert_prefill_cache_quantized(
+              prefill_caches=prefix.caches,
+              decode_caches=decode_state.caches,
+              decode_scales=decode_state.cache_scales,
+              update_indexes=update_indexes,
+              tep_kv=tep_kv,
+              sharding=self.cache_sharding,
+          )
+      )
+    else:
+      caches = self.page_attention_manager.insert_prefill_cache(
+          prefill_caches=prefix.caches,
+          decode_caches=decode_state.caches,
+          update_indexes=update_indexes,
+          tep_kv=tep_kv,
+          sharding=self.cache_sharding,
+      )
+      scales = []
 
     current_pos = prefix.seq_len
 
@@ -611,7 +1105,6 @@ class PyTorchEngine(engine_api.Engine):
     )
 
     input_pos = decode_state.input_pos.at[slot].set(prefix.seq_len)
-    scales = None
     lens = decode_state.lens.at[slot].set(1)
     return DecodeState(
         tokens,
@@ -624,12 +1117,27 @@ class PyTorchEngine(engine_api.Engine):
         mask,
     )
 
+  def _quantize_prefix_static(self, prefix: Prefix) -> Prefix:
+    """Quantizes the prefill kv to int8 with the static kv scales."""
+    k_scales, v_scales = self.env.static_kv_scales
+    return prefix.replace(
+        caches=[
+            (
+                cache_manager.quantize_kv_static(k, k_scales[layer]),
+                cache_manager.quantize_kv_static(v, v_scales[layer]),
+            )
+            for layer, (k, v) in enumerate(prefix.caches)
+        ]
+    )
+
   def insert(
       self,
       prefix: Prefix,
       decode_state: DecodeState,
       slot: int,
   ) -> DecodeState:
+    if self.env.kv_quantize_static:
+      prefix = self._quantize_prefix_static(prefix)
     if self.env.ring_buffer:
       start_insert = decode_state.current_position - prefix.seq_len
       end_insert = start_insert + prefix.caches[0][0].shape[2]  # padded seclen
@@ -652,10 +1160,64 @@ class PyTorchEngine(engine_api.Engine):
       prefix: Prefix,
       decode_state: DecodeState,
       slot: int,
+      shared_slot: Optional[int] = None,
+      shared_len: int = 0,
   ) -> DecodeState:
+    """Inserts the prefix into slot.
+
+    If the first shared_len tokens of the prefix are the same as the ones of
+    shared_slot, e.g. a common system prompt, their full pages are shared with
+    shared_slot instead of being copied.
+    """
+    page_size = self.page_attention_manager.paged_attention_page_size
+    if self.page_attention_manager.num_slot_pages[slot] > 0:
+      # Release the pages of the previous request of the slot
+      self.free_page_attention_slot(slot)
+    num_shared_pages = 0
+    if shared_slot is not None:
+      num_shared_pages = min(shared_len, int(prefix.seq_len)) // page_size
+    num_new_pages = -(-int(prefix.seq_len) // page_size) - num_shared_pages
+    if (
+        self.env.paged_attention_device_reservation
+        and num_new_pages > self.page_attention_manager.num_free_pages
+    ):
+      # The pages parked in the device pool go to the insert first
+      self._release_page_pool()
+    if self.env.paged_attention_preemption:
+      self._discard_preempted_slot(slot)
+      decode_state = self._preempt_for_pages(
+          decode_state,
+          num_new_pages,
+          exclude=(slot,) if shared_slot is None else (slot, shared_slot),
+      )
     num_pages, np_update_indexes = (
-        self.page_attention_manager.reserve_pages_insert(slot, prefix.seq_len)
+        self.page_attention_manager.reserve_pages_insert(
+            slot, prefix.seq_len, shared_slot, shared_len
+        )
     )
+    num_shared_tokens = 0
+    if shared_slot is not None:
+      num_shared_tokens = (
+          min(shared_len, int(prefix.seq_len)) // page_size * page_size
+      )
+    if num_shared_tokens > 0:
+      # Only the tokens after the shared pages are inserted
+      prefix = prefix.replace(
+          caches=[
+              (
+                  k[:, :, num_shared_tokens:],
+                  v[:, :, num_shared_tokens:],
+              )
+              for k, v in prefix.caches
+          ]
+      )
+    if self.env.paged_attention_device_reservation:
+      self.page_table = self.page_table.replace(
+          page_indices=self.page_table.page_indices.at[slot].set(
+              jnp.asarray(self.page_attention_manager.page_indices[slot])
+          )
+      )
+      self._host_input_pos[slot] = int(prefix.seq_len)
     update_indexes = jnp.array(np_update_indexes)
     _, kv_heads, _, dim = prefix.caches[0][0].shape
     tep_kv = jnp.zeros(
@@ -671,6 +1233,175 @@ class PyTorchEngine(engine_api.Engine):
         prefix, decode_state, slot, num_pages, update_indexes, tep_kv
     )
 
+  def _preempt_for_pages(
+      self, decode_state: DecodeState, num_pages: int, exclude=()
+  ) -> DecodeState:
+    """Swaps slots out to host memory until num_pages pages are free."""
+    manager = self.page_attention_manager
+    while num_pages > manager.num_free_pages:
+      victim = manager.select_preemption_victim(exclude)
+      if victim is None:
+        raise RuntimeError(
+            f"Out of pages: {num_pages} needed, {manager.num_free_pages} free "
+            "and no slot left to preempt"
+        )
+      decode_state = self.preempt_slot(decode_state, victim)
+    return decode_state
+
+  def preempt_slot(self, decode_state: DecodeState, slot: int) -> DecodeState:
+    """Swaps the kv pages of slot out to host memory and frees them.
+
+    The slot is paused, i.e. it generates no valid token, until it's swapped
+    back in by resume_preempted_slots. The caller skips the results of the
+    slots in preempted_slots: the JetStream orchestrator would end the request
+    on its first invalid token, so the cli rejects paged_attention_preemption.
+    """
+    manager = self.page_attention_manager
+    pages = manager.page_indices[slot, : manager.num_slot_pages[slot]].copy()
+    caches, cache_scales = jax.device_get(
+        [
+            [(k[:, pages], v[:, pages]) for k, v in layer_caches]
+            for layer_caches in (decode_state.caches, decode_state.cache_scales)
+        ]
+    )
+    state = jax.device_get(
+        (
+            decode_state.tokens[slot],
+            decode_state.lens[slot],
+            decode_state.start[slot],
+            decode_state.input_pos[slot],
+            decode_state.mask[slot],
+        )
+    )
+    self.preempted_slots.append(
+        SwappedSlot(slot, int(state[3]), caches, state, cache_scales)
+    )
+    manager.free_pages_resource(slot)
+    return self._pause_slot_jit(decode_state, slot)
+
+  def _pause_slot(self, decode_state: DecodeState, slot: int) -> DecodeState:
+    # input_pos 0 marks the slot as empty for page attention
+    return decode_state.replace(
+        lens=decode_state.lens.at[slot].set(0),
+        input_pos=decode_state.input_pos.at[slot].set(0),
+        mask=decode_state.mask.at[slot].set(float("-inf")),
+    )
+
+  def _restore_slot(
+      self,
+      decode_state: DecodeState,
+      slot: int,
+      pages: jax.Array,
+      caches: List[Tuple[jax.Array, jax.Array]],
+      state: Tuple[jax.Array, ...],
+      cache_scales: List[Tuple[jax.Array, jax.Array]],
+  ) -> DecodeState:
+    def restore(layer_caches, saved):
+      return [
+          (k.at[:, pages].set(saved_k), v.at[:, pages].set(saved_v))
+          for (k, v), (saved_k, saved_v) in zip(layer_caches, saved)
+      ]
+
+    tokens, lens, start, input_pos, mask = state
+    return decode_state.replace(
+        caches=restore(decode_state.caches, caches),
+        cache_scales=restore(decode_state.cache_scales, cache_scales),
+        tokens=decode_state.tokens.at[slot].set(tokens),
+        lens=decode_state.lens.at[slot].set(lens),
+        start=decode_state.start.at[slot].set(start),
+        input_pos=decode_state.input_pos.at[slot].set(input_pos),
+        mask=decode_state.mask.at[slot].set(mask),
+    )
+
+  def _discard_preempted_slot(self, slot: int):
+    """Drops the swapped copy of slot, a new request now owns the slot."""
+    self.preempted_slots = [
+        swapped for swapped in self.preempted_slots if swapped.slot != slot
+    ]
+
+  def resume_preempted_slots(self, decode_state: DecodeState) -> DecodeState:
+    """Swaps preempted slots back in, oldest first, while pages allow.
+
+    A slot is only resumed if a page stays free for every running slot, so it
+    isn't preempted again on the next step. Slots which hold pages again
+    belong to another request and their swapped copy is dropped.
+    """
+    manager = self.page_attention_manager
+    while self.preempted_slots:
+      swapped = self.preempted_slots[0]
+      if manager.num_slot_pages[swapped.slot] > 0:
+        self.preempted_slots.pop(0)
+        continue
+      num_pages = swapped.caches[0][0].shape[1]
+      num_running = np.count_nonzero(manager.num_slot_pages)
+      if num_pages + num_running > manager.num_free_pages:
+        break
+      self.preempted_slots.pop(0)
+      manager.reserve_pages_insert(swapped.slot, swapped.seq_len)
+      pages = manager.page_indices[swapped.slot, :num_pages]
+      decode_state = self._restore_slot_jit(
+          decode_state,
+          swapped.slot,
+          jnp.asarray(pages),
+          jax.device_put(swapped.caches),
+          jax.device_put(swapped.state),
+          jax.device_put(swapped.cache_scales),
+      )
+    return decode_state
+
+  def _copy_pages(
+      self,
+      decode_state: DecodeState,
+      src_pages: jax.Array,
+      dst_pages: jax.Array,
+  ) -> DecodeState:
+    caches = self.page_attention_manager.copy_pages(
+        decode_state.caches, src_pages, dst_pages
+    )
+    cache_scales = self.page_attention_manager.copy_pages(
+        decode_state.cache_scales, src_pages, dst_pages
+    )
+    return decode_state.replace(caches=caches, cache_scales=cache_scales)
+
+  def _fork_slot(
+      self,
+      decode_state: DecodeState,
+      src_slot: int,
+      dst_slot: int,
+  ) -> DecodeState:
+    def fork(x):
+      return x.at[dst_slot].set(x[src_slot])
+
+    return decode_state.replace(
+        tokens=fork(decode_state.tokens),
+        lens=fork(decode_state.lens),
+        start=fork(decode_state.start),
+        input_pos=fork(decode_state.input_pos),
+        mask=fork(decode_state.mask),
+    )
+
+  def fork_slot(
+      self,
+      decode_state: DecodeState,
+      src_slot: int,
+      dst_slot: int,
+  ) -> DecodeState:
+    """Starts dst_slot as a copy of src_slot sharing all its kv pages.
+
+    Used for parallel sampling: the pages are copied on write once the two
+    slots diverge. Only supported with page attention.
+    """
+    if not self.env.page_attention:
+      raise NotImplementedError("fork_slot needs page attention enabled.")
+    if self.env.paged_attention_device_reservation:
+      raise NotImplementedError(
+          "fork_slot is not supported with on device page reservation."
+      )
+    if self.env.paged_attention_preemption:
+      self._discard_preempted_slot(dst_slot)
+    self.page_attention_manager.fork_pages(src_slot, dst_slot)
+    return self._fork_slot_jit(decode_state, src_slot, dst_slot)
+
   def precompute_ragged_block_indices(self, decode_state: DecodeState):
     """Precompute the ragged attention block indices. Ragged attention iterates the grid
     and relies on the computed grid index to skip the unnecessary blocks. The basic idea
@@ -736,28 +1467,300 @@ class PyTorchEngine(engine_api.Engine):
   def generate_page_attention(
       self, params: Any, decode_state: DecodeState
   ) -> tuple[DecodeState, engine_api.ResultTokens]:
+    if self.env.paged_attention_preemption:
+      decode_state = self.resume_preempted_slots(decode_state)
     np_pos = np.asarray(decode_state.input_pos.block_until_ready())
+    if self.env.paged_attention_preemption:
+      num_pages = self.page_attention_manager.num_pages_needed_decode(np_pos)
+      if num_pages > self.page_attention_manager.num_free_pages:
+        decode_state = self._preempt_for_pages(decode_state, num_pages)
+        np_pos = np.asarray(decode_state.input_pos)
     self.page_attention_manager.fill_new_pages(np_pos)
+    src_pages, dst_pages = self.page_attention_manager.pop_page_copies()
+    if src_pages.size > 0:
+      # Copy on write the shared pages the slots are about to append to
+      decode_state = self._copy_pages_jit(
+          decode_state, jnp.asarray(src_pages), jnp.asarray(dst_pages)
+      )
     np_page_token_indices = self.page_attention_manager.get_page_token_indices(
         np_pos
     )
     page_token_indices = jnp.asarray(np_page_token_indices)
     new_decode_state, result_tokens = self.generate_jit(
-        params, decode_state, page_token_indices=page_token_indices
+        params,
+        decode_state,
+        page_token_indices=page_token_indices,
+        page_indices=jnp.asarray(self.page_attention_manager.page_indices),
+        page_lengths=jnp.asarray(self.page_attention_manager.lengths),
     )
     # new_decode_state, result_tokens = self.generate_impl(params, decode_state, page_token_indices)
     return new_decode_state, result_tokens
 
+  def _reserve_pages_on_device(
+      self, page_table: PageTable, input_pos: jax.Array
+  ) -> Tuple[PageTable, jax.Array, jax.Array]:
+    """Device version of fill_new_pages and get_page_token_indices.
+
+    Slots reaching a page boundary take the next pages of the pool. All the
+    slots get a page token index, the inactive ones write to the padding page.
+    Slots finding the pool empty get the padding page instead of a page in
+    use, _unused_pool_pages raises when it sees it.
+    """
+    manager = self.page_attention_manager
+    page_size = manager.paged_attention_page_size
+    pool_size = page_table.pool.shape[0]
+    batch = jnp.arange(self.env.batch_size)
+    lens = input_pos.reshape(-1)
+    page_col = lens // page_size
+    new_page = jnp.logical_and(lens > 0, lens % page_size == 0)
+    pool_pos = page_table.pool_head + jnp.cumsum(new_page) - 1
+    pool_pages = jnp.where(
+        pool_pos < pool_size,
+        page_table.pool[jnp.minimum(pool_pos, pool_size - 1)],
+        manager.padding_page,
+    )
+    current = page_table.page_indices[batch, page_col]
+    pages = jnp.where(new_page, pool_pages, current)
+    page_table = page_table.replace(
+        page_indices=page_table.page_indices.at[batch, page_col].set(pages),
+        pool_head=page_table.pool_head + jnp.sum(new_page, dtype=jnp.int32),
+    )
+    page_token_indices = jnp.stack(
+        (pages, batch * page_size + lens % page_size, batch)
+    ).astype(jnp.int32)
+    lengths = jnp.where(lens == 0, 0, lens + 1)
+    return page_table, page_token_indices, lengths
+
+  def _generate_page_attention_on_device(
+      self, params: Any, decode_state: DecodeState, page_table: PageTable
+  ) -> tuple[DecodeState, PageTable, engine_api.ResultTokens]:
+    page_table, page_token_indices, lengths = self._reserve_pages_on_device(
+        page_table, decode_state.input_pos
+    )
+    new_decode_state, result_tokens = self.generate_impl(
+        params,
+        decode_state,
+        page_token_indices=page_token_indices,
+        page_indices=page_table.page_indices,
+        page_lengths=lengths,
+    )
+    return new_decode_state, page_table, result_tokens
+
+  def _unused_pool_pages(self) -> np.ndarray:
+    """The pool pages the device didn't take yet, a host sync."""
+    pool = np.asarray(self.page_table.pool)
+    pool_head = int(self.page_table.pool_head)
+    if pool_head > self._page_pool_size:
+      raise RuntimeError(
+          f"The device page pool ran out: {pool_head} pages taken from a "
+          f"pool of {self._page_pool_size}"
+      )
+    return pool[pool_head : self._page_pool_size]
+
+  def _set_page_pool(self, pages: np.ndarray):
+    """Hands pages to the device, the pool is padded with the padding page
+    to a fixed size so generate doesn't compile again."""
+    manager = self.page_attention_manager
+    pool = np.full((2 * self.env.batch_size,), manager.padding_page, np.int32)
+    pool[: len(pages)] = pages
+    page_indices = (
+        jnp.asarray(manager.page_indices)
+        if self.page_table is None
+        else self.page_table.page_indices
+    )
+    self.page_table = PageTable(
+        page_indices, jnp.asarray(pool, dtype=jnp.int32), jnp.int32(0)
+    )
+    self._page_pool_size = len(pages)
+    # Pages left in the pool, as the host counts them
+    self._page_pool_left = len(pages)
+
+  def _refill_page_pool(self, num_pages: int):
+    """Tops up the device page pool with the free pages, this is the only
+    host sync. Raises if the pool can't get the num_pages pages the next
+    step takes."""
+    manager = self.page_attention_manager
+    unused = self._unused_pool_pages()
+    num_extra = min(
+        2 * self.env.batch_size - len(unused), manager.num_free_pages
+    )
+    if len(unused) + num_extra < num_pages:
+      raise RuntimeError(
+          f"Out of pages: {num_pages} needed, {len(unused)} in the device "
+          f"pool and {manager.num_free_pages} free"
+      )
+    self._set_page_pool(
+        np.concatenate([unused, manager.reserve_page_pool(num_extra)])
+    )
+
+  def _release_page_pool(self):
+    """Gives the pages the device didn't take back to the free pages."""
+    self.page_attention_manager.release_page_pool(self._unused_pool_pages())
+    self._set_page_pool(np.zeros((0,), dtype=np.int32))
+
+  def _routing_modules(self):
+    return [
+        mod
+        for mod in self.pt_model.modules()
+        if hasattr(mod, "routing_observer")
+    ]
+
+  def _init_routing_stats(self):
+    """Records the routing stats of the mixture of experts layers in every
+    generate step and exports them every moe_routing_stats_interval."""
+    modules = self._routing_modules()
+    if not modules:
+      raise ValueError("Routing stats need a mixture of experts model")
+    if self.env.scan_layers or self.env.paged_attention_device_reservation:
+      raise ValueError(
+          "Routing stats don't support scan_layers or"
+          " paged_attention_device_reservation"
+      )
+    self._routing_stats_lock = threading.Lock()
+    self.routing_stats = moe.init_routing_stats(
+        len(modules), modules[0].num_experts
+    )
+    self._generate_with_routing_stats_jit = jax.jit(
+        self._generate_with_routing_stats,
+        donate_argnums=(1,),
+        out_shardings=(self.get_decode_state_sharding(), None, None),
+    )
+    if self.env.page_attention:
+      self.generate_jit = self.generate_with_routing_stats
+    else:
+      self.generate = self.generate_with_routing_stats
+    self._routing_stats_stop = threading.Event()
+    self._routing_stats_thread = threading.Thread(
+        target=self._export_routing_stats, daemon=True
+    )
+    self._routing_stats_thread.start()
+
+  def _generate_with_routing_stats(
+      self, params, decode_state, routing_stats, **kwargs
+  ):
+    """generate_impl that also adds the routing stats of the step."""
+    layer_stats = []
+
+    def observe(num_experts, probs, expert_indices):
+      probs, expert_indices = torchjax.from_torch((probs, expert_indices))
+      layer_stats.append(moe.routing_stats(probs, expert_indices, num_experts))
+
+    modules = self._routing_modules()
+    for mod in modules:
+      mod.routing_observer = functools.partial(observe, mod.num_experts)
+    try:
+      new_decode_state, result_tokens = self.generate_impl(
+          params, decode_state, **kwargs
+      )
+    finally:
+      for mod in modules:
+        mod.routing_observer = None
+    routing_stats = moe.add_routing_stats(routing_stats, layer_stats)
+    return new_decode_state, result_tokens, routing_stats
+
+  def generate_with_routing_stats(
+      self, params: Any, decode_state: DecodeState, **kwargs
+  ) -> tuple[DecodeState, engine_api.ResultTokens]:
+    """generate that accumulates the routing stats on device, every decode
+    slot counts, the idle ones too."""
+    with self._routing_stats_lock:
+      decode_state, result_tokens, self.routing_stats = (
+          self._generate_with_routing_stats_jit(
+              params, decode_state, self.routing_stats, **kwargs
+          )
+      )
+    return decode_state, result_tokens
+
+  def routing_metrics(self, reset: bool = True) -> dict[str, Any]:
+    """Returns the moe.routing_metrics of the generate steps since the last
+    reset. This is the only host sync of the routing stats."""
+    with self._routing_stats_lock:
+      stats = self.routing_stats
+      if reset:
+        self.routing_stats = jax.tree.map(jnp.zeros_like, stats)
+    return moe.routing_metrics(stats)
+
+  def _export_routing_stats(self):
+    """Appends the routing metrics to moe_routing_stats_path as json lines
+    until close, which exports the last ones."""
+    with open(self.env.moe_routing_stats_path, "a", encoding="utf-8") as f:
+      while True:
+        stopped = self._routing_stats_stop.wait(
+            self.env.moe_routing_stats_interval
+        )
+        metrics = {"time": time.time(), **self.routing_metrics()}
+        f.write(json.dumps(metrics) + "\n")
+        f.flush()
+        if stopped:
+          return
+
+  def close(self):
+    """Stops the routing stats export after it wrote the stats since the
+    last export. Does nothing without routing stats."""
+    if self._routing_stats_thread is None:
+      return
+    self._routing_stats_stop.set()
+    self._routing_stats_thread.join()
+    self._routing_stats_thread = None
+
+  def generate_page_attention_on_device(
+      self, params: Any, decode_state: DecodeState
+  ) -> tuple[DecodeState, engine_api.ResultTokens]:
+    """Page attention generate without a host sync per step.
+
+    The page table lives on device and new pages come from a pool reserved
+    ahead of time. The host follows the decode positions of the slots, so it
+    knows how many pool pages every step takes and refills the pool, the only
+    host sync, before a step would find it empty.
+    """
+    page_size = self.page_attention_manager.paged_attention_page_size
+    lens = self._host_input_pos
+    num_new_pages = np.count_nonzero((lens > 0) & (lens % page_size == 0))
+    if num_new_pages > self._page_pool_left:
+      self._refill_page_pool(num_new_pages)
+    decode_state, self.page_table, result_tokens = (
+        self._generate_page_attention_on_device_jit(
+            params, decode_state, self.page_table
+        )
+    )
+    self._page_pool_left -= num_new_pages
+    # Same update as generate_impl
+    if self.env.ring_buffer:
+      self._host_input_pos = lens + 1
+    else:
+      self._host_input_pos = np.where(lens == 0, 0, lens + 1)
+    return decode_state, result_tokens
+
+  def free_page_attention_slot(self, slot: int):
+    """Releases the pages of a finished slot."""
+    manager = self.page_attention_manager
+    if self.env.paged_attention_device_reservation:
+      # Pages may have been added on device since the insert
+      manager.set_slot_pages(
+          slot, np.asarray(self.page_table.page_indices[slot])
+      )
+    manager.free_pages_resource(slot)
+    if self.env.paged_attention_device_reservation:
+      self.page_table = self.page_table.replace(
+          page_indices=self.page_table.page_indices.at[slot].set(
+              manager.padding_page
+          )
+      )
+
   def generate_impl(
       self,
       params: Any,
       decode_state: DecodeState,
       sampler=None,
       page_token_indices=None,
+      page_indices=None,
+      page_lengths=None,
   ) -> tuple[DecodeState, engine_api.ResultTokens]:
     # seq_len = padded_tokens.shape[0]
     if self.env.page_attention:
-      page_token_indices = torchjax.to_torch(page_token_indices)
+      page_token_indices, page_indices, page_lengths = torchjax.to_torch(
+          (page_token_indices, page_indices, page_lengths)
+      )
     pos = decode_state.current_position
     if self.env.ring_buffer:
       input_indexes = jnp.full((1,), pos)
@@ -793,6 +1796,8 @@ class PyTorchEngine(engine_api.Engine):
         ragged_batch_index,
         ragged_block_index,
         page_token_indices,
+        page_indices,
+        page_lengths,
     )
 
     if self.env.lazy_cache_update:
@@ -816,10 +1821,15 @@ class PyTorchEngine(engine_api.Engine):
           decode_state.lens == 0, 0, decode_state.lens + 1 % self.env.cache_len
       )
 
+    valid = jnp.ones_like(next_token)
+    if self.env.page_attention and self.env.paged_attention_preemption:
+      # Preempted slots are paused, their tokens are not valid
+      valid = (decode_state.input_pos > 0).reshape(valid.shape)
+      valid = valid.astype(next_token.dtype)
     data = jnp.concatenate(
         [
             decode_state.tokens,
-            jnp.ones_like(next_token),
+            valid,
             lens,
         ],
         axis=-1,
@@ -847,6 +1857,101 @@ class PyTorchEngine(engine_api.Engine):
     )
     return new_decode_state, result_tokens
 
+  def generate_multi_step(
+      self,
+      params: Any,
+      decode_state: DecodeState,
+      num_steps: int,
+  ) -> tuple[DecodeState, engine_api.ResultTokens]:
+    """Runs num_steps generate steps in one call.
+
+    The steps run in a lax.scan over generate_impl, so the host only
+    dispatches once for num_steps tokens per slot. The returned ResultTokens
+    hold the tokens of all the steps in order, [batch_size, num_steps], and the
+    lengths after the last step.
+    """
+    if self.env.page_attention:
+      raise NotImplementedError(
+          "generate_multi_step doesn't support page attention, the pages are"
+          " reserved on the host between steps"
+      )
+
+    def step(state, _):
+      state, result_tokens = self.generate_impl(params, state)
+      return state, result_tokens.data
+
+    decode_state, data = jax.lax.scan(
+        step, decode_state, None, length=num_steps
+    )
+    # [num_steps, batch_size, 3] -> tokens, valid [batch_size, num_steps]
+    tokens = data[:, :, 0].T
+    valid = data[:, :, 1].T
+    lens = data[-1, :, 2:3]
+    result_tokens = engine_api.ResultTokens(
+        data=jnp.concatenate([tokens, valid, lens], axis=-1),
+        tokens_idx=(0, num_steps),
+        valid_idx=(num_steps, 2 * num_steps),
+        length_idx=(2 * num_steps, 2 * num_steps + 1),
+        samples_per_slot=1,
+    )
+    return decode_state, result_tokens
+
+  def verify_impl(
+      self,
+      params: Any,
+      decode_state: DecodeState,
+      tokens: jax.Array,
+  ) -> Tuple[jax.Array, List[Tuple[jax.Array, jax.Array]]]:
+    """Runs the model over several tokens per slot in one forward.
+
+    tokens is [batch_size, num_tokens], written to the cache columns following
+    decode_state.current_position; every token attends to the slot's existing
+    kv and to the tokens before it. Returns the logits of all the tokens,
+    [batch_size, num_tokens, vocab], and the updated caches. The decode state
+    positions are not advanced, the caller decides how many of the tokens to
+    keep. Used by speculative decoding to verify draft tokens, only supports
+    the ring buffer cache.
+    """
+    num_tokens = tokens.shape[1]
+    offsets = jnp.arange(num_tokens)
+    input_indexes = (
+        decode_state.current_position + offsets
+    ) % self.env.cache_sequence_length
+    input_pos = decode_state.input_pos[:, None] + offsets
+
+    # [batch_size, num_tokens, cache_len]: the slot mask, plus causal
+    # attention over the new columns
+    causal = jnp.where(
+        offsets[None, :] <= offsets[:, None], 0, float("-inf")
+    ).astype(decode_state.mask.dtype)
+    mask = jnp.broadcast_to(
+        decode_state.mask[:, None, :],
+        (self.env.batch_size, num_tokens, decode_state.mask.shape[-1]),
+    )
+    mask = mask.at[:, :, input_indexes].set(causal)
+    # Queries are grouped by kv head repetition first, see reshape_heads
+    mask = jnp.broadcast_to(
+        mask[:, None],
+        (self.env.batch_size, self.env.n_reps) + mask.shape[1:],
+    )
+    mask = mask.reshape(self.env.batch_size, 1, -1, mask.shape[-1])
+
+    logits, new_caches, _ = self._call_model_generate(
+        params,
+        tokens,
+        input_indexes,
+        decode_state.caches,
+        decode_state.cache_scales,
+        mask,
+        # Broadcasts with the [batch_size, num_tokens] input_pos
+        decode_state.start[:, None],
+        input_pos,
+        None,
+        None,
+        None,
+    )
+    return logits, new_caches
+
   # pylint: disable-next=all
   def get_tokenizer(self) -> tokenizer_pb2.TokenizerParameters:
     # pylint: disable-next=all
@@ -883,15 +1988,21 @@ class PyTorchEngine(engine_api.Engine):
     return pytree.tree_map_only(torch.Tensor, make_array, model_args_meta)
 
   def _load_from_safetensors(self, path):
-    weights = {}
-    with safe_open(path, framework="flax", device="cpu") as f:
-      for key, model_weights in self.pt_model.state_dict().items():
-        if key == "freqs_cis":
-          continue
-        weights[key] = f.get_tensor(key)
-        assert tuple(model_weights.shape) == tuple(
-            weights[key].shape
-        ), f"key: {key} error: {model_weights.shape} != {weights[key].shape}"
+    """Loads a safetensors file, or a directory of shards, to the devices."""
+    checkpoint = safetensors_loader.SafetensorsCheckpoint(path)
+    keys = []
+    for key, model_weights in self.pt_model.state_dict().items():
+      if key == "freqs_cis":
+        continue
+      assert key in checkpoint, f"key: {key} not found"
+      shape = checkpoint.get_tensor(key).shape
+      assert tuple(model_weights.shape) == tuple(
+          shape
+      ), f"key: {key} error: {model_weights.shape} != {shape}"
+      keys.append(key)
+    weights = safetensors_loader.load_sharded(
+        checkpoint, keys, self.env.sharding_by_name
+    )
     weights["freqs_cis"] = torch_xla2.tensor.t2j(self.pt_model.freqs_cis)
     return weights
 
@@ -925,7 +2036,11 @@ class PyTorchEngine(engine_api.Engine):
       else:
         jax_weights = self._make_state_dict_jax(self.pt_model.state_dict())
 
-      if self.env.quant_config.num_bits_weight == 4:
+      # Packed int4 weights are loaded as the int8 bytes holding them
+      if (
+          self.env.quant_config.num_bits_weight == 4
+          and not self.env.quant_config.pack_weight
+      ):
         assert (
             "gemma" not in self.env.model_type
         ), "int-4 is not supported in Gemma model yet."
@@ -947,6 +2062,10 @@ class PyTorchEngine(engine_api.Engine):
         if k.startswith("layers") and not k.startswith("layers.0"):
           continue
         print(f"Name: {k}, shape: {v.shape} x {v.dtype}")
+      if self.env.scan_layers:
+        jax_weights = scan_layers.stack_layer_weights(
+            jax_weights, self.env.num_layers
+        )
       return jax_weights
 
   @property
@@ -970,7 +2089,12 @@ class PyTorchEngine(engine_api.Engine):
     return DecodeState(
         self.x_sharding if self.env.shard_on_batch else self.replicated,
         self.cache_sharding,
-        self.replicated,
+        # Paged and int4 kv scales are split by heads like the caches
+        (
+            self.cache_sharding
+            if self.env.page_attention or self.env.kv_quantize_int4
+            else self.replicated
+        ),
         self.replicated,
         self.replicated,
         self.replicated,
@@ -1034,8 +2158,18 @@ def create_pytorch_engine(
     generate_cache_stacked=False,
     new_cache_stacked=False,
     lazy_cache_update=False,
+    prefill_chunk_size=0,
+    prefix_cache_max_bytes=0,
+    prefix_cache_block_size=64,
     paged_attention_total_num_pages=0,
     paged_attention_page_size=64,
+    paged_attention_device_reservation=False,
+    paged_attention_preemption=False,
+    scan_layers=False,
+    moe_capacity_factor=0.0,
+    moe_expert_parallel=False,
+    moe_routing_stats_path="",
+    moe_routing_stats_interval=60.0,
     jax_compilation_cache_dir="~/jax_cache",
     jax_persistent_cache_min_entry_size_bytes=0,
     jax_persistent_cache_min_compile_time_secs=1,
@@ -1070,11 +2204,10 @@ def create_pytorch_engine(
     if not path.exists():
       raise ValueError(f"Checkpoint path {ckpt_path} not exists!")
     paths = list(path.glob("*.safetensors"))
-    assert (
-        len(paths) == 1
-    ), f"Expects 1 *.safetensors in the checkpoint dir, see {len(paths)}"
+    assert paths, f"Expects *.safetensors in the checkpoint dir {ckpt_path}"
     checkpoint_format = "safetensors"
-    checkpoint_path = paths[0]
+    # All the shards of a multi file checkpoint are loaded
+    checkpoint_path = paths[0] if len(paths) == 1 else path
 
   pt_model = None
 
@@ -1085,7 +2218,9 @@ def create_pytorch_engine(
     elif model_name.startswith("gemma"):
       sharding_file_name = "gemma"
     elif model_name.startswith("mixtral"):
-      sharding_file_name = "mixtral"
+      sharding_file_name = (
+          "mixtral-expert-parallel" if moe_expert_parallel else "mixtral"
+      )
     sharding_config = os.path.join(
         "default_shardings", sharding_file_name + ".yaml"
     )
@@ -1126,8 +2261,18 @@ def create_pytorch_engine(
       generate_cache_stacked=generate_cache_stacked,
       new_cache_stacked=new_cache_stacked,
       lazy_cache_update=lazy_cache_update,
+      prefill_chunk_size=prefill_chunk_size,
+      prefix_cache_max_bytes=prefix_cache_max_bytes,
+      prefix_cache_block_size=prefix_cache_block_size,
       paged_attention_total_num_pages=paged_attention_total_num_pages,
       paged_attention_page_size=paged_attention_page_size,
+      paged_attention_device_reservation=paged_attention_device_reservation,
+      paged_attention_preemption=paged_attention_preemption,
+      scan_layers=scan_layers,
+      moe_capacity_factor=moe_capacity_factor,
+      moe_expert_parallel=moe_expert_parallel,
+      moe_routing_stats_path=moe_routing_stats_path,
+      moe_routing_stats_interval=moe_routing_stats_interval,
   )
 
   if shard_on_batch and sharding_config:
@@ -13,7 +13,7 @@
 # limitations under the License.
 
 import dataclasses
-from typing import List, Tuple, Union
+from typing import Any, Dict, List, Tuple, Union
 
 import jax
 import jax.numpy as jnp
@@ -23,7 +23,7 @@ import torch_xla2
 import yaml
 
 
-from jetstream_pt import cache_manager
+from jetstream_pt import cache_manager, kv_calibration
 
 
 @dataclasses.dataclass
@@ -34,10 +34,26 @@ class QuantizationConfig:
   is_blockwise_weight: bool = False
   block_size_weight: int = 128
   is_symmetric_weight: bool = True
+  # Store int4 blockwise weights two per byte instead of one per int8
+  pack_weight: bool = False
 
   enable_activation_quantization: bool = False
+  # If set, activations are quantized with the static per tensor scales saved
+  # to this file by activation_calibration instead of per token scales
+  activation_scales_path: str = ""
   enable_kv_quantization: bool = False
+  # 8 for int8 kv caches, 4 for int4 with per channel keys, see
+  # cache_manager.Int4KVCacheGenerate
+  num_bits_kv: int = 8
+  # If set, the int8 kv cache is quantized with the static per layer, per kv
+  # head scales saved to this file by kv_calibration instead of per token
+  # scales computed at every step
+  kv_scales_path: str = ""
   exclude_layers: Union[None, List[str]] = None
+  # Overrides of the weight quantization fields above by layer name, e.g. the
+  # plan of quantization_planner. {"enable_weight_quantization": False} keeps
+  # a layer in floating point.
+  layer_configs: Union[None, Dict[str, Dict[str, Any]]] = None
 
 
 @dataclasses.dataclass
@@ -113,11 +129,49 @@ class JetEngineEnvironmentData:
   # page size per page
   paged_attention_page_size: int = 64
 
+  # Reserve the pages of the next decode step on device instead of the host
+  paged_attention_device_reservation: bool = False
+
+  # Swap slots out to host memory instead of failing when out of pages
+  paged_attention_preemption: bool = False
+
+  # Run the layers with a jax.lax.scan over stacked weights instead of
+  # unrolling them, to cut compile time and executable size
+  scan_layers: bool = False
+
   generate_cache_stacked: bool = False
 
   new_cache_stacked: bool = False
 
   lazy_cache_update: bool = False
+
+  # Number of prompt tokens processed per prefill step in chunked prefill.
+  # 0 disables chunked prefill.
+  prefill_chunk_size: int = 0
+
+  # Memory budget in bytes of the shared-prefix kv cache. 0 disables it.
+  prefix_cache_max_bytes: int = 0
+
+  # Number of tokens per block of the shared-prefix kv cache
+  prefix_cache_block_size: int = 64
+
+  # Token slots of every expert in mixture of experts prefill, relative to a
+  # uniform routing, see moe.capacity_dispatch. Tokens routed to a full
+  # expert skip it. 0 runs every expert on every prefill token.
+  moe_capacity_factor: float = 0.0
+
+  # Shard the experts of mixture of experts layers over the devices and send
+  # the tokens to their experts with an all to all, see
+  # moe.expert_parallel_ffn. moe_capacity_factor then applies to prefill,
+  # decode keeps a slot for every token.
+  moe_expert_parallel: bool = False
+
+  # If set, the engine records the expert load and router entropy of every
+  # mixture of experts layer on device in generate and appends them to this
+  # file as json lines every moe_routing_stats_interval seconds
+  moe_routing_stats_path: str = ""
+  moe_routing_stats_interval: float = 60.0
+
   # Variables used in token sampling
   # sampling algorithm to use ("greedy", "weighted", "neucleus", "topk")
   sampling_algorithm: str = "greedy"
@@ -187,6 +241,28 @@ class JetEngineEnvironment:
       self.generate_cache_stacked = False
       self.new_cache_stacked = False
 
+    quant_config = self._data.quant_config
+    self.kv_quantize_int4 = (
+        quant_config.enable_kv_quantization and quant_config.num_bits_kv == 4
+    )
+    if self.kv_quantize_int4:
+      # Int4 caches are per layer, with per layer scales
+      self.generate_cache_stacked = False
+      self.new_cache_stacked = False
+
+    self.kv_quantize_static = (
+        quant_config.enable_kv_quantization
+        and quant_config.num_bits_kv == 8
+        and bool(quant_config.kv_scales_path)
+    )
+    # Key and value scales of shape [num_layers, num_kv_heads]
+    self.static_kv_scales = None
+    if self.kv_quantize_static:
+      self.static_kv_scales = tuple(
+          jnp.asarray(s)
+          for s in kv_calibration.load_kv_scales(quant_config.kv_scales_path)
+      )
+
     self.default_type = jnp.bfloat16 if self._data.bf16_enable else jnp.float32
 
     if self.generate_cache_stacked:
@@ -292,7 +368,22 @@ class JetEngineEnvironment:
     layered_cache_count = 1 if self.generate_cache_stacked else self.num_layers
 
     for _ in range(layered_cache_count):
-      if self._data.quant_config.enable_kv_quantization:
+      if self._data.quant_config.enable_kv_quantization and self.page_attention:
+        caches.append(
+            cache_manager.PageInt8KVCacheGenerate.empty(
+                self.cache_shape, self.cache_sharding, env=self
+            )
+        )
+      elif self.kv_quantize_int4:
+        caches.append(
+            cache_manager.Int4KVCacheGenerate.empty(
+                self.cache_shape, self.cache_sharding, env=self
+            )
+        )
+      elif (
+          self._data.quant_config.enable_kv_quantization
+          and not self.kv_quantize_static
+      ):
         caches.append(
             cache_manager.Int8KVCacheGenerate.empty(
                 self.cache_shape, self.cache_sharding, env=self
@@ -1,12 +1,14 @@
+import concurrent.futures
 import dataclasses
-import glob
 import os
 from typing import Optional
 from requests.exceptions import HTTPError
 from huggingface_hub import snapshot_download
 from absl import flags
+import ml_dtypes
+import numpy as np
 import torch
-from safetensors import safe_open
+from jetstream_pt import quantize_model, safetensors_loader
 from jetstream_pt.environment import (
     JetEngineEnvironmentData,
 )
@@ -161,14 +163,18 @@ def construct_env_data_from_model_id(
 
 
 def _load_weights(directory):
-  safetensors_files = glob.glob(os.path.join(directory, "*.safetensors"))
-  state_dict = {}
-  for file_path in safetensors_files:
-    with safe_open(file_path, framework="pt") as f:
-      for key in f.keys():
-        state_dict[key] = f.get_tensor(key).to(torch.bfloat16)
-  # Load the state_dict into the model
-  return state_dict
+  checkpoint = safetensors_loader.SafetensorsCheckpoint(directory)
+
+  def load(key):
+    tensor = np.array(checkpoint.get_tensor(key))
+    if tensor.dtype == ml_dtypes.bfloat16:
+      return torch.from_numpy(tensor.view(np.int16)).view(torch.bfloat16)
+    return torch.from_numpy(tensor).to(torch.bfloat16)
+
+  # The shards are memory mapped and read in parallel
+  keys = list(checkpoint.keys())
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    return dict(zip(keys, executor.map(load, keys)))
 
 
 def _make_random_model_weights(model):
@@ -182,11 +188,17 @@ def _make_random_model_weights(model):
 def instantiate_model_from_repo_id(
     repo_id,
     env,
+    load_weights=True,
 ):
-  """Create model instance by hf model id.+"""
+  """Create model instance by hf model id.
+
+  If load_weights is False, the weights are left on the meta device.
+  """
   model_dir = _hf_dir(repo_id)
-  if not FLAGS.internal_use_random_weights and (
-      not os.path.exists(model_dir) or not os.listdir(model_dir)
+  if (
+      load_weights
+      and not FLAGS.internal_use_random_weights
+      and (not os.path.exists(model_dir) or not os.listdir(model_dir))
   ):
     # no weights has been downloaded
     _hf_download(repo_id, model_dir, FLAGS.hf_token)
@@ -197,6 +209,10 @@ def instantiate_model_from_repo_id(
   model = model_info.model_class.from_hf_model_id(
       repo_id, env, FLAGS.internal_use_tiny_model
   )
+  if env.quant_config.enable_weight_quantization:
+    quantize_model.apply_layer_configs(model, env.quant_config)
+  if not load_weights:
+    return model
   if FLAGS.internal_use_random_weights or FLAGS.internal_use_tiny_model:
     weights = _make_random_model_weights(model)
   else:
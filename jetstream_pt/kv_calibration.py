@@ -0,0 +1,100 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Static int8 kv cache scales calibrated on representative prompts.
+
+calibrate_kv_scales runs the prefill of the prompts and records the absolute
+max of the keys and values of every layer and kv head. With the saved scales
+(QuantizationConfig.kv_scales_path) the int8 kv cache is quantized without
+the per token amax reductions of every decode step and DecodeState carries
+no cache scales.
+"""
+
+import json
+from typing import Any, Iterable, Iterator, Sequence, Tuple
+
+import jax.numpy as jnp
+import numpy as np
+
+
+def _head_amax(cache, true_length):
+  """Absolute max per kv head of a [1, heads, seqlen, head_dim] cache."""
+  cache = jnp.abs(cache[:, :, :true_length].astype(jnp.float32))
+  return np.asarray(jnp.max(cache, axis=(0, 2, 3)))
+
+
+def prefill_prompts(
+    engine, params: Any, prompts: Iterable[Sequence[int]]
+) -> Iterator[Tuple[Any, int]]:
+  """Yields the prefix and true length of the prefill of every prompt.
+
+  Every prompt, a sequence of token ids, is truncated to and padded to
+  max_input_sequence_length, so prefill compiles once.
+  """
+  max_length = engine.env.max_input_sequence_length
+  for tokens in prompts:
+    tokens = np.asarray(tokens, dtype=np.int32)[:max_length]
+    true_length = len(tokens)
+    padded_tokens = jnp.asarray(np.pad(tokens, (0, max_length - true_length)))
+    prefix, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=true_length
+    )
+    yield prefix, true_length
+
+
+def calibrate_kv_scales(
+    engine, params: Any, prompts: Iterable[Sequence[int]]
+) -> Tuple[np.ndarray, np.ndarray]:
+  """Returns the int8 key and value scales, [num_layers, num_kv_heads].
+
+  The prompts are sequences of token ids, see prefill_prompts. The engine
+  must not quantize its kv cache.
+  """
+  k_amax = v_amax = None
+  for prefix, true_length in prefill_prompts(engine, params, prompts):
+    k = np.stack([_head_amax(k, true_length) for k, _ in prefix.caches])
+    v = np.stack([_head_amax(v, true_length) for _, v in prefix.caches])
+    if k_amax is None:
+      k_amax, v_amax = k, v
+    else:
+      k_amax, v_amax = np.maximum(k_amax, k), np.maximum(v_amax, v)
+  if k_amax is None:
+    raise ValueError("No calibration prompts")
+
+  def to_scales(amax):
+    return np.where(amax == 0, 1, amax / 127).astype(np.float32)
+
+  return to_scales(k_amax), to_scales(v_amax)
+
+
+def save_kv_scales(path: str, k_scales, v_scales):
+  """Saves the scales of calibrate_kv_scales for kv_scales_path."""
+  with open(path, "w", encoding="utf-8") as f:
+    json.dump(
+        {
+            "k_scales": np.asarray(k_scales).tolist(),
+            "v_scales": np.asarray(v_scales).tolist(),
+        },
+        f,
+    )
+
+
+def load_kv_scales(path: str) -> Tuple[np.ndarray, np.ndarray]:
+  """Loads the key and value scales saved by save_kv_scales."""
+  with open(path, encoding="utf-8") as f:
+    scales = json.load(f)
+  return (
+      np.asarray(scales["k_scales"], dtype=np.float32),
+      np.asarray(scales["v_scales"], dtype=np.float32),
+  )
@@ -34,6 +34,10 @@ from jetstream_pt.quantize import (
     blockwise_jax_kernel,
     blockwise_jax_kernel_dot_general,
     blockwise_jax_kernel_einsum_flatten,
+    blockwise_jax_kernel_int8,
+    blockwise_jax_kernel_packed_int4,
+    pack_int4,
+    unpack_int4,
 )
 from torch import nn
 from . import attention_kernel as ak
@@ -67,6 +71,24 @@ class Int8Embedding(torch.nn.Module):
     return F.embedding(input, self.weight) * self.weight_scaler
 
 
+def quantize_activation_int8(module, x, name="input"):
+  """Quantizes the input x of module to int8 for an int8 x int8 matmul.
+
+  Returns x in int8 and its scale: per token over the last axis, or the static
+  per tensor scale module.static_activation_scales[name] calibrated by
+  activation_calibration, which needs no reduction. Calibration observes x
+  through module.activation_observer.
+  """
+  if module.activation_observer is not None:
+    module.activation_observer(name, x)
+  scale = module.static_activation_scales.get(name)
+  if scale is None:
+    x, scale, _ = quantize_tensor(x, reduce_axis=(x.dim() - 1,))
+    return x, scale
+  x = torch.clamp(torch.round(x * (1.0 / scale)), -127, 127).to(torch.int8)
+  return x, scale
+
+
 class WeightOnlyPerChannelQuantizedLinear(torch.nn.Module):
 
   def __init__(
@@ -108,6 +130,9 @@ class WeightOnlyPerChannelQuantizedLinear(torch.nn.Module):
 
     # Quantize activation
     self.quantize_activation = quant_config.enable_activation_quantization
+    # Static activation scales by input name, see quantize_activation_int8
+    self.static_activation_scales = {}
+    self.activation_observer = None
 
     # Flag to enable dequantize weight first, then do matmul. Useful for debugging.
     self.run_fake_quantize = False
@@ -135,7 +160,7 @@ class WeightOnlyPerChannelQuantizedLinear(torch.nn.Module):
   def forward(self, inputs):
     if not self.run_fake_quantize:
       if self.quantize_activation:
-        inputs, act_s, _ = quantize_tensor(inputs, reduce_axis=(2,))
+        inputs, act_s = quantize_activation_int8(self, inputs)
       if not self.quantize_activation:
         result = F.linear(inputs, self.weight)
       else:
@@ -195,9 +220,15 @@ class WeightOnlyBlockwiseQuantizedLinear(torch.nn.Module):
     self.block_size = quant_config.block_size_weight
     n_blocks = in_features // self.block_size
 
-    assert (
-        not quant_config.enable_activation_quantization
-    ), "Activation quantization not supported for blockwise quantized matmul."
+    # Two int4 values per byte, packed along the block axis by pack_int4
+    self.pack_weight = quant_config.pack_weight
+    if self.pack_weight:
+      assert (
+          quant_config.num_bits_weight == 4
+      ), "Only int4 weights can be packed."
+      assert (
+          not self.use_dot_general and not self.flatten
+      ), "Packed int4 weights only support the einsum implementation."
 
     if self.use_dot_general:
       weight = torch.ones(
@@ -207,7 +238,11 @@ class WeightOnlyBlockwiseQuantizedLinear(torch.nn.Module):
       )
     else:
       weight = torch.ones(
-          (n_blocks, self.block_size, out_features),
+          (
+              n_blocks,
+              self.block_size // 2 if self.pack_weight else self.block_size,
+              out_features,
+          ),
           dtype=torch.int8,
           device=device,
       )
@@ -231,6 +266,13 @@ class WeightOnlyBlockwiseQuantizedLinear(torch.nn.Module):
 
     # Quantize activation
     self.quantize_activation = quant_config.enable_activation_quantization
+    if self.quantize_activation:
+      assert (
+          not self.use_dot_general and not self.flatten
+      ), "Activation quantization only supports the einsum implementation."
+    # Static activation scales by input name, see quantize_activation_int8
+    self.static_activation_scales = {}
+    self.activation_observer = None
 
     # Flag to enable dequantize weight first, then do matmul. Useful for debugging.
     self.run_fake_quantize = False
@@ -242,6 +284,8 @@ class WeightOnlyBlockwiseQuantizedLinear(torch.nn.Module):
     self.weight, self.weight_scaler, self.zero_point = load_q_weight_helper(
         w_q, scale, zp, self.block_size
     )
+    if self.pack_weight:
+      self.weight = pack_int4(self.weight, axis=1)
 
   def quantize_weight_from_nn_linear(self, weight):
     assert weight.dim() == 2, "Expect 2D weight from torch.nn.Linear."
@@ -261,8 +305,21 @@ class WeightOnlyBlockwiseQuantizedLinear(torch.nn.Module):
         assert (
             self.zero_point is None
         ), "Blockwise quantized linear doesn't support zero_point in dot_general or einsum flattened implementation."
+      if self.quantize_activation:
+        inputs, act_s = quantize_activation_int8(self, inputs)
+        result = torchjax.call_jax(
+            blockwise_jax_kernel_int8,
+            inputs,
+            self.weight,
+            self.weight_scaler,
+            self.zero_point,
+            self.pack_weight,
+        )
+        return result * act_s
       blockwise_matmul_kernel = (
-          blockwise_jax_kernel
+          blockwise_jax_kernel_packed_int4
+          if self.pack_weight
+          else blockwise_jax_kernel
           if not self.use_dot_general and not self.flatten
           else blockwise_jax_kernel_dot_general
           if self.use_dot_general
@@ -278,13 +335,16 @@ class WeightOnlyBlockwiseQuantizedLinear(torch.nn.Module):
       return result
     else:
       # Fake quantization, debugging purpose.
-      weight = self.weight.permute(2, 0, 1).to(torch.bfloat16)
+      weight = self.weight
+      if self.pack_weight:
+        weight = torchjax.call_jax(unpack_int4, weight, 1)
+      weight = weight.permute(2, 0, 1).to(torch.bfloat16)
       scaler = self.weight_scaler.unsqueeze(-1).transpose(1, 0)
       if not self.is_symmetric_weight:
         zero_point = self.zero_point.unsqueeze(-1).transpose(1, 0) / scaler
       else:
         zero_point = None
-      w_dequantized = dequantize_tensor(self.weight, scaler, zero_point)
+      w_dequantized = dequantize_tensor(weight, scaler, zero_point)
       w_dequantized = w_dequantized.reshape(w_dequantized.shape[0], -1)
       return F.linear(inputs, w_dequantized)
 
@@ -489,8 +549,8 @@ class AttentionKernel:
             torch.squeeze(xq, 2),
             keys,
             values,
-            cache.page_attention_manager.lengths,
-            cache.page_attention_manager.page_indices,
+            cache.lengths,
+            cache.page_indices,
         )
       else:
         local_output = self.dense_attention(
@@ -520,11 +580,28 @@ class AttentionKernel:
     with jax.named_scope("attn_insert_cache"):
       orig_keys, orig_values = cache.update(xk, xv, self.layer_id)
 
+    existing_xq = xq
+    v_scale = None
+    if self.env.kv_quantize_static and orig_keys.dtype == torch.int8:
+      # With static per head scales, scaling the query by the key scale and
+      # the output by the value scale dequantizes the int8 cache
+      k_scale, v_scale = torchjax.to_torch(
+          tuple(
+              jnp.repeat(scales[self.layer_id], n_rep).reshape(
+                  1, num_heads, 1, 1
+              )
+              for scales in self.env.static_kv_scales
+          )
+      )
+      existing_xq = (xq * k_scale).type_as(xq)
+
     # print(f"attention kernel xq {xq.shape} seqlen {seqlen} keys {keys.shape} mask {mask.shape}")
     with jax.named_scope("attn_qkv"):
       existing_output, (existing_max, existing_denom) = attend(
-          xq=xq, keys=orig_keys, values=orig_values, local_mask=mask
+          xq=existing_xq, keys=orig_keys, values=orig_values, local_mask=mask
       )
+      if v_scale is not None:
+        existing_output = (existing_output * v_scale).type_as(xq)
     # Updating cache during each step still has very large impact on latency.
     # For non flash attention or prefill, existing output contains everything
     if not self.env.lazy_cache_update or seqlen > 1:
@@ -567,6 +644,7 @@ class Int8KVAttentionKernel:
     others_pspec = self.env.partition_by_axis()
     self.dense_attention = ak.dense_attention
     self.flash_attention = ak.flash_attention
+    self.page_attention = ak.call_paged_attention
     self.ragged_attention_orig = ak.RaggedAttentionKernel(
         env,
         input_specs=(q_pspec, kv_pspec, kv_pspec, *([others_pspec] * 7)),
@@ -581,6 +659,24 @@ class Int8KVAttentionKernel:
         q_shard_axis=self.q_shard_axis,
         kv_shard_axis=self.q_shard_axis,
     )
+    # Int4 scales are per head, sharded like the caches
+    self.kv_int4 = self.env.kv_quantize_int4
+    if self.kv_int4:
+      self.ragged_attention_orig = ak.RaggedAttentionKernel(
+          env,
+          input_specs=(
+              q_pspec,
+              kv_pspec,
+              kv_pspec,
+              *([others_pspec] * 5),
+              kv_pspec,
+              kv_pspec,
+          ),
+          output_specs=(q_pspec, (q_pspec, q_pspec)),
+          q_shard_axis=self.q_shard_axis,
+          kv_shard_axis=self.kv_shard_axis,
+          kv_int4=True,
+      )
     self.layer_id = layer_id
 
   def __call__(
@@ -608,15 +704,21 @@ class Int8KVAttentionKernel:
     kv_head_dim = xk.shape[-1]
     n_rep = num_heads // num_kv_heads
 
-    def attend(xq, keys, values, k_scaler, v_scaler, local_mask=None):
-      if keys.ndim == 4:
+    def attend(
+        xq, keys, values, k_scaler, v_scaler, local_mask=None, kv_int4=False
+    ):
+      if keys.ndim == 4 and not kv_int4:
         impl = self.ragged_attention_new
       else:
         impl = self.ragged_attention_orig
 
       true_len = seqlen
       # When GQA is enabled, it not necessary to expand
-      if not (self.env.ragged_mha and n_rep > 1) and seqlen == 1:
+      if (
+          not (self.env.ragged_mha and n_rep > 1)
+          and seqlen == 1
+          and not self.env.page_attention
+      ):
         true_len = 2
         xq = torch.nn.functional.pad(
             xq, (0, 0, 0, true_len - seqlen), "constant", 0
@@ -646,7 +748,21 @@ class Int8KVAttentionKernel:
               k_scaler=k_scaler,
               v_scaler=v_scaler,
               mask=local_mask,
+              kv_int4=kv_int4,
           )
+      elif self.env.page_attention and seqlen == 1:
+        local_output = self.page_attention(
+            self.env,
+            torch.squeeze(xq, 2),
+            keys,
+            values,
+            cache.lengths,
+            cache.page_indices,
+            k_scaler,
+            v_scaler,
+        )
+        local_max = None
+        local_denom = None
       else:
         local_output = self.dense_attention(
             xq=xq,
@@ -655,6 +771,7 @@ class Int8KVAttentionKernel:
             k_scaler=k_scaler,
             v_scaler=v_scaler,
             mask=local_mask,
+            kv_int4=kv_int4,
         )
         local_max = None
         local_denom = None
@@ -692,6 +809,8 @@ class Int8KVAttentionKernel:
           k_scaler=k_scaler,
           v_scaler=v_scaler,
           local_mask=mask,
+          # Prefill attends to the unquantized prompt
+          kv_int4=self.kv_int4 and seqlen == 1,
       )
 
     # For non flash attention or prefill, existing output contains everything
@@ -749,6 +868,7 @@ class Attention(ModuleBase):
     Kernel = (
         Int8KVAttentionKernel
         if env.quant_config.enable_kv_quantization
+        and not env.kv_quantize_static
         else AttentionKernel
     )
     self.attention_kernel = Kernel(env, self.layer_id)
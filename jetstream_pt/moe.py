@@ -0,0 +1,252 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Token dispatch to the experts of mixture of experts layers.
+
+The [T, A] expert assignments of T tokens to A activated experts are sorted
+by expert, so the rows of every expert are contiguous and each expert runs
+one grouped matmul with its weights, read once per step, instead of the
+[T, A] copies of the weights of a gather.
+
+For long prefills capacity_dispatch permutes the tokens to fixed size
+[E, C] slots of their experts, so only the activated experts run on every
+token with static shapes. expert_parallel_ffn sends these slots with an all
+to all to the devices that hold their experts, for weights sharded on the
+expert axis.
+
+RoutingStats accumulates the expert load and router entropy of every layer
+on device, for the routing telemetry of the engine.
+"""
+
+import math
+from typing import Any, Dict, List
+
+from flax import struct
+import jax
+from jax.experimental.shard_map import shard_map
+import jax.numpy as jnp
+import numpy as np
+
+
+def sort_by_expert(expert_indices, num_experts: int):
+  """Sorts the [T, A] expert assignments by expert.
+
+  Returns the order of the flattened assignments, the expert of every sorted
+  row and the number of rows of every expert.
+  """
+  flat_indices = expert_indices.reshape(-1)
+  order = jnp.argsort(flat_indices, stable=True)
+  group_sizes = jnp.bincount(flat_indices, length=num_experts)
+  return order, flat_indices[order], group_sizes.astype(jnp.int32)
+
+
+def grouped_matmul(x, w, group_sizes):
+  """Multiplies the rows of x, [M, K] sorted by expert, by the [N, K] weight
+  of their expert in w, [E, N, K].
+
+  int8 x int8 products are accumulated in int32 and returned in float32.
+  """
+  w = jnp.swapaxes(w, 1, 2)
+  if x.dtype == jnp.int8 and w.dtype == jnp.int8:
+    out = jax.lax.ragged_dot(
+        x, w, group_sizes, preferred_element_type=jnp.int32
+    )
+    return out.astype(jnp.float32)
+  return jax.lax.ragged_dot(x, w.astype(x.dtype), group_sizes)
+
+
+def expert_capacity(
+    num_tokens: int,
+    num_activated: int,
+    num_experts: int,
+    capacity_factor: float,
+) -> int:
+  """Number of token slots of every expert: capacity_factor times the slots
+  of a uniform routing, at most num_tokens."""
+  capacity = math.ceil(
+      capacity_factor * num_tokens * num_activated / num_experts
+  )
+  return max(1, min(num_tokens, capacity))
+
+
+def capacity_dispatch(expert_indices, num_experts: int, capacity: int):
+  """Assigns the [T, A] expert assignments to the capacity slots of their
+  expert, earlier tokens first.
+
+  Returns the token of every slot, [E, C], T for the empty slots, and the
+  slot of every assignment in the flattened [E * C] slots, [T, A], E * C for
+  the assignments dropped because their expert is full or is E, no expert.
+  """
+  num_tokens, num_activated = expert_indices.shape
+  order, row_experts, group_sizes = sort_by_expert(expert_indices, num_experts)
+  # Rank of every sorted row among the rows of its expert
+  starts = jnp.cumsum(group_sizes) - group_sizes
+  ranks = jnp.arange(order.shape[0]) - starts[row_experts]
+  num_slots = num_experts * capacity
+  kept = (ranks < capacity) & (row_experts < num_experts)
+  slots = jnp.where(kept, row_experts * capacity + ranks, num_slots)
+  slots = slots.astype(jnp.int32)
+  slot_tokens = jnp.full((num_slots,), num_tokens, dtype=jnp.int32)
+  slot_tokens = slot_tokens.at[slots].set(
+      (order // num_activated).astype(jnp.int32), mode="drop"
+  )
+  assignment_slots = jnp.zeros_like(slots).at[order].set(slots)
+  return (
+      slot_tokens.reshape(num_experts, capacity),
+      assignment_slots.reshape(num_tokens, num_activated),
+  )
+
+
+def _expert_ffn(x, w1, w2, w3, scalers=None):
+  """SwiGLU feed forward of the experts of w1, w2 and w3 on their slots x,
+  [S, E, C, D]. The weights are int8 if scalers are set."""
+  if scalers is None:
+    scalers = (None, None, None)
+  w1_scaler, w2_scaler, w3_scaler = scalers
+
+  def matmul(subscripts, x, w, w_scaler):
+    out = jnp.einsum(subscripts, x, w.astype(x.dtype))
+    if w_scaler is not None:
+      out = out * w_scaler[:, None, :].astype(out.dtype)
+    return out
+
+  x1 = jax.nn.silu(matmul("seci,eoi->seco", x, w1, w1_scaler))
+  x3 = matmul("seci,eoi->seco", x, w3, w3_scaler)
+  return matmul("seco,eio->seci", x1 * x3, w2, w2_scaler)
+
+
+def expert_parallel_ffn(
+    x,
+    expert_indices,
+    weights,
+    scalers,
+    *,
+    mesh,
+    axis_name: str,
+    capacity_factor: float,
+):
+  """Expert feed forward of the [T, D] tokens x routed to [T, A] experts,
+  with the (w1, w2, w3) weights and their scalers sharded on the expert axis
+  over the axis_name of mesh.
+
+  Every device dispatches its shard of the tokens to capacity slots, see
+  capacity_dispatch, sends the slots of every expert to the device that holds
+  it with an all to all, runs its experts and sends the outputs back. With
+  capacity_factor 0 every expert has a slot for every token. Returns the
+  [T, A, D] expert outputs, zeros for the dropped tokens.
+  """
+  num_devices = mesh.shape[axis_name]
+  num_experts = weights[0].shape[0]
+  num_tokens, num_activated = expert_indices.shape
+  padding = -num_tokens % num_devices
+  x = jnp.pad(x, ((0, padding), (0, 0)))
+  # The padding tokens are routed to no expert
+  expert_indices = jnp.pad(
+      expert_indices, ((0, padding), (0, 0)), constant_values=num_experts
+  )
+  local_tokens = x.shape[0] // num_devices
+  capacity = local_tokens
+  if capacity_factor > 0:
+    capacity = expert_capacity(
+        local_tokens, num_activated, num_experts, capacity_factor
+    )
+
+  def dispatch_and_run(x, expert_indices, weights, scalers):
+    slot_tokens, assignment_slots = capacity_dispatch(
+        expert_indices, num_experts, capacity
+    )
+    # The zero row of the empty slots
+    x = jnp.pad(x, ((0, 1), (0, 0)))[slot_tokens]
+    x = x.reshape(num_devices, num_experts // num_devices, capacity, -1)
+    # [devices, local experts, C, D] to the slots of the local experts from
+    # every device
+    x = jax.lax.all_to_all(x, axis_name, 0, 0, tiled=True)
+    out = _expert_ffn(x, *weights, scalers)
+    out = jax.lax.all_to_all(out, axis_name, 0, 0, tiled=True)
+    out = out.reshape(num_experts * capacity, -1)
+    # The zero output of the dropped assignments
+    return jnp.pad(out, ((0, 1), (0, 0)))[assignment_slots]
+
+  spec = jax.sharding.PartitionSpec(axis_name)
+  out = shard_map(
+      dispatch_and_run,
+      mesh,
+      in_specs=(spec, spec, spec, spec),
+      out_specs=spec,
+      check_rep=False,
+  )(x, expert_indices, weights, scalers)
+  return out[:num_tokens]
+
+
+@struct.dataclass
+class RoutingStats:
+  """Routing statistics of the mixture of experts layers."""
+
+  expert_counts: jax.Array  # [num_layers, num_experts] tokens per expert
+  router_entropy: jax.Array  # [num_layers] sum over the tokens
+  num_tokens: jax.Array  # [num_layers] routed tokens
+
+
+def init_routing_stats(num_layers: int, num_experts: int) -> RoutingStats:
+  """Zero routing stats of num_layers layers with num_experts experts."""
+  return RoutingStats(
+      expert_counts=jnp.zeros((num_layers, num_experts), dtype=jnp.int32),
+      router_entropy=jnp.zeros((num_layers,), dtype=jnp.float32),
+      num_tokens=jnp.zeros((num_layers,), dtype=jnp.int32),
+  )
+
+
+def routing_stats(probs, expert_indices, num_experts: int) -> RoutingStats:
+  """Routing statistics of one layer, with the [T, E] router probabilities
+  and the [T, A] experts of the tokens."""
+  probs = probs.astype(jnp.float32)
+  return RoutingStats(
+      expert_counts=jnp.bincount(
+          expert_indices.reshape(-1), length=num_experts
+      ).astype(jnp.int32),
+      router_entropy=jnp.sum(jax.scipy.special.entr(probs)),
+      num_tokens=jnp.int32(probs.shape[0]),
+  )
+
+
+def add_routing_stats(
+    total: RoutingStats, layer_stats: List[RoutingStats]
+) -> RoutingStats:
+  """Adds the routing_stats of every layer, in order, to total."""
+  stacked = jax.tree.map(lambda *x: jnp.stack(x), *layer_stats)
+  return jax.tree.map(jnp.add, total, stacked)
+
+
+def routing_metrics(stats: RoutingStats) -> Dict[str, Any]:
+  """Per layer expert load and mean router entropy of stats, on the host."""
+  stats = jax.device_get(stats)
+  layers = []
+  for counts, entropy, num_tokens in zip(
+      stats.expert_counts, stats.router_entropy, stats.num_tokens
+  ):
+    counts = np.asarray(counts, dtype=np.int64)
+    total = max(int(counts.sum()), 1)
+    layers.append(
+        {
+            "expert_counts": counts.tolist(),
+            "expert_load": (counts / total).tolist(),
+            # Tokens of the busiest expert over the mean tokens of the experts
+            "load_imbalance": float(counts.max() * len(counts) / total),
+            "mean_router_entropy": float(entropy / max(int(num_tokens), 1)),
+        }
+    )
+  return {
+      "num_tokens": int(stats.num_tokens[0]) if layers else 0,
+      "layers": layers,
+  }
@@ -1,13 +1,26 @@
-import queue
 import functools
 from typing import List, Tuple
 
 import jax
 import jax.numpy as jnp
 import jax.sharding as jsharding
+from jax.experimental.pallas.ops.tpu.paged_attention import quantization_utils
 import numpy as np
 
 
+def quantize_kv_pages(x: jax.Array) -> Tuple[jax.Array, jax.Array]:
+  """Quantizes kv to int8 per token and head, along the last (head_dim) axis.
+
+  Returns the int8 values and their scales, [..., 1], in the convention of the
+  paged attention kernel, which dequantizes with x * scale / MAX_INT8.
+  """
+  amax = jnp.max(jnp.abs(x), axis=-1, keepdims=True)
+  amax = jnp.where(amax == 0, 1, amax)
+  x_q = jnp.clip(jnp.rint(x * (127 / amax)), -127, 127).astype(jnp.int8)
+  scales = amax * (quantization_utils.MAX_INT8 / 127)
+  return x_q, scales.astype(x.dtype)
+
+
 class PageAttentionManager:
   """Manages page blocks.
 
@@ -16,8 +29,13 @@ class PageAttentionManager:
    2. Free pages resource for the slots after decode. Pages indices go to free list.
    3. Get pages indices meta data for all the slots.
    4. Transform and insert prefill caches to decode caches.
+   5. Share pages between slots with reference counting. A shared page is
+      copied on write, i.e. before a slot appends a token to it.
+   6. Quantize the prefill caches for int8 kv pages, see quantize_kv_pages.
   """
 
+  # pylint: disable=too-many-instance-attributes
+  # More than 7 is reasonable in this case.
   def __init__(
       self,
       batch_size: int,
@@ -25,8 +43,8 @@ class PageAttentionManager:
       paged_attention_page_size: int,
       max_pages_per_sequence: int,
   ):
-    self.unused_pages = queue.Queue()
     self.batch_size = batch_size
+    self.total_num_pages = paged_attention_total_num_pages
     self.page_indices = np.full(
         (batch_size, max_pages_per_sequence),
         paged_attention_total_num_pages - 1,
@@ -35,33 +53,211 @@ class PageAttentionManager:
     self.lengths = np.zeros(batch_size, dtype=np.int32)
     self.paged_attention_page_size = paged_attention_page_size
     self.max_pages_per_sequence = max_pages_per_sequence
-    for i in range(paged_attention_total_num_pages):
-      self.unused_pages.put(i, block=False)
+    # Number of slots using each page
+    self.page_ref_counts = np.zeros(
+        paged_attention_total_num_pages, dtype=np.int32
+    )
+    # Number of pages reserved by each slot
+    self.num_slot_pages = np.zeros(batch_size, dtype=np.int32)
+    # (src, dst) page pairs to copy before the next decode step
+    self.pending_page_copies = []
+    # Free list as a ring buffer, pages are allocated from the head and
+    # released to the tail. The last page is never handed out: unused
+    # entries of the page table point to it.
+    self.padding_page = paged_attention_total_num_pages - 1
+    self._free_pages = np.arange(self.padding_page, dtype=np.int32)
+    self._free_head = 0
+    self.num_free_pages = self.padding_page
+
+  def _allocate_pages(self, num_pages: int) -> np.ndarray:
+    if num_pages > self.num_free_pages:
+      raise RuntimeError(
+          f"Out of pages: {num_pages} requested, "
+          f"{self.num_free_pages} available"
+      )
+    capacity = len(self._free_pages)
+    positions = (self._free_head + np.arange(num_pages)) % capacity
+    pages = self._free_pages[positions]
+    self._free_head = (self._free_head + num_pages) % capacity
+    self.num_free_pages -= num_pages
+    self.page_ref_counts[pages] = 1
+    return pages
+
+  def _release_pages(self, pages: np.ndarray):
+    capacity = len(self._free_pages)
+    tail = self._free_head + self.num_free_pages
+    positions = (tail + np.arange(len(pages))) % capacity
+    self._free_pages[positions] = pages
+    self.num_free_pages += len(pages)
+
+  def reserve_page_pool(self, num_pages: int) -> np.ndarray:
+    """Reserves pages to be handed out to slots by the device.
+
+    The pages are owned by the caller until they get assigned to a slot, they
+    can be given back with release_page_pool.
+    """
+    return self._allocate_pages(num_pages)
+
+  def release_page_pool(self, pages: np.ndarray):
+    """Gives back pool pages that were not assigned to any slot."""
+    pages = np.asarray(pages, dtype=np.int32)
+    self.page_ref_counts[pages] = 0
+    self._release_pages(pages)
+
+  def set_slot_pages(self, slot: int, page_indices: np.ndarray):
+    """Syncs the page table row of slot after pages were added on device."""
+    self.page_indices[slot] = page_indices
+    self.num_slot_pages[slot] = np.count_nonzero(
+        page_indices != self.padding_page
+    )
 
   # pylint: disable-next=all
-  def reserve_pages_insert(self, slot: int, seq_len: int):
+  def reserve_pages_insert(
+      self,
+      slot: int,
+      seq_len: int,
+      shared_slot: int | None = None,
+      shared_len: int = 0,
+  ):
+    """Reserves the pages to insert a prefill of seq_len tokens to slot.
+
+    If shared_slot is given, the first shared_len tokens of the prefill are
+    expected to be identical to the ones of shared_slot, and the full pages
+    holding them are shared instead of reserved. Raises ValueError if
+    shared_slot is slot or doesn't hold that many pages.
+
+    Returns the number of new pages and their indices. The new pages hold the
+    tokens after the shared pages.
+    """
+    num_pages = -(-seq_len // self.paged_attention_page_size)
+    num_shared_pages = 0
+    if shared_slot is not None:
+      num_shared_pages = (
+          min(shared_len, seq_len) // self.paged_attention_page_size
+      )
+      if shared_slot == slot:
+        raise ValueError(f"Slot {slot} can't share its own pages")
+      if num_shared_pages > self.num_slot_pages[shared_slot]:
+        raise ValueError(
+            f"Slot {shared_slot} holds {self.num_slot_pages[shared_slot]} "
+            f"pages, {num_shared_pages} can't be shared"
+        )
+      shared = self.page_indices[shared_slot, :num_shared_pages]
+      self.page_indices[slot, :num_shared_pages] = shared
+      self.page_ref_counts[shared] += 1
+
     self.lengths[slot] = seq_len
-    num_pages = (
-        seq_len // self.paged_attention_page_size
-        if seq_len % self.paged_attention_page_size == 0
-        else seq_len // self.paged_attention_page_size + 1
+    indices = self._allocate_pages(num_pages - num_shared_pages)
+    self.page_indices[slot, num_shared_pages:num_pages] = indices
+    self.num_slot_pages[slot] = num_pages
+    return (
+        num_pages - num_shared_pages,
+        self.page_indices[slot, num_shared_pages:num_pages],
     )
 
-    indices = [self.unused_pages.get(block=False) for _ in range(num_pages)]
-    self.page_indices[slot, :num_pages] = indices
-    return num_pages, self.page_indices[slot, :num_pages]
+  def fork_pages(self, src_slot: int, dst_slot: int):
+    """Makes dst_slot share all the pages of src_slot, e.g. parallel sampling.
+
+    The last partial page is copied on write once either slot decodes into it.
+    """
+    num_pages = self.num_slot_pages[src_slot]
+    shared = self.page_indices[src_slot, :num_pages]
+    self.page_indices[dst_slot, :num_pages] = shared
+    self.page_ref_counts[shared] += 1
+    self.num_slot_pages[dst_slot] = num_pages
+    self.lengths[dst_slot] = self.lengths[src_slot]
+
+  def _reserve_pages_decode(self, slots: np.ndarray, lens: np.ndarray):
+    """Makes the page receiving the next token of each slot writable.
+
+    A new page is reserved for the slots at a page boundary, and the shared
+    last partial page of the other slots is copied on write.
+    """
+    page_size = self.paged_attention_page_size
+    pages = lens // page_size
+    current = self.page_indices[slots, pages]
+    new_page = lens % page_size == 0
+    copy = ~new_page & (self.page_ref_counts[current] > 1)
+    if copy.any():
+      # When all the users of a shared page write to it in the same step, the
+      # last one can keep it.
+      shared = np.flatnonzero(copy)
+      order = shared[np.argsort(current[shared], kind="stable")]
+      _, group_start, group_size = np.unique(
+          current[order], return_index=True, return_counts=True
+      )
+      rank = np.arange(len(order)) - np.repeat(group_start, group_size)
+      copy[order] = rank < self.page_ref_counts[current[order]] - 1
+    need_page = new_page | copy
+    if not need_page.any():
+      return
+    # Pages are handed out in slot order
+    indices = self._allocate_pages(int(need_page.sum()))
+    self.page_indices[slots[need_page], pages[need_page]] = indices
+    self.num_slot_pages[slots[new_page]] = pages[new_page] + 1
+
+    copy_src = current[copy]
+    np.subtract.at(self.page_ref_counts, copy_src, 1)
+    copy_dst = indices[copy[need_page]]
+    self.pending_page_copies.extend(zip(copy_src, copy_dst))
+
+  def num_pages_needed_decode(self, lens) -> int:
+    """Upper bound of the pages fill_new_pages takes for lens."""
+    lens = np.asarray(lens).reshape(-1)
+    slots = np.flatnonzero(lens > 0)
+    lens = lens[slots]
+    current = self.page_indices[slots, lens // self.paged_attention_page_size]
+    new_page = lens % self.paged_attention_page_size == 0
+    copy = ~new_page & (self.page_ref_counts[current] > 1)
+    return int(new_page.sum() + copy.sum())
+
+  def select_preemption_victim(self, exclude=()) -> int | None:
+    """Picks the slot to swap out when running out of pages.
+
+    The slot holding the most pages is picked, so a single preemption frees as
+    much memory as possible. Returns None if no slot can be preempted.
+    """
+    num_pages = self.num_slot_pages.copy()
+    num_pages[list(exclude)] = 0
+    if not num_pages.any():
+      return None
+    return int(np.argmax(num_pages))
 
   # pylint: disable-next=all
   def reserve_pages_decode(self, slot: int, seq_len: int):
-    if seq_len > 0 and seq_len % self.paged_attention_page_size == 0:
-      index = self.unused_pages.get(block=False)
-      num_pages = seq_len // self.paged_attention_page_size
-      self.page_indices[slot, num_pages] = index
+    if seq_len > 0:
+      self._reserve_pages_decode(
+          np.asarray([slot]), np.asarray([seq_len], dtype=np.int32)
+      )
 
   # pylint: disable-next=all
   def fill_new_pages(self, lens):
-    for slot in range(self.batch_size):
-      self.reserve_pages_decode(slot, lens[slot])
+    lens = np.asarray(lens).reshape(-1)
+    slots = np.flatnonzero(lens > 0)
+    self._reserve_pages_decode(slots, lens[slots])
+
+  def pop_page_copies(self) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the (src, dst) pages to copy before decoding and clears them."""
+    copies = np.asarray(self.pending_page_copies, dtype=np.int32)
+    self.pending_page_copies = []
+    if copies.size == 0:
+      return np.zeros((0,), np.int32), np.zeros((0,), np.int32)
+    return copies[:, 0], copies[:, 1]
+
+  def copy_pages(
+      self,
+      decode_caches: List[Tuple[jax.Array, jax.Array]],
+      src_pages: jax.Array,
+      dst_pages: jax.Array,
+  ) -> List[Tuple[jax.Array, jax.Array]]:
+    """Copies the src pages of the decode caches to the dst pages."""
+    return [
+        (
+            k.at[:, dst_pages, :, :].set(k[:, src_pages, :, :]),
+            v.at[:, dst_pages, :, :].set(v[:, src_pages, :, :]),
+        )
+        for k, v in decode_caches
+    ]
 
   # pylint: disable-next=all
   def prefill_cache_padding(
@@ -105,6 +301,57 @@ class PageAttentionManager:
       Decode cache. List of Tuple K, V. For each K, V:
         [num_heads, paged_attention_total_num_pages, paged_attention_page_size, head_dim] jax.Array.
     """
+    paged_caches = self._page_prefill_caches(prefill_caches, tep_kv)
+    return [
+        (
+            self._insert_pages(k, newk, update_indexes, sharding),
+            self._insert_pages(v, newv, update_indexes, sharding),
+        )
+        for (k, v), (newk, newv) in zip(decode_caches, paged_caches)
+    ]
+
+  def insert_prefill_cache_quantized(
+      self,
+      prefill_caches: List[Tuple[jax.Array, jax.Array]],
+      decode_caches: List[Tuple[jax.Array, jax.Array]],
+      decode_scales: List[Tuple[jax.Array, jax.Array]],
+      update_indexes: jax.Array,
+      tep_kv: jax.Array,
+      sharding: jsharding.Sharding,
+  ):
+    """Quantizes the prefill caches and inserts them to int8 decode caches.
+
+    Same as insert_prefill_cache, decode_scales are the per token scales of
+    the decode caches, [num_heads, paged_attention_total_num_pages,
+    paged_attention_page_size, 1] for each K, V.
+
+    Returns:
+      Tuple of the decode caches and their scales.
+    """
+    paged_caches = self._page_prefill_caches(prefill_caches, tep_kv)
+    caches = []
+    scales = []
+    for (k, v), (ks, vs), (newk, newv) in zip(
+        decode_caches, decode_scales, paged_caches
+    ):
+      newk, newks = quantize_kv_pages(newk)
+      newv, newvs = quantize_kv_pages(newv)
+      caches.append(
+          (
+              self._insert_pages(k, newk, update_indexes, sharding),
+              self._insert_pages(v, newv, update_indexes, sharding),
+          )
+      )
+      scales.append(
+          (
+              self._insert_pages(ks, newks, update_indexes, sharding),
+              self._insert_pages(vs, newvs, update_indexes, sharding),
+          )
+      )
+    return caches, scales
+
+  def _page_prefill_caches(self, prefill_caches, tep_kv):
+    """Pads the prefill caches to tep_kv and splits them into pages."""
     # Reduce cache batch deminsion
     # [kv_heads, seq_len, dim]
     squeezed_caches = [
@@ -120,7 +367,7 @@ class PageAttentionManager:
     ]
     kv_heads, _, dim = tmp_caches[0][0].shape
     # [kv_heads, num_pages, paged_attention_page_size, dim]
-    paged_caches = [
+    return [
         (
             jnp.reshape(k, (kv_heads, -1, self.paged_attention_page_size, dim)),
             jnp.reshape(v, (kv_heads, -1, self.paged_attention_page_size, dim)),
@@ -128,53 +375,39 @@ class PageAttentionManager:
         for k, v in tmp_caches
     ]
 
-    @functools.partial(jax.jit, donate_argnums=(0, 1), inline=True)
-    def insert(cache, new_entry):
-      res = cache.at[:, update_indexes, :, :].set(new_entry)
-      res = jax.lax.with_sharding_constraint(res, sharding)
-      return res
-
-    caches = [
-        (insert(k, newk), insert(v, newv))
-        for (k, v), (newk, newv) in zip(decode_caches, paged_caches)
-    ]
-
-    return caches
+  @staticmethod
+  @functools.partial(
+      jax.jit, donate_argnums=(0, 1), static_argnames=("sharding",), inline=True
+  )
+  def _insert_pages(cache, new_entry, update_indexes, sharding):
+    """Writes the pages of new_entry at the update_indexes pages of cache."""
+    res = cache.at[:, update_indexes, :, :].set(new_entry)
+    res = jax.lax.with_sharding_constraint(res, sharding)
+    return res
 
-  # pylint: disable-next=all
   def get_page_token_indices(self, lens):
-    # assert lens.shape == (
-    #     self.batch_size,
-    #     1,
-    # ), f"len shape: {lens.shape} not equals batch size: {self.batch_size, 1}"
-    update_page_indices = []
-    token_scale_indices = []
-    batch_slots = []
-    offset = 0
-
-    for slot in range(self.batch_size):
-      seq_len = lens[slot]
-      if seq_len == 0:
-        continue
-      num_pages = seq_len // self.paged_attention_page_size + 1
-      token_pos = seq_len % self.paged_attention_page_size
-      page_index = self.page_indices[slot, num_pages - 1]
-
-      update_page_indices.append(page_index)
-      token_scale_indices.append(offset + token_pos)
-      batch_slots.append(slot)
-      offset += self.paged_attention_page_size
+    """Returns the page, token offset and slot of the active slots' next token.
+
+    The result is [3, num_active_slots], the token offsets index the stacked
+    pages of the active slots.
+    """
+    lens = np.asarray(lens).reshape(-1)
+    batch_slots = np.flatnonzero(lens != 0)
+    seq_lens = lens[batch_slots]
+    page_size = self.paged_attention_page_size
+    update_page_indices = self.page_indices[batch_slots, seq_lens // page_size]
+    # Offset of the token in the stacked pages of the active slots
+    token_scale_indices = (
+        np.arange(len(batch_slots)) * page_size + seq_lens % page_size
+    )
     self.lengths = np.where(lens == 0, 0, lens + 1)
-    update_page_indices = np.asarray(update_page_indices)
-    token_scale_indices = np.asarray(token_scale_indices)
-    batch_slots = np.asarray(batch_slots)
     return np.stack(
         (
             update_page_indices,
             token_scale_indices,
             batch_slots,
         )
-    )
+    ).astype(np.int32)
 
   # pylint: disable-next=all
   def get_compress_kv_cache(
@@ -212,11 +445,26 @@ class PageAttentionManager:
 
   # pylint: disable-next=all
   def free_pages_resource(self, slot):
-    for i in range(self.max_pages_per_sequence):
-      index = self.page_indices[slot, i]
-      if index < 0:
-        break
-      self.unused_pages.put(index, block=False)
-
-    self.page_indices = self.page_indices.at[slot, :].set(jnp.asarray([0]))
+    self.free_slots(np.asarray([slot]))
     return None
+
+  def free_slots(self, slots):
+    """Releases the pages of several slots at once.
+
+    Shared pages go back to the free list with the last slot using them.
+    """
+    slots = np.asarray(slots).reshape(-1)
+    in_use = (
+        np.arange(self.max_pages_per_sequence)[None, :]
+        < self.num_slot_pages[slots][:, None]
+    )
+    pages = self.page_indices[slots][in_use]
+    np.subtract.at(self.page_ref_counts, pages, 1)
+    released = pages[self.page_ref_counts[pages] == 0]
+    # A page used by several of the slots shows up several times
+    _, first = np.unique(released, return_index=True)
+    self._release_pages(released[np.sort(first)])
+
+    self.page_indices[slots, :] = self.padding_page
+    self.num_slot_pages[slots] = 0
+    self.lengths[slots] = 0
@@ -0,0 +1,131 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import dataclasses
+from typing import Dict, List, Optional, Tuple
+
+import jax
+import numpy as np
+
+
+@dataclasses.dataclass
+class _Entry:
+  tokens: np.ndarray  # [num_blocks * block_size]
+  caches: List[Tuple[jax.Array, jax.Array]]  # (1, kv_heads, seqlen, dim)
+  block_keys: List[int]
+  nbytes: int
+
+
+class PrefixCache:
+  """Caches prefill kv of prompt prefixes, keyed by token blocks.
+
+  A prompt is split into blocks of `block_size` tokens and every block
+  boundary is keyed by a hash chained over all the previous blocks, so two
+  prompts share a key only if they share the whole prefix. Only full blocks are
+  cached. Entries are evicted in LRU order once the stored kv exceeds
+  `max_bytes`.
+  """
+
+  def __init__(self, block_size: int, max_bytes: int):
+    if block_size <= 0:
+      raise ValueError(f"block_size should be positive, got {block_size}")
+    self.block_size = block_size
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    # entry key -> _Entry, least recently used first
+    self._entries: collections.OrderedDict[int, _Entry] = (
+        collections.OrderedDict()
+    )
+    # block key -> keys of the entries containing that prefix
+    self._index: Dict[int, List[int]] = collections.defaultdict(list)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _block_keys(self, tokens: np.ndarray) -> List[int]:
+    keys = []
+    key = 0
+    for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+      key = hash((key, tokens[start : start + self.block_size].tobytes()))
+      keys.append(key)
+    return keys
+
+  def lookup(
+      self, tokens
+  ) -> Tuple[int, Optional[List[Tuple[jax.Array, jax.Array]]]]:
+    """Finds the longest cached prefix of tokens.
+
+    Returns the number of cached tokens and their kv caches, or (0, None)
+    on a miss.
+    """
+    tokens = np.asarray(tokens, dtype=np.int32)
+    block_keys = self._block_keys(tokens)
+    for num_blocks in range(len(block_keys), 0, -1):
+      length = num_blocks * self.block_size
+      entry_keys = self._index.get(block_keys[num_blocks - 1], [])
+      for entry_key in reversed(entry_keys):
+        entry = self._entries[entry_key]
+        if not np.array_equal(entry.tokens[:length], tokens[:length]):
+          continue  # hash collision
+        self._entries.move_to_end(entry_key)
+        if entry.tokens.shape[0] == length:
+          return length, entry.caches
+        return length, [
+            (k[:, :, :length], v[:, :, :length]) for k, v in entry.caches
+        ]
+    return 0, None
+
+  def insert(self, tokens, caches: List[Tuple[jax.Array, jax.Array]]):
+    """Stores the kv of the full blocks of tokens.
+
+    caches are the prefill caches of the prompt, i.e. Prefix.caches, and
+    should hold at least len(tokens) positions.
+    """
+    tokens = np.asarray(tokens, dtype=np.int32)
+    block_keys = self._block_keys(tokens)
+    if not block_keys:
+      return
+    length = len(block_keys) * self.block_size
+    cached_length, _ = self.lookup(tokens[:length])
+    if cached_length == length:
+      return  # Already covered by an existing entry
+
+    caches = [(k[:, :, :length], v[:, :, :length]) for k, v in caches]
+    nbytes = sum(k.nbytes + v.nbytes for k, v in caches)
+    if nbytes > self.max_bytes:
+      return
+    entry_key = block_keys[-1]
+    self._entries[entry_key] = _Entry(
+        tokens[:length].copy(), caches, block_keys, nbytes
+    )
+    for key in block_keys:
+      self._index[key].append(entry_key)
+    self.nbytes += nbytes
+    self._evict()
+
+  def _evict(self):
+    while self.nbytes > self.max_bytes and self._entries:
+      entry_key, entry = self._entries.popitem(last=False)
+      for key in entry.block_keys:
+        self._index[key].remove(entry_key)
+        if not self._index[key]:
+          del self._index[key]
+      self.nbytes -= entry.nbytes
+
+  def clear(self):
+    """Drops all the entries."""
+    self._entries.clear()
+    self._index.clear()
+    self.nbytes = 0
@@ -0,0 +1,282 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mixed precision weight quantization planned on representative prompts.
+
+plan_quantization runs the prefill of the prompts through the float model and
+records the inputs of every linear layer. Each layer is quantized with every
+setting of CANDIDATES and the error of its outputs measured on those inputs.
+The plan picks the smallest weights whose mean error over the layers stays
+under max_error; saved to quantization_plan_path it is applied as
+QuantizationConfig.layer_configs by quantize_model and the model constructors.
+"""
+
+import dataclasses
+import functools
+import json
+from typing import Any, Dict, Iterable, List, Sequence
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import torch
+
+from jetstream_pt import kv_calibration, torchjax
+
+# Weight quantization settings tried for every layer, see
+# QuantizationConfig. The float setting keeps the layer in bfloat16.
+CANDIDATES = {
+    "int4_blockwise": {
+        "enable_weight_quantization": True,
+        "num_bits_weight": 4,
+        "is_blockwise_weight": True,
+        "pack_weight": True,
+    },
+    "int8_per_channel": {
+        "enable_weight_quantization": True,
+        "num_bits_weight": 8,
+        "is_blockwise_weight": False,
+    },
+    "int8_blockwise": {
+        "enable_weight_quantization": True,
+        "num_bits_weight": 8,
+        "is_blockwise_weight": True,
+    },
+    "float": {"enable_weight_quantization": False},
+}
+
+
+@dataclasses.dataclass
+class QuantizationPlan:
+  """Per layer quantization settings picked by plan_quantization."""
+
+  # Name of the CANDIDATES setting by layer name
+  layer_settings: Dict[str, str]
+  # Relative output error of the picked setting by layer name
+  layer_errors: Dict[str, float]
+  # Bytes of the linear weights, with the plan and in bfloat16
+  weight_bytes: int
+  float_weight_bytes: int
+  block_size: int = 128
+
+  @property
+  def mean_error(self) -> float:
+    """Mean relative output error over the layers."""
+    return float(np.mean(list(self.layer_errors.values())))
+
+  @property
+  def layer_configs(self) -> Dict[str, Dict[str, Any]]:
+    """The plan as QuantizationConfig.layer_configs."""
+    layer_configs = {}
+    for name, setting in self.layer_settings.items():
+      layer_configs[name] = dict(CANDIDATES[setting])
+      if layer_configs[name].get("is_blockwise_weight"):
+        layer_configs[name]["block_size_weight"] = self.block_size
+    return layer_configs
+
+
+def _fake_quantize(weight, setting, block_size):
+  """Quantizes and dequantizes an [out, in] weight symmetrically."""
+  options = CANDIDATES[setting]
+  if not options["enable_weight_quantization"]:
+    return weight
+  max_int = 2 ** (options["num_bits_weight"] - 1) - 1
+  out_features, in_features = weight.shape
+  if options["is_blockwise_weight"]:
+    weight = weight.reshape(out_features, in_features // block_size, block_size)
+  scale = jnp.maximum(jnp.max(jnp.abs(weight), axis=-1, keepdims=True), 1e-5)
+  scale = scale / max_int
+  weight = jnp.clip(jnp.round(weight / scale), -max_int - 1, max_int) * scale
+  return weight.reshape(out_features, in_features)
+
+
+def _weight_bytes(weight_shape, setting, block_size):
+  """Bytes of the weight and scales of a layer with setting."""
+  options = CANDIDATES[setting]
+  out_features, in_features = weight_shape
+  if not options["enable_weight_quantization"]:
+    return 2 * out_features * in_features
+  # Unpacked int4 values are stored one per int8
+  num_bits = options["num_bits_weight"]
+  if num_bits < 8 and not options.get("pack_weight"):
+    num_bits = 8
+  weight_bytes = out_features * in_features * num_bits // 8
+  # bfloat16 scales, one per block or per output channel
+  if options["is_blockwise_weight"]:
+    return weight_bytes + 2 * out_features * in_features // block_size
+  return weight_bytes + 2 * out_features
+
+
+def layer_errors(weight, inputs, block_size: int) -> Dict[str, float]:
+  """Relative output error, 1 - cosine similarity, of every setting of a
+  layer with the [out, in] weight on the [tokens, in] inputs."""
+  weight = jnp.asarray(weight, dtype=jnp.float32)
+  inputs = jnp.asarray(inputs, dtype=jnp.float32)
+  expected = (inputs @ weight.T).ravel()
+  errors = {}
+  for setting, options in CANDIDATES.items():
+    if options.get("is_blockwise_weight") and weight.shape[1] % block_size != 0:
+      continue
+    out = (inputs @ _fake_quantize(weight, setting, block_size).T).ravel()
+    cosine = jnp.dot(out, expected) / jnp.maximum(
+        jnp.linalg.norm(out) * jnp.linalg.norm(expected), 1e-12
+    )
+    errors[setting] = max(float(1 - cosine), 0.0)
+  return errors
+
+
+def select_settings(
+    errors: Dict[str, Dict[str, float]],
+    sizes: Dict[str, Dict[str, int]],
+    max_error: float,
+) -> Dict[str, str]:
+  """Picks a setting per layer with the smallest total size whose mean error
+  is at most max_error.
+
+  Every layer starts at its smallest setting and the layer upgrade with the
+  largest error reduction per added byte is applied until the mean error is
+  under max_error.
+  """
+  frontiers = {}
+  for name, layer_sizes in sizes.items():
+    # Settings no other setting beats on both size and error, smallest first
+    frontier = []
+    for setting in sorted(
+        layer_sizes,
+        key=lambda s, layer_sizes=layer_sizes, name=name: (
+            layer_sizes[s],
+            errors[name][s],
+        ),
+    ):
+      if not frontier or errors[name][setting] < errors[name][frontier[-1]]:
+        frontier.append(setting)
+    frontiers[name] = frontier
+  picked = {name: 0 for name in frontiers}
+
+  def total_error():
+    return sum(errors[name][frontiers[name][i]] for name, i in picked.items())
+
+  budget = max_error * len(picked)
+  while total_error() > budget:
+    best_name, best_gain = None, 0.0
+    for name, i in picked.items():
+      if i + 1 == len(frontiers[name]):
+        continue
+      current, upgrade = frontiers[name][i], frontiers[name][i + 1]
+      gain = (errors[name][current] - errors[name][upgrade]) / (
+          sizes[name][upgrade] - sizes[name][current]
+      )
+      if best_name is None or gain > best_gain:
+        best_name, best_gain = name, gain
+    if best_name is None:
+      break
+    picked[best_name] += 1
+  return {name: frontiers[name][i] for name, i in picked.items()}
+
+
+def record_linear_inputs(
+    engine, params: Any, prompts: Iterable[Sequence[int]], max_tokens: int
+) -> Dict[str, np.ndarray]:
+  """Returns the [tokens, in] inputs of every linear layer of the engine on
+  the prefill of the prompts, at most max_tokens per layer.
+
+  The prompts are sequences of token ids, see kv_calibration.prefill_prompts.
+  The engine must not have compiled prefill yet, since the inputs are
+  recorded while prefill is traced.
+  """
+  pending = {}
+
+  def record(name, x):
+    pending.setdefault(name, []).append(np.asarray(x))
+
+  def observe(name, module, args):
+    del module
+    x = torchjax.from_torch(args[0]).astype(jnp.float32)
+    # Called while tracing, the value is sent back to the host when it runs
+    jax.debug.callback(functools.partial(record, name), x)
+
+  handles = [
+      mod.register_forward_pre_hook(functools.partial(observe, name))
+      for name, mod in engine.pt_model.named_modules()
+      if isinstance(mod, torch.nn.Linear)
+  ]
+  inputs: Dict[str, List[np.ndarray]] = {}
+  try:
+    for prefix, true_length in kv_calibration.prefill_prompts(
+        engine, params, prompts
+    ):
+      jax.block_until_ready(prefix)
+      jax.effects_barrier()
+      for name, values in pending.items():
+        layer_inputs = inputs.setdefault(name, [])
+        for x in values:
+          recorded = sum(len(i) for i in layer_inputs)
+          # Only the prompt tokens of the batch of one, not the padding
+          x = x.reshape(-1, x.shape[-1])[:true_length]
+          layer_inputs.append(x[: max(max_tokens - recorded, 0)])
+      pending.clear()
+  finally:
+    for handle in handles:
+      handle.remove()
+  if not inputs:
+    raise ValueError("No linear layer inputs recorded while planning")
+  return {name: np.concatenate(x) for name, x in inputs.items()}
+
+
+def plan_quantization(
+    engine,
+    params: Any,
+    prompts: Iterable[Sequence[int]],
+    max_error: float,
+    block_size: int = 128,
+    max_tokens: int = 2048,
+) -> QuantizationPlan:
+  """Plans the weight quantization of the linear layers of a float engine.
+
+  max_error bounds the mean over the layers of the relative output error of
+  layer_errors.
+  """
+  inputs = record_linear_inputs(engine, params, prompts, max_tokens)
+  errors, sizes = {}, {}
+  for name, layer_inputs in inputs.items():
+    if f"{name}.weight" not in params:
+      continue
+    weight = params[f"{name}.weight"]
+    errors[name] = layer_errors(weight, layer_inputs, block_size)
+    sizes[name] = {
+        setting: _weight_bytes(weight.shape, setting, block_size)
+        for setting in errors[name]
+    }
+  settings = select_settings(errors, sizes, max_error)
+  return QuantizationPlan(
+      layer_settings=settings,
+      layer_errors={name: errors[name][s] for name, s in settings.items()},
+      weight_bytes=sum(sizes[name][s] for name, s in settings.items()),
+      float_weight_bytes=sum(s["float"] for s in sizes.values()),
+      block_size=block_size,
+  )
+
+
+def save_plan(path: str, plan: QuantizationPlan):
+  """Saves the plan for quantization_plan_path."""
+  with open(path, "w", encoding="utf-8") as f:
+    json.dump(dataclasses.asdict(plan), f, indent=2, sort_keys=True)
+
+
+def load_layer_configs(path: str) -> Dict[str, Dict[str, Any]]:
+  """Loads the QuantizationConfig.layer_configs of a plan saved by
+  save_plan."""
+  with open(path, encoding="utf-8") as f:
+    plan = QuantizationPlan(**json.load(f))
+  return plan.layer_configs
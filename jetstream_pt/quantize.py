@@ -99,6 +99,33 @@ def load_q_weight_helper(w_q, scale, zp=None, block_size=-1):
   return w_q, scale, zp
 
 
+def pack_int4(w: torch.Tensor, axis: int) -> torch.Tensor:
+  """Packs int4 values in an int8 container two per byte along axis.
+
+  The first half of axis goes to the low nibbles and the second half to the
+  high nibbles, so unpacking needs no interleaving.
+  """
+  assert w.shape[axis] % 2 == 0, "Packed axis must have an even size."
+  low, high = torch.chunk(w.to(torch.int8), 2, dim=axis)
+  return torch.bitwise_or(
+      torch.bitwise_and(low, 0x0F), torch.bitwise_left_shift(high, 4)
+  )
+
+
+def pack_int4_jax(w: jax.Array, axis: int) -> jax.Array:
+  """Same as pack_int4 for jax arrays."""
+  assert w.shape[axis] % 2 == 0, "Packed axis must have an even size."
+  low, high = jnp.split(w.astype(jnp.int8), 2, axis=axis)
+  return jnp.bitwise_or(jnp.bitwise_and(low, 0x0F), jnp.left_shift(high, 4))
+
+
+def unpack_int4(packed, axis: int):
+  """Unpacks the int4 values packed by pack_int4 along axis to int8."""
+  low = jnp.right_shift(jnp.left_shift(packed, 4), 4)
+  high = jnp.right_shift(packed, 4)
+  return jnp.concatenate([low, high], axis=axis)
+
+
 def blockwise_jax_kernel(inputs, weight, weight_scaler, zero_point):
   """Blockwise Matmul kernel impl in JAX using einsum"""
   weight = weight.astype(jnp.int8)
@@ -117,6 +144,34 @@ def blockwise_jax_kernel(inputs, weight, weight_scaler, zero_point):
   return out
 
 
+def int8_einsum(subscripts, *operands):
+  """einsum of int8 operands accumulated in int32, returned in float32"""
+  out = jnp.einsum(subscripts, *operands, preferred_element_type=jnp.int32)
+  return out.astype(jnp.float32)
+
+
+def blockwise_jax_kernel_int8(
+    inputs, weight, weight_scaler, zero_point, packed=False
+):
+  """Blockwise Matmul kernel impl in JAX using int8 x int8 einsum, for inputs
+  quantized to int8. The result is in units of the input scale."""
+  if packed:
+    weight = unpack_int4(weight, 1)
+  block_size = weight.shape[1]
+  inputs_shape = inputs.shape
+  inputs_new_shape = inputs_shape[:-1] + (
+      inputs_shape[-1] // block_size,
+      block_size,
+  )
+  inputs = inputs.reshape(inputs_new_shape)
+  out = int8_einsum("scz,bdsc->bdsz", weight.astype(jnp.int8), inputs)
+  out = jnp.einsum("bdsz,sz->bdz", out, weight_scaler.astype(jnp.float32))
+  if zero_point is not None:
+    zp_out = jnp.einsum("bdsc,sz->bdz", inputs.astype(jnp.float32), zero_point)
+    out = out - zp_out
+  return out.astype(weight_scaler.dtype)
+
+
 def blockwise_jax_kernel_dot_general(inputs, weight, weight_scaler, zero_point):
   """Blockwise Matmul kernel impl in JAX using dot general"""
   inputs_shape = inputs.shape
@@ -157,3 +212,24 @@ def blockwise_jax_kernel_einsum_flatten(
   out = jnp.einsum("bsz,sz->bz", out, weight_scaler)
   out = out.reshape((bs, -1) + out.shape[1:])
   return out
+
+
+def blockwise_jax_kernel_packed_int4(inputs, weight, weight_scaler, zero_point):
+  """Blockwise Matmul kernel impl in JAX using einsum, with the int4 weight
+  packed two per byte by pack_int4 along the block axis"""
+  half_block_size = weight.shape[1]
+  low = jnp.right_shift(jnp.left_shift(weight, 4), 4)
+  high = jnp.right_shift(weight, 4)
+  inputs_shape = inputs.shape
+  inputs_new_shape = inputs_shape[:-1] + (
+      inputs_shape[-1] // (2 * half_block_size),
+      2 * half_block_size,
+  )
+  inputs = inputs.reshape(inputs_new_shape)
+  out = jnp.einsum("scz,bdsc->bdsz", low, inputs[..., :half_block_size])
+  out = out + jnp.einsum("scz,bdsc->bdsz", high, inputs[..., half_block_size:])
+  out = jnp.einsum("bdsz,sz->bdz", out, weight_scaler)
+  if zero_point is not None:
+    zp_out = jnp.einsum("bdsc,sz->bdz", inputs, zero_point)
+    out = out - zp_out
+  return out
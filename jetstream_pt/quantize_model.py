@@ -1,13 +1,30 @@
+import dataclasses
+import json
+import os
+
+from safetensors.torch import save_file
 import torch
+from . import activation_calibration
 from .environment import QuantizationConfig
 from .layers import (
     create_quantized_from_nn_linear,
     create_quantized_from_nn_embedding,
+    get_quantized_linear_layer,
     AttentionKernel,
     Int8KVAttentionKernel,
 )
 
 
+def layer_quantization_config(
+    config: QuantizationConfig, name: str
+) -> QuantizationConfig:
+  """Returns the config of the layer called name, with its overrides in
+  config.layer_configs."""
+  if not config.layer_configs or name not in config.layer_configs:
+    return config
+  return dataclasses.replace(config, **config.layer_configs[name])
+
+
 def quantize_model(float_model, config: QuantizationConfig):
   """Apply quantization to linear layers."""
   exclude_mods = None
@@ -17,27 +34,148 @@ def quantize_model(float_model, config: QuantizationConfig):
         for name, module in float_model.named_modules()
         if name in config.exclude_layers
     ]
+  module_names = {id(mod): name for name, mod in float_model.named_modules()}
 
   def quantize_nn_mod(float_model):
+    prefix = module_names.get(id(float_model), "")
     for name, mod in float_model.named_modules():
       new_mod = None
       if config.exclude_layers and mod in exclude_mods:
         continue
+      full_name = ".".join(n for n in (prefix, name) if n)
+      mod_config = layer_quantization_config(config, full_name)
+      if not mod_config.enable_weight_quantization:
+        continue
       if hasattr(mod, "get_quantized_version"):
-        new_mod = mod.get_quantized_version()
+        new_mod = mod.get_quantized_version(mod_config)
       elif isinstance(mod, torch.nn.Linear):
-        new_mod = create_quantized_from_nn_linear(mod, config)
+        new_mod = create_quantized_from_nn_linear(mod, mod_config)
       elif isinstance(mod, torch.nn.Embedding):
-        new_mod = create_quantized_from_nn_embedding(mod, config)
+        new_mod = create_quantized_from_nn_embedding(mod, mod_config)
 
       if new_mod:
         setattr(float_model, name, new_mod)
 
     if config.enable_kv_quantization:
       for name, mod in float_model.__dict__.items():
-        if isinstance(mod, AttentionKernel):
+        if isinstance(mod, AttentionKernel) and not mod.env.kv_quantize_static:
           new_mod = Int8KVAttentionKernel(mod.env, mod.layer_id)
           setattr(float_model, name, new_mod)
 
   float_model.apply(quantize_nn_mod)
+  load_activation_scales(float_model, config)
   return float_model
+
+
+def apply_layer_configs(model, config: QuantizationConfig):
+  """Gives the linear layers of a model constructed with config their own
+  layer_configs or exclude_layers config.
+
+  The model constructors use one config for every layer, so the layers with
+  another one are replaced on the meta device, to load the weights saved by
+  save_quantized_checkpoint.
+  """
+  exclude_layers = set(config.exclude_layers or ())
+  for name in sorted(set(config.layer_configs or ()) | exclude_layers):
+    parent_name, _, child_name = name.rpartition(".")
+    parent = model.get_submodule(parent_name)
+    mod = getattr(parent, child_name)
+    if not hasattr(mod, "in_features"):
+      continue
+    mod_config = layer_quantization_config(config, name)
+    if name in exclude_layers:
+      mod_config = dataclasses.replace(
+          mod_config, enable_weight_quantization=False
+      )
+    linear_layer = get_quantized_linear_layer(mod_config)
+    linear_kwargs = {}
+    if linear_layer != torch.nn.Linear:
+      linear_kwargs = {"quant_config": mod_config}
+    setattr(
+        parent,
+        child_name,
+        linear_layer(
+            mod.in_features,
+            mod.out_features,
+            bias=False,
+            device="meta",
+            **linear_kwargs,
+        ),
+    )
+
+
+def load_activation_scales(model, config: QuantizationConfig):
+  """Sets the static activation scales of config.activation_scales_path."""
+  if config.enable_activation_quantization and config.activation_scales_path:
+    activation_calibration.apply_activation_scales(
+        model,
+        activation_calibration.load_activation_scales(
+            config.activation_scales_path
+        ),
+    )
+
+
+QUANTIZATION_CONFIG_FILE = "quantization_config.json"
+
+# Fields of QuantizationConfig that determine the layout of the weights
+_WEIGHT_QUANTIZATION_FIELDS = (
+    "enable_weight_quantization",
+    "num_bits_weight",
+    "is_blockwise_weight",
+    "block_size_weight",
+    "is_symmetric_weight",
+    "pack_weight",
+    "exclude_layers",
+    "layer_configs",
+)
+
+
+def save_quantized_checkpoint(
+    model, config: QuantizationConfig, path, max_shard_bytes=4 << 30
+):
+  """Saves the weights of a quantized model as safetensors shards.
+
+  The weights, scalers and zero points are saved under their state_dict
+  names, next to the weight quantization config, so that a model constructed
+  with that config loads them without quantizing again.
+  """
+  os.makedirs(path, exist_ok=True)
+  shards = [{}]
+  shard_bytes = 0
+  for key, value in model.state_dict().items():
+    if key == "freqs_cis":
+      continue
+    if value.device.type == "meta":
+      raise ValueError(f"Weight {key} is not loaded")
+    size = value.numel() * value.element_size()
+    if shards[-1] and shard_bytes + size > max_shard_bytes:
+      shards.append({})
+      shard_bytes = 0
+    # safetensors does not save tied or strided tensors
+    shards[-1][key] = value.detach().contiguous().clone()
+    shard_bytes += size
+  for i, shard in enumerate(shards):
+    save_file(
+        shard,
+        os.path.join(
+            path, f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+        ),
+    )
+  weight_config = {
+      name: getattr(config, name) for name in _WEIGHT_QUANTIZATION_FIELDS
+  }
+  with open(
+      os.path.join(path, QUANTIZATION_CONFIG_FILE), "w", encoding="utf-8"
+  ) as f:
+    json.dump(weight_config, f, indent=2)
+
+
+def load_quantization_config(
+    path, config: QuantizationConfig
+) -> QuantizationConfig:
+  """Returns config with the weight quantization of a saved checkpoint."""
+  with open(
+      os.path.join(path, QUANTIZATION_CONFIG_FILE), encoding="utf-8"
+  ) as f:
+    weight_config = json.load(f)
+  return dataclasses.replace(config, **weight_config)
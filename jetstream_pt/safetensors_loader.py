@@ -0,0 +1,122 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory mapped safetensors loading straight to the device shards.
+
+Every shard of the checkpoint is memory mapped and each tensor is built with
+jax.make_array_from_callback, so every device only reads its own slice of the
+file. Tensors load in a thread pool; a worker holds at most one tensor on the
+host at a time, so peak host memory is bounded by max_workers times the size
+of the largest tensor instead of the size of the checkpoint.
+"""
+
+import concurrent.futures
+import glob
+import json
+import os
+import struct
+from typing import Any, Callable, Dict, List, Optional
+
+import jax
+from jax import numpy as jnp
+import ml_dtypes
+import numpy as np
+
+_DTYPES = {
+    "BOOL": np.bool_,
+    "U8": np.uint8,
+    "I8": np.int8,
+    "I16": np.int16,
+    "I32": np.int32,
+    "I64": np.int64,
+    "F16": np.float16,
+    "BF16": ml_dtypes.bfloat16,
+    "F32": np.float32,
+    "F64": np.float64,
+    "F8_E4M3": ml_dtypes.float8_e4m3fn,
+    "F8_E5M2": ml_dtypes.float8_e5m2,
+}
+
+
+def list_shards(path: str) -> List[str]:
+  """Returns the safetensors files of a checkpoint file or directory."""
+  path = str(path)
+  if os.path.isdir(path):
+    return sorted(glob.glob(os.path.join(path, "*.safetensors")))
+  return [path]
+
+
+def _read_header(path):
+  with open(path, "rb") as f:
+    (header_size,) = struct.unpack("<Q", f.read(8))
+    header = json.loads(f.read(header_size))
+  header.pop("__metadata__", None)
+  return 8 + header_size, header
+
+
+class SafetensorsCheckpoint:
+  """Memory maps the tensors of all the shards of a checkpoint."""
+
+  def __init__(self, path: str):
+    self._tensors = {}
+    for shard in list_shards(path):
+      data_start, header = _read_header(shard)
+      if not header:
+        continue
+      data = np.memmap(shard, dtype=np.uint8, mode="r")
+      for key, info in header.items():
+        begin, end = info["data_offsets"]
+        self._tensors[key] = (
+            data[data_start + begin : data_start + end]
+            .view(_DTYPES[info["dtype"]])
+            .reshape(info["shape"])
+        )
+
+  def keys(self):
+    """Returns the names of the tensors of all the shards."""
+    return self._tensors.keys()
+
+  def __contains__(self, key):
+    return key in self._tensors
+
+  def get_tensor(self, key: str) -> np.ndarray:
+    """Returns the memory mapped tensor, read lazily when indexed."""
+    return self._tensors[key]
+
+
+def load_sharded(
+    checkpoint: SafetensorsCheckpoint,
+    keys: List[str],
+    sharding_fn: Callable[[str], jax.sharding.Sharding],
+    dtype: Optional[Any] = None,
+    max_workers: Optional[int] = None,
+) -> Dict[str, jax.Array]:
+  """Loads the keys to the devices with the sharding of sharding_fn(key).
+
+  If dtype is set, floating point tensors are cast to it on the host, one
+  device shard at a time.
+  """
+
+  def load(key):
+    tensor = checkpoint.get_tensor(key)
+    cast = dtype is not None and jnp.issubdtype(tensor.dtype, jnp.floating)
+
+    def read(index):
+      shard = np.asarray(tensor[index])
+      return shard.astype(dtype) if cast else shard
+
+    return jax.make_array_from_callback(tensor.shape, sharding_fn(key), read)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    return dict(zip(keys, executor.map(load, keys)))
@@ -0,0 +1,182 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the transformer layers with jax.lax.scan instead of unrolling them.
+
+The weights of all the layers are stacked once at load time, under the
+SCANNED_PREFIX keys, and the model runs its first layer as a template once per
+scan iteration with that layer's weights and kv cache swapped in. XLA then
+compiles one layer instead of num_layers.
+"""
+
+import copy
+import re
+from typing import Any, Callable, Dict, List, Tuple
+
+import jax
+from jax import numpy as jnp
+import torch
+
+from jetstream_pt import torchjax
+
+SCANNED_PREFIX = "scanned_layers."
+
+# Cache attributes that hold per layer (or stacked) kv state
+_CACHE_STATE_ATTRS = ("cache_k", "cache_v", "new_ks", "new_vs")
+
+_LAYER_KEY = re.compile(r"^layers\.(\d+)\.(.+)$")
+
+
+def stack_layer_weights(weights: Dict[str, Any], num_layers: int):
+  """Stacks the per layer weights "layers.{i}.{name}" along a new axis 0.
+
+  The stacked weights are stored as SCANNED_PREFIX + name and keep the
+  sharding of the per layer weights on the other axes. Other weights are
+  returned unchanged.
+  """
+  result = {}
+  names = []
+  for key, value in weights.items():
+    match = _LAYER_KEY.match(key)
+    if match is None:
+      result[key] = value
+    elif match.group(1) == "0":
+      names.append(match.group(2))
+  for name in names:
+    values = [weights[f"layers.{i}.{name}"] for i in range(num_layers)]
+    sharding = getattr(values[0], "sharding", None)
+    out_sharding = None
+    if isinstance(sharding, jax.sharding.NamedSharding):
+      out_sharding = jax.sharding.NamedSharding(
+          sharding.mesh, jax.sharding.PartitionSpec(None, *sharding.spec)
+      )
+    result[SCANNED_PREFIX + name] = jax.jit(
+        jnp.stack, out_shardings=out_sharding
+    )(values)
+  return result
+
+
+def split_scanned_weights(weights: Dict[str, Any]):
+  """Splits the weights into the model weights and the stacked layer weights.
+
+  Returns (weights, None) if the layers are not stacked.
+  """
+  layer_weights = {
+      key[len(SCANNED_PREFIX) :]: value
+      for key, value in weights.items()
+      if key.startswith(SCANNED_PREFIX)
+  }
+  if not layer_weights:
+    return weights, None
+  weights = {
+      key: value
+      for key, value in weights.items()
+      if not key.startswith(SCANNED_PREFIX)
+  }
+  return weights, layer_weights
+
+
+def _cache_state(cache):
+  return {
+      attr: getattr(cache, attr)
+      for attr in _CACHE_STATE_ATTRS
+      if isinstance(getattr(cache, attr, None), torch.Tensor)
+  }
+
+
+def _set_layer_id(layer: torch.nn.Module, layer_id):
+  for module in layer.modules():
+    if hasattr(module, "layer_id"):
+      module.layer_id = layer_id
+    # The attention kernels are plain objects with their own layer id
+    kernel = getattr(module, "attention_kernel", None)
+    if hasattr(kernel, "layer_id"):
+      kernel.layer_id = layer_id
+
+
+def scan_layers(
+    layers: List[torch.nn.Module],
+    layer_weights: Dict[str, Any],
+    x: torch.Tensor,
+    caches: List[Any],
+    layer_args: Callable[[torch.Tensor, Any], Tuple[tuple, dict]],
+) -> torch.Tensor:
+  """Runs x through all the layers with one jax.lax.scan.
+
+  layers must be structurally identical, layers[0] is called with the
+  weights of each layer in turn and the (args, kwargs) returned by
+  layer_args(x, cache). layer_weights are the stacked weights, see
+  stack_layer_weights.
+
+  A stacked generate cache (caches[0].stacked) is carried through the scan
+  and indexed by the layer id like in the unrolled model. Per layer caches
+  are stacked into the scan inputs and written back after the scan, which
+  copies them, so they are only used by prefill: the engine requires
+  generate_cache_stacked with scan_layers.
+  """
+  template = layers[0]
+  stacked = caches[0].stacked
+  num_layers = len(layers)
+
+  if stacked:
+    carry_cache = torchjax.from_torch(_cache_state(caches[0]))
+    xs_cache = None
+  else:
+    carry_cache = None
+    # Fresh prefill caches have no state yet
+    states = [_cache_state(c) for c in caches]
+    xs_cache = {
+        attr: jnp.stack([torchjax.from_torch(s[attr]) for s in states])
+        for attr in states[0]
+    }
+
+  def body(carry, xs):
+    h, cache_state = carry
+    weights, layer_cache_state, layer_id = xs
+    cache = copy.copy(caches[0])
+    state = cache_state if stacked else layer_cache_state
+    for attr, value in torchjax.to_torch(state).items():
+      setattr(cache, attr, value)
+
+    _set_layer_id(template, torchjax.to_torch(layer_id))
+    args, kwargs = layer_args(torchjax.to_torch(h), cache)
+    h = torch.func.functional_call(
+        template, torchjax.to_torch(weights), args, kwargs
+    )
+    new_state = torchjax.from_torch(_cache_state(cache))
+    if stacked:
+      return (torchjax.from_torch(h), new_state), None
+    return (torchjax.from_torch(h), None), new_state
+
+  try:
+    (h, carry_cache), ys_cache = jax.lax.scan(
+        body,
+        (torchjax.from_torch(x), carry_cache),
+        (
+            torchjax.from_torch(layer_weights),
+            xs_cache,
+            jnp.arange(num_layers),
+        ),
+    )
+  finally:
+    _set_layer_id(template, 0)
+
+  if stacked:
+    for attr, value in torchjax.to_torch(carry_cache).items():
+      setattr(caches[0], attr, value)
+  else:
+    for i, cache in enumerate(caches):
+      for attr, value in ys_cache.items():
+        setattr(cache, attr, torchjax.to_torch(value[i]))
+  return torchjax.to_torch(h)
@@ -0,0 +1,584 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Speculative decoding with a draft model or prompt lookup."""
+
+import functools
+from typing import Any, Optional, Tuple, Union, Callable
+
+from flax import struct
+import jax
+from jax import numpy as jnp
+
+from jetstream.engine import engine_api, tokenizer_api, tokenizer_pb2
+from jetstream_pt.engine import DecodeState, Prefix, PyTorchEngine
+
+Params = Any
+
+
+@struct.dataclass
+# pylint: disable-next=all
+class TokenHistory:
+  """The prompt and output tokens, for prompt lookup."""
+
+  tokens: jax.Array  # [batch_size, history_len], or [seqlen] in a prefix
+  length: jax.Array  # [batch_size], or the true length in a prefix
+
+
+@struct.dataclass
+# pylint: disable-next=all
+class SpeculativePrefix:
+  target: Prefix
+  draft: Union[Prefix, TokenHistory]
+
+
+@struct.dataclass
+# pylint: disable-next=all
+class SpeculativeDecodeState:
+  target: DecodeState
+  draft: Union[DecodeState, TokenHistory]
+  # Verified tokens not emitted yet, see SpeculativeEngine.generate_impl
+  pending_tokens: jax.Array  # [batch_size, 2 * (num_speculative_tokens + 1)]
+  num_pending: jax.Array  # [batch_size]
+
+
+def lookup_ngram(
+    history: jax.Array,
+    length: jax.Array,
+    max_ngram_size: int,
+    num_tokens: int,
+) -> jax.Array:
+  """Proposes tokens by matching the last n-gram earlier in the history.
+
+  For every slot, finds the latest earlier occurrence of the last n tokens of
+  history[:length] and returns the num_tokens that followed it, trying n from
+  max_ngram_size down to 1. Slots without any match repeat their last token.
+  Returns [batch_size, num_tokens].
+  """
+  history_len = history.shape[1]
+  last_token = jnp.take_along_axis(history, (length - 1)[:, None], axis=1)
+  proposals = jnp.broadcast_to(last_token, (history.shape[0], num_tokens))
+  found = jnp.zeros((history.shape[0],), dtype=jnp.bool_)
+  for ngram_size in range(max_ngram_size, 0, -1):
+    num_starts = history_len - ngram_size
+    ngram_pos = length[:, None] - ngram_size + jnp.arange(ngram_size)
+    ngram = jnp.take_along_axis(history, jnp.maximum(ngram_pos, 0), axis=1)
+    starts = jnp.arange(num_starts)
+    # The match should end before the last token so there's a continuation
+    match = starts[None, :] < (length - ngram_size)[:, None]
+    for j in range(ngram_size):
+      match &= history[:, j : j + num_starts] == ngram[:, j : j + 1]
+    start = jnp.max(jnp.where(match, starts[None, :], -1), axis=1)
+    cont_pos = start[:, None] + ngram_size + jnp.arange(num_tokens)
+    cont = jnp.take_along_axis(
+        history, jnp.minimum(cont_pos, history_len - 1), axis=1
+    )
+    use = (start >= 0) & ~found
+    proposals = jnp.where(use[:, None], cont, proposals)
+    found |= start >= 0
+  return proposals
+
+
+def _check_env(env, name):
+  if not env.ring_buffer:
+    raise ValueError(f"Speculative decoding needs ring_buffer on the {name}")
+  if (
+      env.lazy_cache_update
+      or env.page_attention
+      or env.ragged_mha
+      or env.quant_config.enable_kv_quantization
+  ):
+    raise ValueError(
+        "Speculative decoding doesn't support lazy_cache_update, page "
+        f"attention, ragged_mha or kv quantization, see the {name} env"
+    )
+
+
+def _commit_tokens(
+    decode_state: DecodeState,
+    caches,
+    next_token: jax.Array,
+    num_kept: jax.Array,
+    num_tokens: int,
+    cache_len: int,
+) -> DecodeState:
+  """Keeps the first num_kept of the num_tokens speculated columns.
+
+  decode_state is the state before the speculation. The cache columns of the
+  rejected tokens are masked out and input_pos/lens only advance by the kept
+  tokens, RoPE only depends on relative positions so the gap left in the ring
+  buffer is harmless. Slots keeping no column keep their pending token.
+
+  The slots share current_position, so it advances past the longest kept run
+  of the batch and the columns after it are written again on the next step.
+  Slots keeping fewer tokens leave masked gaps: in the worst case a slot keeps
+  one token per step and only attends to its last cache_len / num_tokens
+  tokens, instead of cache_len.
+  """
+  offsets = jnp.arange(num_tokens)
+  columns = (decode_state.current_position + offsets) % cache_len
+  kept = offsets[None, :] < num_kept[:, None]
+  mask = decode_state.mask.at[:, columns].set(
+      jnp.where(kept, 0, float("-inf")).astype(decode_state.mask.dtype)
+  )
+  num_columns = jnp.max(num_kept)
+  return decode_state.replace(
+      tokens=jnp.where(num_kept[:, None] > 0, next_token, decode_state.tokens),
+      caches=caches,
+      current_position=(decode_state.current_position + num_columns)
+      % cache_len,
+      lens=decode_state.lens + num_kept[:, None],
+      input_pos=decode_state.input_pos + num_kept,
+      mask=mask,
+  )
+
+
+# pylint: disable-next=all
+class SpeculativeEngine(engine_api.Engine):
+  """Speculative decoding with a small draft model.
+
+  Every speculative step the draft model proposes num_speculative_tokens
+  tokens one at a time, then the target model scores all of them in one
+  forward over its kv cache. The longest prefix of the proposals the target
+  agrees with is kept, plus one token sampled from the target, so each step
+  keeps between 1 and num_speculative_tokens + 1 tokens per slot. Every
+  generate call emits num_speculative_tokens + 1 tokens per slot, see
+  generate_impl. With greedy sampling the
+  output is the same as the target's alone; with weighted sampling, the
+  proposals are accepted with rejection sampling, which preserves the target
+  distribution.
+
+  Both models must share the tokenizer and use the same batch size, cache
+  length and starting position. Params, prefixes and decode states hold a
+  (target, draft) pair.
+
+  Without a draft model, the proposals come from prompt lookup instead: the
+  tokens that followed the latest earlier occurrence of the slot's last
+  n-gram in its prompt and output, see lookup_ngram. The draft part of the
+  decode state is then the TokenHistory of each slot.
+  """
+
+  def __init__(
+      self,
+      target: PyTorchEngine,
+      draft: Optional[PyTorchEngine] = None,
+      num_speculative_tokens: int = 4,
+      max_ngram_size: int = 3,
+  ):
+    if num_speculative_tokens <= 0:
+      raise ValueError(
+          "num_speculative_tokens should be positive, got "
+          f"{num_speculative_tokens}"
+      )
+    _check_env(target.env, "target")
+    if draft is not None:
+      _check_env(draft.env, "draft")
+      for attr in ("batch_size", "cache_sequence_length", "starting_position"):
+        if getattr(target.env, attr) != getattr(draft.env, attr):
+          raise ValueError(f"The target and draft {attr} should be the same")
+    if target.env.sampling_algorithm not in ("greedy", "weighted"):
+      raise NotImplementedError(
+          "Speculative decoding only supports greedy and weighted sampling, "
+          f"got {target.env.sampling_algorithm}"
+      )
+
+    self.target = target
+    self.draft = draft
+    self.env = target.env
+    self.num_speculative_tokens = num_speculative_tokens
+    self.max_ngram_size = max_ngram_size
+    self.history_len = target.max_prefill_length + target.max_decode_length
+    self._insert_history_jit = jax.jit(
+        self._insert_history,
+        donate_argnums=(1,),
+        out_shardings=self._history_sharding(),
+    )
+    self._generate_jit = jax.jit(
+        self.generate_impl,
+        donate_argnums=(1,),
+        out_shardings=(self.get_decode_state_sharding(), None),
+    )
+
+  def load_params(self, *args, **kwargs) -> Params:
+    """Loads the (target, draft) params, draft is None for prompt lookup."""
+    if self.draft is None:
+      return (self.target.load_params(*args, **kwargs), None)
+    return (
+        self.target.load_params(*args, **kwargs),
+        self.draft.load_params(*args, **kwargs),
+    )
+
+  def init_decode_state(self, *args, **kwargs) -> SpeculativeDecodeState:
+    """Inits the (target, draft) decode states, see SpeculativeEngine."""
+    if self.draft is None:
+      batch_size = self.env.batch_size
+      draft_state = TokenHistory(
+          jnp.zeros((batch_size, self.history_len), dtype=jnp.int32),
+          jnp.zeros((batch_size,), dtype=jnp.int32),
+      )
+    else:
+      draft_state = self.draft.init_decode_state(*args, **kwargs)
+    num_emitted = self.num_speculative_tokens + 1
+    return SpeculativeDecodeState(
+        self.target.init_decode_state(*args, **kwargs),
+        draft_state,
+        jnp.zeros((self.env.batch_size, 2 * num_emitted), dtype=jnp.int32),
+        jnp.zeros((self.env.batch_size,), dtype=jnp.int32),
+    )
+
+  def prefill(
+      self,
+      *,
+      params: Params,
+      existing_prefix: Optional[SpeculativePrefix] = None,
+      padded_tokens: jax.Array,
+      true_length: int,
+      sampler: Optional[Callable[[Any], Any]] = None,
+  ) -> Tuple[SpeculativePrefix, engine_api.ResultTokens]:
+    target_params, draft_params = params
+    target_existing = draft_existing = None
+    if existing_prefix is not None:
+      target_existing, draft_existing = (
+          existing_prefix.target,
+          existing_prefix.draft,
+      )
+    target_prefix, result = self.target.prefill(
+        params=target_params,
+        existing_prefix=target_existing,
+        padded_tokens=padded_tokens,
+        true_length=true_length,
+        sampler=sampler,
+    )
+    if self.draft is None:
+      draft_prefix = TokenHistory(padded_tokens, true_length)
+      return SpeculativePrefix(target_prefix, draft_prefix), result
+    draft_prefix, _ = self.draft.prefill(
+        params=draft_params,
+        existing_prefix=draft_existing,
+        padded_tokens=padded_tokens,
+        true_length=true_length,
+    )
+    # The draft continues from the target's first token, a copy since insert
+    # donates the prefixes
+    draft_prefix = draft_prefix.replace(token=jnp.copy(target_prefix.token))
+    return SpeculativePrefix(target_prefix, draft_prefix), result
+
+  def insert(
+      self,
+      prefix: SpeculativePrefix,
+      decode_state: SpeculativeDecodeState,
+      slot: int,
+  ) -> SpeculativeDecodeState:
+    # The history reads the target prefix, which the target insert donates
+    if self.draft is None:
+      draft_state = self._insert_history_jit(prefix, decode_state.draft, slot)
+    else:
+      draft_state = self.draft.insert(prefix.draft, decode_state.draft, slot)
+    target_state = self.target.insert(prefix.target, decode_state.target, slot)
+    return SpeculativeDecodeState(
+        target_state,
+        draft_state,
+        decode_state.pending_tokens,
+        decode_state.num_pending.at[slot].set(0),
+    )
+
+  def _insert_history(
+      self, prefix: SpeculativePrefix, history: TokenHistory, slot: int
+  ) -> TokenHistory:
+    """Writes the prompt and the first generated token into the slot."""
+    prompt = prefix.draft.tokens
+    length = prefix.draft.length
+    row = jnp.zeros((self.history_len,), dtype=jnp.int32)
+    row = row.at[: prompt.shape[0]].set(prompt.astype(jnp.int32))
+    row = row.at[length].set(prefix.target.token.reshape(()))
+    return TokenHistory(
+        history.tokens.at[slot].set(row),
+        history.length.at[slot].set(length + 1),
+    )
+
+  def _propose(self, draft_params, draft_state: DecodeState, key):
+    """Runs the draft num_speculative_tokens + 1 steps.
+
+    The last step only writes the kv of the last proposal so the draft cache
+    is complete when all the proposals are accepted. Returns the new draft
+    state, the proposed tokens [batch_size, num_speculative_tokens] and their
+    draft probabilities [batch_size, num_speculative_tokens, vocab].
+    """
+    tokens = []
+    logits = []
+
+    def sampler(step_logits):
+      logits.append(step_logits)
+      if self.env.sampling_algorithm == "greedy":
+        token = jnp.argmax(step_logits, axis=-1)
+      else:
+        token = jax.random.categorical(
+            jax.random.fold_in(key, len(logits)),
+            step_logits / self.env.temperature,
+        )
+      token = token.reshape(-1, 1).astype(jnp.int32)
+      tokens.append(token)
+      return token
+
+    for _ in range(self.num_speculative_tokens + 1):
+      draft_state, _ = self.draft.generate_impl(
+          draft_params, draft_state, sampler=sampler
+      )
+    k = self.num_speculative_tokens
+    draft_probs = None
+    if self.env.sampling_algorithm != "greedy":
+      draft_probs = jax.nn.softmax(
+          jnp.stack(logits[:k], axis=1).astype(jnp.float32)
+          / self.env.temperature,
+          axis=-1,
+      )
+    return draft_state, jnp.concatenate(tokens[:k], axis=1), draft_probs
+
+  def _accept(self, logits, proposals, draft_probs, key):
+    """Returns the number of accepted proposals and the token after them."""
+    k = self.num_speculative_tokens
+    batch = jnp.arange(proposals.shape[0])
+    if self.env.sampling_algorithm == "greedy":
+      target_tokens = jnp.argmax(logits, axis=-1)
+      match = (proposals == target_tokens[:, :k]).astype(jnp.int32)
+      num_accepted = jnp.cumprod(match, axis=1).sum(axis=1)
+      return num_accepted, target_tokens[batch, num_accepted]
+
+    temperature = self.env.temperature
+    probs = jax.nn.softmax(logits.astype(jnp.float32) / temperature, axis=-1)
+    p = jnp.take_along_axis(probs[:, :k], proposals[..., None], axis=-1)
+    q = jnp.take_along_axis(draft_probs, proposals[..., None], axis=-1)
+    accept_key, sample_key = jax.random.split(key)
+    u = jax.random.uniform(accept_key, p.shape[:2])
+    match = (u * q[..., 0] < p[..., 0]).astype(jnp.int32)
+    num_accepted = jnp.cumprod(match, axis=1).sum(axis=1)
+
+    # Sample the first rejected position from max(p - q, 0), or from p
+    # after the last proposal
+    draft_probs = jnp.pad(draft_probs, ((0, 0), (0, 1), (0, 0)))
+    residual = jnp.maximum(probs - draft_probs, 0)[batch, num_accepted]
+    next_token = jax.random.categorical(sample_key, jnp.log(residual))
+    return num_accepted, next_token
+
+  def _speculate(
+      self, params: Params, decode_state: SpeculativeDecodeState
+  ) -> SpeculativeDecodeState:
+    """Proposes, verifies and commits the tokens of one speculative step.
+
+    Only the slots with fewer than num_speculative_tokens + 1 pending tokens
+    keep tokens, their pending target token and the accepted proposals are
+    appended to their pending tokens.
+    """
+    target_params, draft_params = params
+    target_state, draft_state = decode_state.target, decode_state.draft
+    k = self.num_speculative_tokens
+    key = jax.random.fold_in(self.target.rng, target_state.current_position)
+    draft_key, accept_key = jax.random.split(key)
+
+    if self.draft is None:
+      proposals = lookup_ngram(
+          draft_state.tokens, draft_state.length, self.max_ngram_size, k
+      )
+      draft_probs = None
+    else:
+      new_draft_state, proposals, draft_probs = self._propose(
+          draft_params, draft_state, draft_key
+      )
+    # The pending token plus the proposals
+    tokens = jnp.concatenate([target_state.tokens, proposals], axis=1)
+    logits, target_caches = self.target.verify_impl(
+        target_params, target_state, tokens
+    )
+    if draft_probs is None and self.env.sampling_algorithm != "greedy":
+      # Prompt lookup proposals are deterministic
+      draft_probs = jax.nn.one_hot(proposals, logits.shape[-1])
+    num_accepted, next_token = self._accept(
+        logits, proposals, draft_probs, accept_key
+    )
+    next_token = next_token.reshape(-1, 1).astype(jnp.int32)
+    num_kept = jnp.where(decode_state.num_pending < k + 1, num_accepted + 1, 0)
+
+    cache_len = self.env.cache_sequence_length
+    new_target_state = _commit_tokens(
+        target_state, target_caches, next_token, num_kept, k + 1, cache_len
+    )
+    if self.draft is None:
+      new_draft_state = self._append_history(
+          draft_state, proposals, next_token, num_kept
+      )
+    else:
+      new_draft_state = _commit_tokens(
+          draft_state,
+          new_draft_state.caches,
+          next_token,
+          num_kept,
+          k + 1,
+          cache_len,
+      )
+
+    # Same as generate_impl, the tokens are emitted one step late: the pending
+    # token and the accepted proposals
+    offsets = jnp.arange(k + 1)
+    positions = jnp.where(
+        offsets[None, :] < num_kept[:, None],
+        decode_state.num_pending[:, None] + offsets,
+        decode_state.pending_tokens.shape[1],
+    )
+    batch = jnp.arange(tokens.shape[0])[:, None]
+    pending_tokens = decode_state.pending_tokens.at[batch, positions].set(
+        tokens, mode="drop"
+    )
+    return SpeculativeDecodeState(
+        new_target_state,
+        new_draft_state,
+        pending_tokens,
+        decode_state.num_pending + num_kept,
+    )
+
+  def generate_impl(
+      self,
+      params: Params,
+      decode_state: SpeculativeDecodeState,
+  ) -> Tuple[SpeculativeDecodeState, engine_api.ResultTokens]:
+    """Emits num_speculative_tokens + 1 verified tokens per slot.
+
+    JetStream ends a request at its first invalid token, so every slot emits
+    the same number of valid tokens. Speculative steps run until every slot
+    has that many pending tokens, the slots that already have them keep none,
+    and the tokens left over are emitted by the next call.
+    """
+    num_emitted = self.num_speculative_tokens + 1
+    decode_state = jax.lax.while_loop(
+        lambda state: jnp.any(state.num_pending < num_emitted),
+        functools.partial(self._speculate, params),
+        decode_state,
+    )
+    tokens = decode_state.pending_tokens[:, :num_emitted]
+    num_pending = decode_state.num_pending - num_emitted
+    pending_tokens = jnp.pad(
+        decode_state.pending_tokens[:, num_emitted:],
+        ((0, 0), (0, num_emitted)),
+    )
+    # The lengths up to the emitted tokens
+    lens = decode_state.target.lens - num_pending[:, None]
+    valid = jnp.ones_like(tokens)
+    data = jnp.concatenate([tokens, valid, lens], axis=-1)
+    result_tokens = engine_api.ResultTokens(
+        data=data,
+        tokens_idx=(0, num_emitted),
+        valid_idx=(num_emitted, 2 * num_emitted),
+        length_idx=(2 * num_emitted, 2 * num_emitted + 1),
+        samples_per_slot=1,
+    )
+    return (
+        decode_state.replace(
+            pending_tokens=pending_tokens, num_pending=num_pending
+        ),
+        result_tokens,
+    )
+
+  def _append_history(
+      self,
+      history: TokenHistory,
+      proposals: jax.Array,
+      next_token: jax.Array,
+      num_kept: jax.Array,
+  ) -> TokenHistory:
+    """Appends the num_kept - 1 accepted proposals and the next token to the
+    history."""
+    k = self.num_speculative_tokens
+    offsets = jnp.arange(k + 1)
+    # The accepted proposals, then the next token at offset num_kept - 1
+    new_tokens = jnp.concatenate([proposals, next_token], axis=1)
+    new_tokens = jnp.where(
+        offsets[None, :] == num_kept[:, None] - 1, next_token, new_tokens
+    )
+    positions = history.length[:, None] + offsets
+    # Rejected offsets and positions past the end are dropped
+    positions = jnp.where(
+        offsets[None, :] < num_kept[:, None], positions, self.history_len
+    )
+    batch = jnp.arange(history.tokens.shape[0])[:, None]
+    tokens = history.tokens.at[batch, positions].set(new_tokens, mode="drop")
+    length = jnp.minimum(history.length + num_kept, self.history_len)
+    return TokenHistory(tokens, length)
+
+  def generate(
+      self, params: Params, decode_state: SpeculativeDecodeState
+  ) -> Tuple[SpeculativeDecodeState, engine_api.ResultTokens]:
+    return self._generate_jit(params, decode_state)
+
+  def get_tokenizer(self) -> tokenizer_pb2.TokenizerParameters:
+    return self.target.get_tokenizer()
+
+  def build_tokenizer(
+      self, metadata: tokenizer_pb2.TokenizerParameters
+  ) -> tokenizer_api.Tokenizer:
+    return self.target.build_tokenizer(metadata)
+
+  def join_prefixes(self, *args, **kwargs):
+    """Not supported, the draft prefixes would need joining as well."""
+    raise NotImplementedError("join_prefixes is not supported")
+
+  @property
+  def colocated_cpus(self) -> Union[list[engine_api.CpuDevices], None]:
+    return self.target.colocated_cpus
+
+  def _history_sharding(self) -> TokenHistory:
+    return TokenHistory(self.target.replicated, self.target.replicated)
+
+  def get_prefix_destination_sharding(self) -> SpeculativePrefix:
+    return SpeculativePrefix(
+        self.target.get_prefix_destination_sharding(),
+        self._history_sharding()
+        if self.draft is None
+        else self.draft.get_prefix_destination_sharding(),
+    )
+
+  def get_decode_state_sharding(self) -> SpeculativeDecodeState:
+    """The (target, draft) decode state shardings."""
+    return SpeculativeDecodeState(
+        self.target.get_decode_state_sharding(),
+        self._history_sharding()
+        if self.draft is None
+        else self.draft.get_decode_state_sharding(),
+        self.target.replicated,
+        self.target.replicated,
+    )
+
+  def get_prefix_sequence_ddim(self) -> Any:
+    """Returns the index of the sequence dim in the prefix type."""
+    return self.get_prefix_destination_sharding()
+
+  @property
+  def max_concurrent_decodes(self) -> int:
+    return self.target.max_concurrent_decodes
+
+  @property
+  def samples_per_slot(self) -> int:
+    return self.target.samples_per_slot
+
+  @property
+  def max_prefill_length(self) -> int:
+    return self.target.max_prefill_length
+
+  @property
+  def max_decode_length(self) -> int:
+    """Maximum decode length."""
+    return self.target.max_decode_length
+
+  @property
+  def mesh(self):
+    """The mesh of the target engine."""
+    return self.target.mesh
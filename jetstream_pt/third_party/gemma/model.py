@@ -21,6 +21,9 @@ from typing import Any, List
 from . import config as gemma_config
 
 from jetstream_pt import layers
+from jetstream_pt import quantize
+from jetstream_pt import scan_layers
+from jetstream_pt import torchjax
 from jetstream_pt.model_base import ModuleBase
 import jax
 
@@ -148,6 +151,7 @@ class GemmaAttention(ModuleBase):
     Kernel = (
         layers.Int8KVAttentionKernel
         if env.quant_config.enable_kv_quantization
+        and not env.kv_quantize_static
         else layers.AttentionKernel
     )
     self.attention_kernel = Kernel(env, layer_id)
@@ -385,6 +389,10 @@ class GemmaModel(ModuleBase):
     self.hf_name("layers", "model.layers")
     self.hf_name("norm", "model.norm")
 
+    # The int8 lm head input, see layers.quantize_activation_int8
+    self.static_activation_scales = {}
+    self.activation_observer = None
+
     rope_theta = getattr(config, "rope_theta", 10000)
     freqs_cis = precompute_freqs_cis(
         config.head_dim, config.max_position_embeddings * 2, theta=rope_theta
@@ -401,6 +409,8 @@ class GemmaModel(ModuleBase):
       start=None,
       ragged_batch_index=None,
       ragged_block_index=None,
+      output_positions=None,
+      layer_weights=None,
   ):
     """
     tokens: the input token for decoding
@@ -410,6 +420,8 @@ class GemmaModel(ModuleBase):
     input_pos: the decoding position relative to the start, which is the length of the decoding results
     ragged_batch_index: precomputed batch index for ragged attention
     ragged_block_index: precomputed block index for ragged attention
+    output_positions: positions [batch, n] to compute the logits at, all positions if None
+    layer_weights: stacked weights of all the layers, to run them with a scan
     """
 
     with jax.named_scope("transformer_freq"):
@@ -422,22 +434,59 @@ class GemmaModel(ModuleBase):
 
     end = None if start is None else (start + input_pos) % self.env.cache_len
 
-    for i in range(len(self.layers)):
-      layer = self.layers[i]
-      hidden_states = layer(
-          hidden_states=hidden_states,
-          freqs_cis=freqs_cis,
-          cache=caches[i],
-          mask=mask,
-          start=start,
-          end=end,
-          ragged_batch_index=ragged_batch_index,
-          ragged_block_index=ragged_block_index,
+    if layer_weights is not None:
+      hidden_states = scan_layers.scan_layers(
+          self.layers,
+          layer_weights,
+          hidden_states,
+          caches,
+          lambda x, cache: (
+              (),
+              dict(
+                  hidden_states=x,
+                  freqs_cis=freqs_cis,
+                  cache=cache,
+                  mask=mask,
+                  start=start,
+                  end=end,
+                  ragged_batch_index=ragged_batch_index,
+                  ragged_block_index=ragged_block_index,
+              ),
+          ),
+      )
+    else:
+      for i in range(len(self.layers)):
+        layer = self.layers[i]
+        hidden_states = layer(
+            hidden_states=hidden_states,
+            freqs_cis=freqs_cis,
+            cache=caches[i],
+            mask=mask,
+            start=start,
+            end=end,
+            ragged_batch_index=ragged_batch_index,
+            ragged_block_index=ragged_block_index,
+        )
+    if output_positions is not None:
+      # Only the sampled positions go through the lm head
+      index = output_positions.unsqueeze(-1).expand(
+          -1, -1, hidden_states.shape[-1]
       )
+      hidden_states = torch.gather(hidden_states, 1, index)
     hidden_states = self.norm(hidden_states)
 
     embedder_weight = self.embedder.weight
     if hasattr(self.embedder, "weight_scaler"):
+      if self.env.quant_config.enable_activation_quantization:
+        # The per channel embedding scales are folded into the activations,
+        # so the lm head is an int8 x int8 matmul
+        hidden_states, act_s = layers.quantize_activation_int8(
+            self, hidden_states * self.embedder.weight_scaler, "lm_head"
+        )
+        logits = torchjax.call_jax(
+            quantize.int8_einsum, "btd,vd->btv", hidden_states, embedder_weight
+        )
+        return (logits * act_s).type_as(self.embedder.weight_scaler)
       embedder_weight = embedder_weight * self.embedder.weight_scaler
     logits = torch.matmul(hidden_states, embedder_weight.t())
     return logits
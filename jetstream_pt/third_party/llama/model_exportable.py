@@ -8,6 +8,7 @@ import math
 import torch
 import torch.nn.functional as F
 import functools
+from jetstream_pt import scan_layers
 from jetstream_pt.model_base import ModuleBase
 from jetstream_pt.layers import (
     Attention,
@@ -282,6 +283,8 @@ class Transformer(ModuleBase):
       start=None,
       ragged_batch_index=None,
       ragged_block_index=None,
+      output_positions=None,
+      layer_weights=None,
   ):
     """
     tokens: the input token for decoding
@@ -291,6 +294,8 @@ class Transformer(ModuleBase):
     start: the starting position for each slot
     ragged_batch_index: precomputed batch index for ragged attention
     ragged_block_index: precomputed block index for ragged attention
+    output_positions: positions [batch, n] to compute the logits at, all positions if None
+    layer_weights: stacked weights of all the layers, to run them with a scan
     """
     with jax.named_scope("transformer_tok"):
       seqlen = tokens.shape[-1]
@@ -302,25 +307,52 @@ class Transformer(ModuleBase):
       freqs_cis = freqs_cis.reshape(bsz, seqlen, -1)
 
     end = None if start is None else (start + input_pos) % self.env.cache_len
-    # For stacked case, cannot get cache inside the loop which will cause cache copy
-    for layer_id, layer in enumerate(self.layers):
-      if caches[0].stacked:
-        cache = caches[0]
-      else:
-        cache = caches[layer_id]
-      # else:  # For stacked case, there is only 1 yer of kv cache
-
-      with jax.named_scope("TransformerBlock_Layer_" + str(layer_id)):
-        h = layer(
+    if layer_weights is not None:
+      with jax.named_scope("TransformerBlock_Scan"):
+        h = scan_layers.scan_layers(
+            self.layers,
+            layer_weights,
             h,
-            freqs_cis,
-            mask,
-            cache,
-            start,
-            end,
-            ragged_batch_index,
-            ragged_block_index,
+            caches,
+            lambda x, cache: (
+                (
+                    x,
+                    freqs_cis,
+                    mask,
+                    cache,
+                    start,
+                    end,
+                    ragged_batch_index,
+                    ragged_block_index,
+                ),
+                {},
+            ),
         )
+    else:
+      # For stacked case, cannot get cache inside the loop which will cause cache copy
+      for layer_id, layer in enumerate(self.layers):
+        if caches[0].stacked:
+          cache = caches[0]
+        else:
+          cache = caches[layer_id]
+        # else:  # For stacked case, there is only 1 yer of kv cache
+
+        with jax.named_scope("TransformerBlock_Layer_" + str(layer_id)):
+          h = layer(
+              h,
+              freqs_cis,
+              mask,
+              cache,
+              start,
+              end,
+              ragged_batch_index,
+              ragged_block_index,
+          )
+
+    if output_positions is not None:
+      # Only the sampled positions go through the lm head
+      index = output_positions.unsqueeze(-1).expand(-1, -1, h.shape[-1])
+      h = torch.gather(h, 1, index)
 
     with jax.named_scope("transformer_norm"):
       h = self.norm(h)
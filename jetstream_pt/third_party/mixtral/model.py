@@ -14,6 +14,7 @@
 # limitations under the License.
 import collections
 import copy
+import functools
 from dataclasses import dataclass
 from typing import Optional, List, Any
 
@@ -22,8 +23,12 @@ import torch.nn as nn
 from torch import Tensor
 from torch.nn import functional as F
 from .config import ModelArgs, find_multiple
+from jetstream_pt import moe
 from jetstream_pt import quantize
-from jetstream_pt.layers import Attention, get_quantized_linear_layer, get_quantized_embedding_layer
+from jetstream_pt import scan_layers
+from jetstream_pt import torchjax
+from jetstream_pt.environment import QuantizationConfig
+from jetstream_pt.layers import Attention, get_quantized_linear_layer, get_quantized_embedding_layer, quantize_activation_int8
 from jetstream_pt.model_base import ModuleBase
 
 import jax
@@ -80,6 +85,8 @@ class Transformer(ModuleBase):
       start: Optional[Tensor] = None,
       ragged_batch_index=None,
       ragged_block_index=None,
+      output_positions: Optional[Tensor] = None,
+      layer_weights=None,
   ) -> Tensor:
     assert self.freqs_cis is not None, "Caches must be initialized first"
     end = None if start is None else (start + input_pos) % self.env.cache_len
@@ -92,18 +99,45 @@ class Transformer(ModuleBase):
     assert len(caches) == len(
         self.layers
     ), f"Number of caches ({len(caches)}) and layers ({len(self.layers)}) dont match"
-    for layer, cache in zip(self.layers, caches):
-      with jax.named_scope("TransformerBlock"):
-        x = layer(
+    if layer_weights is not None:
+      with jax.named_scope("TransformerBlock_Scan"):
+        x = scan_layers.scan_layers(
+            self.layers,
+            layer_weights,
             x,
-            freqs_cis,
-            mask,
-            cache,
-            start,
-            end,
-            ragged_batch_index,
-            ragged_block_index,
+            caches,
+            lambda h, cache: (
+                (
+                    h,
+                    freqs_cis,
+                    mask,
+                    cache,
+                    start,
+                    end,
+                    ragged_batch_index,
+                    ragged_block_index,
+                ),
+                {},
+            ),
         )
+    else:
+      for layer, cache in zip(self.layers, caches):
+        with jax.named_scope("TransformerBlock"):
+          x = layer(
+              x,
+              freqs_cis,
+              mask,
+              cache,
+              start,
+              end,
+              ragged_batch_index,
+              ragged_block_index,
+          )
+
+    if output_positions is not None:
+      # Only the sampled positions go through the lm head
+      index = output_positions.unsqueeze(-1).expand(-1, -1, x.shape[-1])
+      x = torch.gather(x, 1, index)
 
     with jax.named_scope("transformer_norm"):
       x = self.norm(x)
@@ -228,7 +262,9 @@ class TransformerBlock(ModuleBase):
 
 class Int8ConditionalFeedForward(ModuleBase):
 
-  def __init__(self, config):
+  def __init__(
+      self, config, quant_config=QuantizationConfig(), expert_parallel=False
+  ):
     super().__init__()
     w1 = torch.empty(
         config.num_experts,
@@ -252,9 +288,12 @@ class Int8ConditionalFeedForward(ModuleBase):
     self.register_buffer("w2", w2)
     self.register_buffer("w3", w3)
 
-    self.annotate_sharding("w1", 1)
-    self.annotate_sharding("w2", 2)
-    self.annotate_sharding("w3", 1)
+    self.expert_parallel = expert_parallel
+    # Expert parallel shards the experts, otherwise every device holds a
+    # slice of the intermediate dim of every expert
+    self.annotate_sharding("w1", 0 if expert_parallel else 1)
+    self.annotate_sharding("w2", 0 if expert_parallel else 2)
+    self.annotate_sharding("w3", 0 if expert_parallel else 1)
 
     w1_scaler = torch.empty(config.num_experts, config.intermediate_size)
     w2_scaler = torch.empty(config.num_experts, config.dim)
@@ -263,16 +302,66 @@ class Int8ConditionalFeedForward(ModuleBase):
     self.register_buffer("w1_scaler", w1_scaler)
     self.register_buffer("w2_scaler", w2_scaler)
     self.register_buffer("w3_scaler", w3_scaler)
-    self.annotate_sharding("w1_scaler", 1)
-    self.annotate_sharding("w2_scaler", -1)
-    self.annotate_sharding("w3_scaler", 1)
+    self.annotate_sharding("w1_scaler", 0 if expert_parallel else 1)
+    self.annotate_sharding("w2_scaler", 0 if expert_parallel else -1)
+    self.annotate_sharding("w3_scaler", 0 if expert_parallel else 1)
+
+    # Run the expert einsums on int8 x int8, see quantize_activation_int8.
+    # The inputs of w1 and w3 are quantized per token, the input of w2 per
+    # token and expert.
+    self.quantize_activation = quant_config.enable_activation_quantization
+    self.static_activation_scales = {}
+    self.activation_observer = None
+
+  def _einsum(self, subscripts, x, w, w_scaler, name):
+    """einsum of x with the int8 weight w, scaled by w_scaler"""
+    if not self.quantize_activation:
+      return torch.einsum(subscripts, x, w) * w_scaler
+    x, x_scaler = quantize_activation_int8(self, x, name)
+    out = torchjax.call_jax(quantize.int8_einsum, subscripts, x, w)
+    if torch.is_tensor(x_scaler) and x_scaler.dim() < out.dim():
+      # Per token scales of [T, D] inputs, broadcast over the experts
+      x_scaler = x_scaler.unsqueeze(-1)
+    return (out * w_scaler * x_scaler).type_as(w_scaler)
+
+  def _grouped_matmul(self, x, w, w_scaler, group_sizes, row_experts, name):
+    """moe.grouped_matmul of x with the int8 weight w, scaled by w_scaler"""
+    w_scaler = w_scaler[row_experts]
+    if not self.quantize_activation:
+      out = torchjax.call_jax(moe.grouped_matmul, x, w, group_sizes)
+      return out * w_scaler
+    x, x_scaler = quantize_activation_int8(self, x, name)
+    out = torchjax.call_jax(moe.grouped_matmul, x, w, group_sizes)
+    return (out * w_scaler * x_scaler).type_as(w_scaler)
 
   def forward(self, x: Tensor, expert_indices: Tensor) -> Tensor:
     seq_len = x.shape[0]
     if seq_len >= 4:
       return self.forward_for_long_seq_len(x, expert_indices)
     else:
-      return self.forward_for_short_seq_len(x, expert_indices)
+      return self.forward_grouped(x, expert_indices)
+
+  def forward_grouped(self, x: Tensor, expert_indices: Tensor) -> Tensor:
+    """Runs every expert once on the tokens routed to it, see moe."""
+    num_tokens, num_activated = expert_indices.shape
+    with jax.named_scope("conditional_ff"):
+      order, row_experts, group_sizes = torchjax.call_jax(
+          moe.sort_by_expert, expert_indices, self.w1.shape[0]
+      )
+      x = x[order // num_activated]  # [T * A, D] sorted by expert
+      x1 = F.silu(
+          self._grouped_matmul(
+              x, self.w1, self.w1_scaler, group_sizes, row_experts, "input"
+          )
+      )
+      x3 = self._grouped_matmul(
+          x, self.w3, self.w3_scaler, group_sizes, row_experts, "input"
+      )
+      expert_outs = self._grouped_matmul(
+          x1 * x3, self.w2, self.w2_scaler, group_sizes, row_experts, "w2_input"
+      )
+      expert_outs = expert_outs[torch.argsort(order)]
+    return expert_outs.reshape(num_tokens, num_activated, -1)
 
   def forward_for_short_seq_len(
       self, x: Tensor, expert_indices: Tensor
@@ -285,13 +374,69 @@ class Int8ConditionalFeedForward(ModuleBase):
       w2_scaler = self.w2_scaler[expert_indices]
       w3_scaler = self.w3_scaler[expert_indices]
 
-      x1 = F.silu(torch.einsum("ti,taoi -> tao", x, w1_weights) * w1_scaler)
-      x3 = torch.einsum("ti, taoi -> tao", x, w3_weights) * w3_scaler
-      expert_outs = (
-          torch.einsum("tao, taio -> tai", (x1 * x3), w2_weights) * w2_scaler
+      x1 = F.silu(
+          self._einsum("ti,taoi->tao", x, w1_weights, w1_scaler, "input")
+      )
+      x3 = self._einsum("ti,taoi->tao", x, w3_weights, w3_scaler, "input")
+      expert_outs = self._einsum(
+          "tao,taio->tai", x1 * x3, w2_weights, w2_scaler, "w2_input"
       )
     return expert_outs
 
+  def forward_capacity(
+      self, x: Tensor, expert_indices: Tensor, capacity_factor: float
+  ) -> Tensor:
+    """Runs the experts on the capacity slots of moe.capacity_dispatch, the
+    outputs of dropped tokens are zeros."""
+    num_tokens, num_activated = expert_indices.shape
+    num_experts = self.w1.shape[0]
+    capacity = moe.expert_capacity(
+        num_tokens, num_activated, num_experts, capacity_factor
+    )
+    with jax.named_scope("conditional_ff"):
+      slot_tokens, assignment_slots = torchjax.call_jax(
+          moe.capacity_dispatch, expert_indices, num_experts, capacity
+      )
+      # The zero row of the empty slots
+      x = F.pad(x, (0, 0, 0, 1))[slot_tokens]  # [E, C, D]
+      x1 = F.silu(
+          self._einsum(
+              "eci,eoi->eco", x, self.w1, self.w1_scaler.unsqueeze(1), "input"
+          )
+      )
+      x3 = self._einsum(
+          "eci,eoi->eco", x, self.w3, self.w3_scaler.unsqueeze(1), "input"
+      )
+      expert_outs = self._einsum(
+          "eco,eio->eci",
+          x1 * x3,
+          self.w2,
+          self.w2_scaler.unsqueeze(1),
+          "w2_input",
+      )
+      expert_outs = expert_outs.reshape(-1, expert_outs.shape[-1])
+      # The zero output of the dropped assignments
+      return F.pad(expert_outs, (0, 0, 0, 1))[assignment_slots]
+
+  def forward_expert_parallel(
+      self, x: Tensor, expert_indices: Tensor, mesh, capacity_factor: float
+  ) -> Tensor:
+    """Runs the experts on the devices that hold them, see
+    moe.expert_parallel_ffn."""
+    with jax.named_scope("conditional_ff"):
+      return torchjax.call_jax(
+          functools.partial(
+              moe.expert_parallel_ffn,
+              mesh=mesh,
+              axis_name="x",
+              capacity_factor=capacity_factor,
+          ),
+          x,
+          expert_indices,
+          (self.w1, self.w2, self.w3),
+          (self.w1_scaler, self.w2_scaler, self.w3_scaler),
+      )
+
   def forward_for_long_seq_len(self, x, expert_indices):
     seqlen = x.shape[0]
     num_experts = self.w1.shape[0]
@@ -301,19 +446,21 @@ class Int8ConditionalFeedForward(ModuleBase):
     # o = config.imtermediate size
     # i = config.dim
     with jax.named_scope("conditional_ff"):
-      x1 = F.silu(torch.einsum("ti,eoi -> teo", x, self.w1) * self.w1_scaler)
-      x3 = torch.einsum("ti, eoi-> teo", x, self.w3) * self.w3_scaler
-      expert_outs = (
-          torch.einsum("teo, eio -> tei", (x1 * x3), self.w2) * self.w2_scaler
+      x1 = F.silu(
+          self._einsum("ti,eoi->teo", x, self.w1, self.w1_scaler, "input")
+      )
+      x3 = self._einsum("ti,eoi->teo", x, self.w3, self.w3_scaler, "input")
+      expert_outs = self._einsum(
+          "teo,eio->tei", x1 * x3, self.w2, self.w2_scaler, "w2_input"
       )
       # e = 8; need to reduce to 2
-      seq_indexes = torch.arange(seqlen).unsqueeze(1)
+      seq_indexes = torch.arange(seqlen, device=x.device).unsqueeze(1)
       return expert_outs[seq_indexes, expert_indices]
 
 
 class ConditionalFeedForward(ModuleBase):
 
-  def __init__(self, config):
+  def __init__(self, config, expert_parallel=False):
     super().__init__()
     # TODO(How to enable quantization?)
     self.w1 = nn.Parameter(
@@ -325,9 +472,10 @@ class ConditionalFeedForward(ModuleBase):
     self.w3 = nn.Parameter(
         torch.empty(config.num_experts, config.intermediate_size, config.dim)
     )
-    self.annotate_sharding("w1", 1)
-    self.annotate_sharding("w2", 2)
-    self.annotate_sharding("w3", 1)
+    self.expert_parallel = expert_parallel
+    self.annotate_sharding("w1", 0 if expert_parallel else 1)
+    self.annotate_sharding("w2", 0 if expert_parallel else 2)
+    self.annotate_sharding("w3", 0 if expert_parallel else 1)
     self.config = config
 
   def forward(self, x: Tensor, expert_indices: Tensor) -> Tensor:
@@ -335,7 +483,25 @@ class ConditionalFeedForward(ModuleBase):
     if seq_len >= 4:
       return self.forward_for_long_seq_len(x, expert_indices)
     else:
-      return self.forward_for_short_seq_len(x, expert_indices)
+      return self.forward_grouped(x, expert_indices)
+
+  def forward_grouped(self, x: Tensor, expert_indices: Tensor) -> Tensor:
+    """Runs every expert once on the tokens routed to it, see moe."""
+    num_tokens, num_activated = expert_indices.shape
+    with jax.named_scope("conditional_ff"):
+      order, _, group_sizes = torchjax.call_jax(
+          moe.sort_by_expert, expert_indices, self.w1.shape[0]
+      )
+      x = x[order // num_activated]  # [T * A, D] sorted by expert
+      x1 = F.silu(
+          torchjax.call_jax(moe.grouped_matmul, x, self.w1, group_sizes)
+      )
+      x3 = torchjax.call_jax(moe.grouped_matmul, x, self.w3, group_sizes)
+      expert_outs = torchjax.call_jax(
+          moe.grouped_matmul, x1 * x3, self.w2, group_sizes
+      )
+      expert_outs = expert_outs[torch.argsort(order)]
+    return expert_outs.reshape(num_tokens, num_activated, -1)
 
   def forward_for_short_seq_len(
       self, x: Tensor, expert_indices: Tensor
@@ -350,6 +516,48 @@ class ConditionalFeedForward(ModuleBase):
       expert_outs = torch.einsum("tao, taio -> tai", (x1 * x3), w2_weights)
     return expert_outs
 
+  def forward_capacity(
+      self, x: Tensor, expert_indices: Tensor, capacity_factor: float
+  ) -> Tensor:
+    """Runs the experts on the capacity slots of moe.capacity_dispatch, the
+    outputs of dropped tokens are zeros."""
+    num_tokens, num_activated = expert_indices.shape
+    num_experts = self.w1.shape[0]
+    capacity = moe.expert_capacity(
+        num_tokens, num_activated, num_experts, capacity_factor
+    )
+    with jax.named_scope("conditional_ff"):
+      slot_tokens, assignment_slots = torchjax.call_jax(
+          moe.capacity_dispatch, expert_indices, num_experts, capacity
+      )
+      # The zero row of the empty slots
+      x = F.pad(x, (0, 0, 0, 1))[slot_tokens]  # [E, C, D]
+      x1 = F.silu(torch.einsum("eci,eoi->eco", x, self.w1))
+      x3 = torch.einsum("eci,eoi->eco", x, self.w3)
+      expert_outs = torch.einsum("eco,eio->eci", (x1 * x3), self.w2)
+      expert_outs = expert_outs.reshape(-1, expert_outs.shape[-1])
+      # The zero output of the dropped assignments
+      return F.pad(expert_outs, (0, 0, 0, 1))[assignment_slots]
+
+  def forward_expert_parallel(
+      self, x: Tensor, expert_indices: Tensor, mesh, capacity_factor: float
+  ) -> Tensor:
+    """Runs the experts on the devices that hold them, see
+    moe.expert_parallel_ffn."""
+    with jax.named_scope("conditional_ff"):
+      return torchjax.call_jax(
+          functools.partial(
+              moe.expert_parallel_ffn,
+              mesh=mesh,
+              axis_name="x",
+              capacity_factor=capacity_factor,
+          ),
+          x,
+          expert_indices,
+          (self.w1, self.w2, self.w3),
+          None,
+      )
+
   def forward_for_long_seq_len(self, x, expert_indices):
     seqlen = x.shape[0]
     num_experts = self.w1.shape[0]
@@ -363,12 +571,14 @@ class ConditionalFeedForward(ModuleBase):
       x3 = torch.einsum("ti, eoi-> teo", x, self.w3)
       expert_outs = torch.einsum("teo, eio -> tei", (x1 * x3), self.w2)
       # e = 8; need to reduce to 2
-      seq_indexes = torch.arange(seqlen).unsqueeze(1)
+      seq_indexes = torch.arange(seqlen, device=x.device).unsqueeze(1)
       return expert_outs[seq_indexes, expert_indices]
 
-  def get_quantized_version(self):
+  def get_quantized_version(self, quant_config=QuantizationConfig()):
     """Return quantized version of this class."""
-    quant_version = Int8ConditionalFeedForward(self.config)
+    quant_version = Int8ConditionalFeedForward(
+        self.config, quant_config, self.expert_parallel
+    )
     w1, w1_scaler, _ = quantize.quantize_tensor(self.w1, 2)
     w2, w2_scaler, _ = quantize.quantize_tensor(self.w2, 2)
     w3, w3_scaler, _ = quantize.quantize_tensor(self.w3, 2)
@@ -392,23 +602,67 @@ class MOEFeedForward(ModuleBase):
         if env.quant_config.enable_weight_quantization
         else ConditionalFeedForward
     )
-    self.cond_ffn = CondLayer(config)
+    self.expert_parallel = env.moe_expert_parallel
+    if self.expert_parallel:
+      if env.quant_config.enable_activation_quantization:
+        raise ValueError(
+            "Expert parallel doesn't support activation quantization"
+        )
+      if config.num_experts % env.mesh.shape["x"] != 0:
+        raise ValueError(
+            f"Expert parallel needs the {config.num_experts} experts to be"
+            f" divisible by the {env.mesh.shape['x']} devices"
+        )
+    if CondLayer == Int8ConditionalFeedForward:
+      self.cond_ffn = CondLayer(
+          config, env.quant_config, expert_parallel=self.expert_parallel
+      )
+    else:
+      self.cond_ffn = CondLayer(config, expert_parallel=self.expert_parallel)
+    self.env = env
     self.dim = config.dim
+    self.num_experts = config.num_experts
     self.num_activated_experts = config.num_activated_experts
+    # Called with the router probabilities and the experts of the tokens,
+    # the engine sets it to record the routing stats, see moe.RoutingStats
+    self.routing_observer = None
+    self.capacity_factor = env.moe_capacity_factor
 
   def forward(self, x: Tensor) -> Tensor:
     bsz, seq, hidden = x.shape
     # [B, T, D], combine BT, for prefill B = 1, for decode, T = 1
     x = x.view(-1, self.dim)
+    if self.expert_parallel:
+      # Every device routes its shard of the tokens
+      self.env.apply_sharding(x, axis=0)
     # T = num_tokens, E = num_experts, D = hidden dim, A = activated experts
     # x: [T, D]
     scores = self.gate(x)  # [T, E]
-    expert_weights = F.softmax(scores, dim=-1)
+    probs = F.softmax(scores, dim=-1)
     expert_weights, expert_indices = torch.topk(
-        expert_weights, self.num_activated_experts, dim=-1
+        probs, self.num_activated_experts, dim=-1
     )  # [T, A], [T, A]
+    if self.routing_observer is not None:
+      self.routing_observer(probs, expert_indices)
     expert_weights /= expert_weights.sum(dim=-1, keepdim=True)  # [T, A]
-    expert_outs = self.cond_ffn(x, expert_indices)
+    if self.expert_parallel:
+      # Decode keeps a slot for every token, a dropped token would change
+      # the next token of its request
+      capacity_factor = 0.0 if seq == 1 else self.capacity_factor
+      expert_outs = self.cond_ffn.forward_expert_parallel(
+          x, expert_indices, self.env.mesh, capacity_factor
+      )
+    elif seq == 1:
+      # Decode, the tokens of the batch are grouped by expert so that every
+      # expert weight is read once per step
+      expert_outs = self.cond_ffn.forward_grouped(x, expert_indices)
+    elif self.capacity_factor > 0:
+      # Prefill, only the activated experts run on every token
+      expert_outs = self.cond_ffn.forward_capacity(
+          x, expert_indices, self.capacity_factor
+      )
+    else:
+      expert_outs = self.cond_ffn(x, expert_indices)
     expert_outs = torch.einsum("tai,ta -> ti", expert_outs, expert_weights)
     # Changes back to [B, T, D]
     expert_outs = expert_outs.reshape(bsz, seq, hidden)
@@ -96,6 +96,7 @@ def make_page_attention_env_tiny(
   environment_data.model_type = "llama-2-tiny"
   environment_data.batch_size = 1
   environment_data.num_layers = config.n_layers
+  environment_data.n_reps = config.n_heads // config.n_kv_heads
   environment_data.cache_shape = (
       config.n_kv_heads,
       environment_data.paged_attention_total_num_pages,
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import torch
+import torch_xla2
+from torch.utils import _pytree as pytree
+
+from jetstream_pt import aot_cache
+from jetstream_pt.engine import PyTorchEngine
+from jetstream_pt.third_party.llama import model_exportable
+from tests import helpers
+
+
+class AotCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    jax.config.update("jax_platform_name", "cpu")
+    jax.config.update("jax_default_matmul_precision", "highest")
+
+  def _make_engine(self):
+    def update_env_data(env_data):
+      env_data.max_input_sequence_length = 32
+
+    env, model_arg = helpers.make_env_tiny(
+        bf16_enable=False, env_data_update_fn=update_env_data
+    )
+    torch.manual_seed(0)
+    model = model_exportable.Transformer(model_arg, env)
+    return PyTorchEngine(pt_model=model, env=env)
+
+  def _decode(self, engine, params):
+    padded_tokens = jnp.array(np.pad(np.arange(10, dtype=np.int32) + 1, (0, 6)))
+    prefix, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=10
+    )
+    decode_state = engine.insert(prefix, engine.init_decode_state(), slot=0)
+    out_tokens = []
+    for _ in range(3):
+      decode_state, result_tokens = engine.generate(params, decode_state)
+      out_tokens.append(result_tokens.get_result_at_slot(0).tokens[0, 0])
+    return out_tokens
+
+  def test_warmup_saves_and_loads_executables(self):
+    engine = self._make_engine()
+    params = pytree.tree_map_only(
+        torch.Tensor, torch_xla2.tensor.t2j, engine.pt_model.state_dict()
+    )
+    expected = self._decode(engine, params)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+      engine = self._make_engine()
+      manifest = aot_cache.aot_warmup(engine, params, cache_dir)
+      # The state of init_decode_state isn't sharded like the one insert
+      # returns, so insert and generate are compiled for both
+      names = {"generate", "generate/init"}
+      for bucket in aot_cache.prefill_buckets(32):
+        names |= {
+            f"prefill/{bucket}",
+            f"insert/{bucket}",
+            f"insert/{bucket}/init",
+        }
+      self.assertEqual(set(manifest["entries"]), names)
+      self.assertTrue(
+          os.path.exists(
+              os.path.join(
+                  cache_dir, manifest["config_hash"], aot_cache.MANIFEST_FILE
+              )
+          )
+      )
+      self.assertEqual(self._decode(engine, params), expected)
+
+      # A new engine loads every executable and never calls jit
+      engine = self._make_engine()
+      aot_cache.aot_warmup(engine, params, cache_dir)
+      for entry_point in ("prefill", "insert", "generate"):
+        getattr(engine, entry_point).fn = None
+      self.assertEqual(self._decode(engine, params), expected)
+
+  def test_config_hash_covers_the_sources(self):
+    engine = self._make_engine()
+    params = pytree.tree_map_only(
+        torch.Tensor, torch_xla2.tensor.t2j, engine.pt_model.state_dict()
+    )
+    expected = aot_cache.config_hash(engine, params)
+    self.assertEqual(aot_cache.config_hash(engine, params), expected)
+    with mock.patch.object(aot_cache, "source_hash", return_value="changed"):
+      self.assertNotEqual(aot_cache.config_hash(engine, params), expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
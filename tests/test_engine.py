@@ -14,11 +14,15 @@
 
 # pylint: disable=all
 
+import json
+import os
+import tempfile
 import unittest
 import jax
 import jax.numpy as jnp
 
 from jetstream_pt.third_party.llama import model_exportable
+from jetstream_pt.third_party.mixtral import model as mixtral
 from jetstream_pt.engine import PyTorchEngine
 from tests import helpers
 
@@ -101,6 +105,24 @@ class EngineTest(unittest.TestCase):
     self.assertTrue(jnp.array_equal(token, jnp.array([[3], [1]])))
     self.assertTrue(jnp.isdtype(token, jnp.int32))
 
+  def test_routing_stats_export(self):
+    env, model_arg = helpers.make_mixtral_env(bf16_enable=False)
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, "routing_stats.jsonl")
+      env._data.moe_routing_stats_path = path
+      env._data.moe_routing_stats_interval = 3600.0
+      engine = PyTorchEngine(mixtral.Transformer(model_arg, env), env)
+      # close exports the stats of the current interval and stops the export
+      engine.close()
+      self.assertIsNone(engine._routing_stats_thread)
+      engine.close()
+      with open(path, encoding="utf-8") as f:
+        lines = f.readlines()
+      self.assertEqual(len(lines), 1)
+      metrics = json.loads(lines[0])
+      self.assertEqual(metrics["num_tokens"], 0)
+      self.assertEqual(len(metrics["layers"]), model_arg.n_layer)
+
 
 #     def test_insert(self):
 #         seqlen = 32
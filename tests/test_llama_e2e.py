@@ -13,6 +13,7 @@
 # limitations under the License.
 
 
+import types
 import unittest
 import os
 
@@ -23,6 +24,7 @@ import torch
 import torch_xla2
 from torch.utils import _pytree as pytree
 from absl.testing import parameterized
+from jetstream.engine import token_utils
 
 from jetstream_pt.engine import PyTorchEngine
 from jetstream_pt.third_party.llama import model_exportable, model_args
@@ -579,6 +581,440 @@ class LlamaE2ETest(parameterized.TestCase):
       )
       print(f"-------------------->out_tokens: {decode_state.tokens}")
 
+  @parameterized.named_parameters(
+      ("ring_buffer", True),
+      ("left_aligned", False),
+  )
+  def test_llama_int4_kv_short_prompt(self, ring_buffer):
+    """test int4 kv after a 2 tokens prompt matches the float cache"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    def decode(num_bits_kv):
+      def update_env_data(env_data):
+        env_data.ring_buffer = ring_buffer
+        env_data.flash_attention = not ring_buffer
+        env_data.lazy_cache_update = not ring_buffer
+        env_data.quant_config = environment.QuantizationConfig(
+            enable_kv_quantization=num_bits_kv < 16, num_bits_kv=num_bits_kv
+        )
+
+      env, model_arg = helpers.make_env_tiny(False, update_env_data)
+      torch.manual_seed(0)
+      model_ours = model_exportable.Transformer(model_arg, env)
+      engine = PyTorchEngine(pt_model=model_ours, env=env)
+      params = self._from_torch(model_ours.state_dict())
+      prefix, _ = engine.prefill(
+          params=params,
+          padded_tokens=jnp.array(np.pad([1, 2], (0, 14))),
+          true_length=2,
+      )
+      decode_state = engine.insert(prefix, engine.init_decode_state(), slot=0)
+      out_tokens = []
+      for _ in range(4):
+        decode_state, result_tokens = engine.generate(params, decode_state)
+        out_tokens.append(result_tokens.get_result_at_slot(0).tokens[0, 0])
+      return out_tokens
+
+    self.assertEqual(decode(4), decode(16))
+
+  def test_llama_prefill_batch(self):
+    """test batched prefill matches prefilling the prompts one by one"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    env, model_arg = helpers.make_env_tiny(bf16_enable=False)
+    model_ours = model_exportable.Transformer(model_arg, env)
+    engine = PyTorchEngine(pt_model=model_ours, env=env)
+    params = self._from_torch(model_ours.state_dict())
+
+    true_lengths = [10, 7]
+    padded_tokens = jnp.array(
+        [
+            np.pad(np.arange(length, dtype=np.int32) + 1, (0, 16 - length))
+            for length in true_lengths
+        ]
+    )
+
+    prefixes, results = engine.prefill_batch(
+        params=params,
+        padded_tokens=padded_tokens,
+        true_lengths=jnp.array(true_lengths),
+    )
+    self.assertEqual(len(prefixes), 2)
+    self.assertEqual(len(results), 2)
+
+    for i, true_length in enumerate(true_lengths):
+      prefix, _ = engine.prefill(
+          params=params,
+          padded_tokens=padded_tokens[i],
+          true_length=true_length,
+      )
+      self.assertEqual(prefixes[i].token, prefix.token)
+      self.assertEqual(prefixes[i].seq_len, true_length)
+      # Prefixes are placed like the ones of prefill
+      self.assertTrue(
+          prefixes[i]
+          .caches[0][0]
+          .sharding.is_equivalent_to(prefix.caches[0][0].sharding, 4)
+      )
+      for (k, v), (expected_k, expected_v) in zip(
+          prefixes[i].caches, prefix.caches
+      ):
+        self.assertEqual(k.shape, expected_k.shape)
+        self.assertTrue(jnp.allclose(k, expected_k, atol=1e-4))
+        self.assertTrue(jnp.allclose(v, expected_v, atol=1e-4))
+
+  def test_llama_prefill_chunked(self):
+    """test chunked prefill matches prefilling the whole prompt at once"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    env, model_arg = helpers.make_env_tiny(bf16_enable=False)
+    model_ours = model_exportable.Transformer(model_arg, env)
+    engine = PyTorchEngine(pt_model=model_ours, env=env)
+    params = self._from_torch(model_ours.state_dict())
+
+    true_length = 10
+    padded_tokens = jnp.array(
+        np.pad(np.arange(true_length, dtype=np.int32) + 1, (0, 6))
+    )
+    expected, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=true_length
+    )
+
+    num_compiled = PyTorchEngine._call_model_prefill._cache_size()
+    chunks = list(
+        engine.prefill_chunked(
+            params=params,
+            padded_tokens=padded_tokens,
+            true_length=true_length,
+            chunk_size=4,
+        )
+    )
+    self.assertEqual(len(chunks), 3)
+    # The first chunk and one executable for the later chunks
+    self.assertEqual(
+        PyTorchEngine._call_model_prefill._cache_size(), num_compiled + 2
+    )
+    prefix, _ = chunks[-1]
+    self.assertEqual(prefix.seq_len, true_length)
+    self.assertEqual(prefix.token, expected.token)
+    for (k, v), (expected_k, expected_v) in zip(prefix.caches, expected.caches):
+      self.assertTrue(
+          jnp.allclose(
+              k[:, :, :true_length],
+              expected_k[:, :, :true_length],
+              atol=1e-4,
+          )
+      )
+      self.assertTrue(
+          jnp.allclose(
+              v[:, :, :true_length],
+              expected_v[:, :, :true_length],
+              atol=1e-4,
+          )
+      )
+
+  def test_llama_generate_multi_step(self):
+    """test multi step generate matches calling generate step by step"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    env, model_arg = helpers.make_env_tiny(bf16_enable=False)
+    model_ours = model_exportable.Transformer(model_arg, env)
+    engine = PyTorchEngine(pt_model=model_ours, env=env)
+    params = self._from_torch(model_ours.state_dict())
+
+    padded_tokens = jnp.array(np.pad(np.arange(10, dtype=np.int32) + 1, (0, 6)))
+    prefix, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=10
+    )
+
+    decode_state = engine.insert(prefix, engine.init_decode_state(), slot=0)
+    expected = []
+    for _ in range(4):
+      decode_state, result_tokens = engine.generate(params, decode_state)
+      expected.append(result_tokens.get_result_at_slot(0).tokens[0, 0].item())
+    expected_lens = result_tokens.get_result_at_slot(0).lengths
+
+    # insert donates the prefix
+    prefix, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=10
+    )
+    decode_state = engine.insert(prefix, engine.init_decode_state(), slot=0)
+    decode_state, result_tokens = engine.generate_multi_step(
+        params, decode_state, 4
+    )
+    slot_data = result_tokens.get_result_at_slot(0)
+    self.assertEqual(slot_data.tokens[0].tolist(), expected)
+    self.assertTrue(np.all(slot_data.valid[0]))
+    self.assertEqual(slot_data.lengths, expected_lens)
+
+  def test_llama_scan_layers(self):
+    """test running the layers with a scan matches the unrolled model"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    def update_env_data(env_data, scan):
+      # Scanned layers index the stacked generate cache with the layer id
+      env_data.ring_buffer = False
+      env_data.ragged_mha = True
+      env_data.flash_attention = True
+      env_data.generate_cache_stacked = True
+      env_data.new_cache_stacked = True
+      env_data.lazy_cache_update = True
+      env_data.scan_layers = scan
+
+    outputs = []
+    for scan in (False, True):
+      env, model_arg = helpers.make_env_tiny(
+          bf16_enable=False,
+          env_data_update_fn=lambda env_data: update_env_data(env_data, scan),
+      )
+      torch.manual_seed(0)
+      model_ours = model_exportable.Transformer(model_arg, env)
+      engine = PyTorchEngine(
+          pt_model=model_ours,
+          env=env,
+          weights=self._from_torch(model_ours.state_dict()),
+      )
+      params = engine.load_params()
+      self.assertEqual(
+          any(k.startswith("scanned_layers.") for k in params),
+          env.scan_layers,
+      )
+
+      padded_tokens = jnp.array(
+          np.pad(np.arange(10, dtype=np.int32) + 1, (0, 6))
+      )
+      prefix, _ = engine.prefill(
+          params=params, padded_tokens=padded_tokens, true_length=10
+      )
+      prefix_caches = jax.device_get(prefix.caches)
+      decode_state = engine.insert(prefix, engine.init_decode_state(), slot=0)
+      tokens = []
+      for _ in range(4):
+        decode_state, result_tokens = engine.generate(params, decode_state)
+        tokens.append(result_tokens.get_result_at_slot(0).tokens[0, 0].item())
+      outputs.append((tokens, prefix_caches, decode_state.caches))
+
+    expected_tokens, expected_prefix, expected_caches = outputs[0]
+    tokens, prefix_caches, caches = outputs[1]
+    self.assertEqual(tokens, expected_tokens)
+    for (k, v), (expected_k, expected_v) in zip(
+        prefix_caches + caches, expected_prefix + expected_caches
+    ):
+      self.assertTrue(jnp.allclose(k, expected_k, atol=1e-4))
+      self.assertTrue(jnp.allclose(v, expected_v, atol=1e-4))
+
+  def test_llama_scan_layers_needs_stacked_cache(self):
+    """test scan_layers rejects the per layer generate caches"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    def update_env_data(env_data):
+      env_data.scan_layers = True
+      env_data.generate_cache_stacked = False
+
+    env, model_arg = helpers.make_env_tiny(
+        bf16_enable=False, env_data_update_fn=update_env_data
+    )
+    model_ours = model_exportable.Transformer(model_arg, env)
+    with self.assertRaises(ValueError):
+      PyTorchEngine(pt_model=model_ours, env=env)
+
+  def test_reserve_pages_on_device(self):
+    """test the device page reservation of the next decode step"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    def update_env_data(env_data):
+      env_data.batch_size = 4
+      env_data.paged_attention_device_reservation = True
+
+    env, model_arg = helpers.make_page_attention_env_tiny(
+        bf16_enable=False, env_data_update_fn=update_env_data
+    )
+    model_ours = model_exportable.Transformer(model_arg, env)
+    engine = PyTorchEngine(pt_model=model_ours, env=env)
+    manager = engine.page_attention_manager
+    pool = np.asarray(engine.page_table.pool)
+
+    manager.reserve_pages_insert(0, 32)
+    manager.reserve_pages_insert(2, 40)
+    page_table = engine.page_table.replace(
+        page_indices=jnp.asarray(manager.page_indices)
+    )
+    lens = np.asarray([32, 0, 40, 0], dtype=np.int32)
+    page_table, page_token_indices, lengths = engine._reserve_pages_on_device(
+        page_table, jnp.asarray(lens)
+    )
+
+    # Slot 0 is at a page boundary and takes the first pool page
+    self.assertEqual(int(page_table.pool_head), 1)
+    self.assertEqual(int(page_table.page_indices[0, 1]), pool[0])
+    self.assertTrue(
+        np.array_equal(page_table.page_indices[2], manager.page_indices[2])
+    )
+    # Pages and token offsets of the active slots
+    self.assertEqual(int(page_token_indices[0, 0]), pool[0])
+    self.assertEqual(int(page_token_indices[0, 2]), manager.page_indices[2, 1])
+    self.assertEqual(int(page_token_indices[1, 0]), 0)
+    self.assertEqual(int(page_token_indices[1, 2]), 2 * 32 + 8)
+    self.assertTrue(np.array_equal(lengths, [33, 0, 41, 0]))
+
+    # An empty pool hands out the padding page, never a page in use
+    page_table = page_table.replace(pool_head=jnp.int32(len(pool)))
+    page_table, page_token_indices, _ = engine._reserve_pages_on_device(
+        page_table, jnp.asarray(lens)
+    )
+    self.assertEqual(int(page_token_indices[0, 0]), manager.padding_page)
+    engine.page_table = page_table
+    with self.assertRaises(RuntimeError):
+      engine._refill_page_pool(0)
+
+  def test_page_pool_with_few_free_pages(self):
+    """test the device page pool only takes the pages there are"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    def update_env_data(env_data):
+      env_data.batch_size = 4
+      env_data.ring_buffer = False
+      env_data.paged_attention_device_reservation = True
+
+    env, model_arg = helpers.make_page_attention_env_tiny(
+        bf16_enable=False, env_data_update_fn=update_env_data
+    )
+    model_ours = model_exportable.Transformer(model_arg, env)
+    engine = PyTorchEngine(pt_model=model_ours, env=env)
+    params = self._from_torch(model_ours.state_dict())
+    manager = engine.page_attention_manager
+
+    # A single free page refills the pool with it
+    engine._release_page_pool()
+    held_pages = manager.reserve_page_pool(manager.num_free_pages - 1)
+    engine._refill_page_pool(1)
+    self.assertEqual(engine._page_pool_left, 1)
+    self.assertEqual(manager.num_free_pages, 0)
+    # Only a step taking more pages than there are fails
+    with self.assertRaises(RuntimeError):
+      engine._refill_page_pool(2)
+    manager.release_page_pool(held_pages)
+
+    # The insert takes the pages parked in the pool
+    engine._refill_page_pool(0)
+    held_pages = manager.reserve_page_pool(manager.num_free_pages)
+    padded_tokens = jnp.array(
+        np.pad(np.arange(40, dtype=np.int32) + 1, (0, 24))
+    )
+    prefix, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=40
+    )
+    engine.insert(prefix, engine.init_decode_state(), 0)
+    self.assertEqual(manager.num_slot_pages[0], 2)
+    self.assertEqual(engine._page_pool_left, 0)
+
+  def test_preempt_and_resume_slot(self):
+    """test a preempted slot is restored with the same kv pages content"""
+    jax.config.update("jax_platform_name", "cpu")
+
+    def update_env_data(env_data):
+      env_data.batch_size = 2
+      env_data.ring_buffer = False
+      env_data.paged_attention_preemption = True
+
+    env, model_arg = helpers.make_page_attention_env_tiny(
+        bf16_enable=False, env_data_update_fn=update_env_data
+    )
+    model_ours = model_exportable.Transformer(model_arg, env)
+    engine = PyTorchEngine(pt_model=model_ours, env=env)
+    params = self._from_torch(model_ours.state_dict())
+    manager = engine.page_attention_manager
+
+    padded_tokens = jnp.array(np.pad(np.arange(10, dtype=np.int32) + 1, (0, 6)))
+    prefix, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=10
+    )
+    decode_state = engine.insert(prefix, engine.init_decode_state(), 1)
+    pages = manager.page_indices[1, : manager.num_slot_pages[1]].copy()
+    expected_k = np.asarray(decode_state.caches[0][0][:, pages])
+    num_free_pages = manager.num_free_pages
+
+    decode_state = engine.preempt_slot(decode_state, 1)
+    self.assertEqual(len(engine.preempted_slots), 1)
+    self.assertEqual(int(decode_state.input_pos[1]), 0)
+    self.assertEqual(manager.num_free_pages, num_free_pages + len(pages))
+
+    decode_state = engine.resume_preempted_slots(decode_state)
+    self.assertEqual(len(engine.preempted_slots), 0)
+    self.assertEqual(int(decode_state.input_pos[1]), 10)
+    pages = manager.page_indices[1, : manager.num_slot_pages[1]]
+    self.assertTrue(
+        np.array_equal(decode_state.caches[0][0][:, pages], expected_k)
+    )
+
+    # A slot reused by a new request is never overwritten by its swapped copy
+    decode_state = engine.preempt_slot(decode_state, 1)
+    prefix, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=10
+    )
+    decode_state = engine.insert(prefix, decode_state, 1)
+    self.assertEqual(len(engine.preempted_slots), 0)
+    decode_state = engine.preempt_slot(decode_state, 1)
+    manager.reserve_pages_insert(1, 10)
+    decode_state = engine.resume_preempted_slots(decode_state)
+    self.assertEqual(len(engine.preempted_slots), 0)
+    self.assertEqual(int(decode_state.input_pos[1]), 0)
+
+  def test_preempted_slot_through_process_result_tokens(self):
+    """test a driver skipping the preempted slots decodes the same tokens"""
+    jax.config.update("jax_platform_name", "cpu")
+    tokenizer = types.SimpleNamespace(stop_tokens=set())
+
+    def update_env_data(env_data):
+      env_data.batch_size = 2
+      env_data.ring_buffer = False
+      env_data.paged_attention_preemption = True
+
+    def decode(preempt):
+      env, model_arg = helpers.make_page_attention_env_tiny(
+          bf16_enable=False, env_data_update_fn=update_env_data
+      )
+      torch.manual_seed(0)
+      model_ours = model_exportable.Transformer(model_arg, env)
+      engine = PyTorchEngine(pt_model=model_ours, env=env)
+      params = self._from_torch(model_ours.state_dict())
+      manager = engine.page_attention_manager
+      padded_tokens = jnp.array(
+          np.pad(np.arange(10, dtype=np.int32) + 1, (0, 6))
+      )
+      prefix, _ = engine.prefill(
+          params=params, padded_tokens=padded_tokens, true_length=10
+      )
+      decode_state = engine.insert(prefix, engine.init_decode_state(), 1)
+      complete = np.zeros((1,), dtype=np.bool_)
+      out_tokens = []
+      for step in range(6):
+        if preempt and step == 2:
+          decode_state = engine.preempt_slot(decode_state, 1)
+          # Without free pages the slot isn't resumed
+          held_pages = manager.reserve_page_pool(manager.num_free_pages)
+        if preempt and step == 4:
+          manager.release_page_pool(held_pages)
+        decode_state, result_tokens = engine.generate(params, decode_state)
+        result_tokens = result_tokens.convert_to_numpy()
+        paused = any(swapped.slot == 1 for swapped in engine.preempted_slots)
+        samples, new_complete = token_utils.process_result_tokens(
+            tokenizer=tokenizer,
+            slot=1,
+            slot_max_length=engine.max_decode_length,
+            result_tokens=result_tokens,
+            complete=complete.copy(),
+            is_client_side_tokenization=True,
+        )
+        # The orchestrator would end the request on the paused step
+        self.assertEqual(bool(new_complete[0]), paused)
+        if not paused:
+          out_tokens.extend(samples[0].token_ids)
+      return out_tokens
+
+    expected = decode(preempt=False)
+    self.assertEqual(decode(preempt=True), expected[:4])
+
 
 if __name__ == "__main__":
   unittest.main()
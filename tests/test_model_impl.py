@@ -29,6 +29,7 @@ from jetstream_pt.third_party.mixtral import model as mixtral
 from jetstream_pt.third_party.mixtral import config as mixtral_config
 from jetstream_pt import torchjax
 from jetstream_pt import layers
+from jetstream_pt import moe
 from jetstream_pt import cache_manager
 
 from . import helpers
@@ -414,6 +415,42 @@ class ModelComponentTest(parameterized.TestCase):
     print("Transformer: Diff norm", (result_torch - expected_out).norm())
     self.assertTrue(torch.allclose(result_torch, expected_out, atol=1e-4))
 
+  def test_transformer_output_positions(self):
+    """test logits at selected positions match the full logits"""
+    env, model_arg = helpers.make_env_tiny(False)
+    model_ours = model_exportable.Transformer(model_arg, env)
+    state_dict = dict(model_ours.state_dict())
+
+    seqlen = 32
+    x = torch.randint(0, 32000, (1, seqlen))
+    _, our_mask = self._prefill_mask(seqlen, 0, env)
+    input_pos = torch.arange(0, seqlen)
+
+    expected_out = helpers.call_xla_model(
+        model_ours,
+        state_dict,
+        (x, input_pos, env.make_caches_prefill(), our_mask),
+    )
+    output_positions = torch.tensor([[3, 31]])
+    result_torch = helpers.call_xla_model(
+        model_ours,
+        state_dict,
+        (
+            x,
+            input_pos,
+            env.make_caches_prefill(),
+            our_mask,
+            None,
+            None,
+            None,
+            output_positions,
+        ),
+    )
+    self.assertEqual(result_torch.shape[1], 2)
+    self.assertTrue(
+        torch.allclose(result_torch, expected_out[:, [3, 31]], atol=1e-4)
+    )
+
   # pylint: disable-next=all
   def test_mixtral_transformer(self):
     """test transformer diff between original model vs xla_model"""
@@ -500,6 +537,119 @@ class ModelComponentTest(parameterized.TestCase):
 
     torch.testing.assert_close(res1, res2)
 
+    # Short sequences run the experts on the tokens grouped by expert
+    res3 = helpers.call_xla_model(m, m.state_dict(), (x, exp_index))
+    torch.testing.assert_close(res1, res3, atol=1e-4, rtol=1e-4)
+
+    qm = m.get_quantized_version()
+    dequantized = mixtral.ConditionalFeedForward(config)
+    dequantized.load_state_dict(
+        {
+            name: getattr(qm, name) * getattr(qm, f"{name}_scaler").unsqueeze(2)
+            for name in ("w1", "w2", "w3")
+        },
+        assign=True,
+    )
+    res4 = helpers.call_xla_model(qm, qm.state_dict(), (x, exp_index))
+    torch.testing.assert_close(
+        dequantized.forward_for_short_seq_len(x, exp_index),
+        res4,
+        atol=1e-3,
+        rtol=1e-3,
+    )
+
+  def test_mixtral_moe_capacity(self):
+    """Test mixtral moe prefill with capacity based routing."""
+    env, config = helpers.make_mixtral_env(False)
+    dense_moe = mixtral.MOEFeedForward(config, "cpu", env)
+    states = dense_moe.state_dict()
+    for k, v in states.items():
+      states[k] = torch.randn(v.shape)
+    x = torch.randn(1, 16, config.dim)
+    expected = helpers.call_xla_model(dense_moe, states, (x,))
+
+    # Slots for all the tokens of every expert, none is dropped
+    env._data.moe_capacity_factor = (
+        config.num_experts / config.num_activated_experts
+    )
+    moe_ffn = mixtral.MOEFeedForward(config, "cpu", env)
+    result = helpers.call_xla_model(moe_ffn, states, (x,))
+    torch.testing.assert_close(result, expected, atol=1e-4, rtol=1e-4)
+
+    # Tokens routed to a full expert skip it
+    env._data.moe_capacity_factor = 0.25
+    moe_ffn = mixtral.MOEFeedForward(config, "cpu", env)
+    result = helpers.call_xla_model(moe_ffn, states, (x,))
+    self.assertFalse(torch.allclose(result, expected, atol=1e-4, rtol=1e-4))
+
+  def test_mixtral_moe_expert_parallel(self):
+    """Test mixtral moe with the experts sharded over the devices."""
+    env, config = helpers.make_mixtral_env(False)
+    dense_moe = mixtral.MOEFeedForward(config, "cpu", env)
+    states = dense_moe.state_dict()
+    for k, v in states.items():
+      states[k] = torch.randn(v.shape)
+
+    env._data.moe_expert_parallel = True
+    moe_ffn = mixtral.MOEFeedForward(config, "cpu", env)
+    shardings = moe_ffn.get_sharding_annotations()
+    for name in ("w1", "w2", "w3"):
+      self.assertEqual(shardings[f"cond_ffn.{name}"], 0)
+    # Decode and prefill, the experts sum in another order than dense
+    for batch_size, seqlen in ((16, 1), (1, 16)):
+      x = torch.randn(batch_size, seqlen, config.dim)
+      expected = helpers.call_xla_model(dense_moe, states, (x,))
+      result = helpers.call_xla_model(moe_ffn, states, (x,))
+      torch.testing.assert_close(result, expected, atol=1e-3, rtol=1e-3)
+
+    # The capacity factor drops prefill tokens but no decode token
+    env._data.moe_capacity_factor = 0.25
+    moe_ffn = mixtral.MOEFeedForward(config, "cpu", env)
+    x = torch.randn(16, 1, config.dim)
+    expected = helpers.call_xla_model(dense_moe, states, (x,))
+    result = helpers.call_xla_model(moe_ffn, states, (x,))
+    torch.testing.assert_close(result, expected, atol=1e-3, rtol=1e-3)
+    x = torch.randn(1, 16, config.dim)
+    expected = helpers.call_xla_model(dense_moe, states, (x,))
+    result = helpers.call_xla_model(moe_ffn, states, (x,))
+    self.assertFalse(torch.allclose(result, expected, atol=1e-3, rtol=1e-3))
+
+  def test_mixtral_moe_routing_stats(self):
+    """Test the routing stats of mixtral moe."""
+    env, config = helpers.make_mixtral_env(False)
+    moe_ffn = mixtral.MOEFeedForward(config, "cpu", env)
+    states = moe_ffn.state_dict()
+    for k, v in states.items():
+      states[k] = torch.randn(v.shape)
+    num_tokens = 16
+    x = torch.randn(num_tokens, 1, config.dim)
+    layer_stats = []
+
+    def observe(probs, expert_indices):
+      probs, expert_indices = torchjax.from_torch((probs, expert_indices))
+      layer_stats.append(
+          moe.routing_stats(probs, expert_indices, config.num_experts)
+      )
+
+    moe_ffn.routing_observer = observe
+    helpers.call_xla_model(moe_ffn, states, (x,))
+    total = moe.init_routing_stats(1, config.num_experts)
+    total = moe.add_routing_stats(total, layer_stats)
+    metrics = moe.routing_metrics(moe.add_routing_stats(total, layer_stats))
+
+    self.assertEqual(metrics["num_tokens"], 2 * num_tokens)
+    (layer,) = metrics["layers"]
+    self.assertEqual(
+        sum(layer["expert_counts"]),
+        2 * num_tokens * config.num_activated_experts,
+    )
+    self.assertAlmostEqual(sum(layer["expert_load"]), 1.0, places=5)
+    self.assertGreaterEqual(layer["load_imbalance"], 1.0)
+    self.assertGreater(layer["mean_router_entropy"], 0.0)
+    self.assertLessEqual(
+        layer["mean_router_entropy"], float(jnp.log(config.num_experts))
+    )
+
 
 if __name__ == "__main__":
   unittest.main()
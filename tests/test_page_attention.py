@@ -8,7 +8,12 @@ import torch
 from jetstream_pt.third_party.llama import model_args
 from jetstream_pt import environment
 from jetstream_pt.page_attention_manager import PageAttentionManager
-from jetstream_pt.cache_manager import PageKVCacheGenerate, KVCachePrefill
+from jetstream_pt.cache_manager import (
+    PageInt8KVCacheGenerate,
+    PageKVCacheGenerate,
+    KVCachePrefill,
+)
+from jax.experimental.pallas.ops.tpu.paged_attention import quantization_utils
 from absl.testing import parameterized
 
 P = jax.sharding.PartitionSpec
@@ -144,6 +149,45 @@ class PageAttentionTest(parameterized.TestCase):
     noupdated_k = jax.lax.slice_in_dim(decode_caches[0][0], 2, 20, axis=1)
     self.assertTrue(jnp.array_equal(noupdated_k, jnp.zeros_like(noupdated_k)))
 
+  def test_prefill_insert_quantized(self):
+
+    env, _ = self._make_env(bf16_enable=False)
+
+    pam = PageAttentionManager(
+        batch_size=3,
+        paged_attention_total_num_pages=20,
+        paged_attention_page_size=4,
+        max_pages_per_sequence=4,
+    )
+    shape = (1, 20, 4, 2)
+    cache = PageInt8KVCacheGenerate.empty(shape=shape, device=None, env=env)
+    decode_caches = [cache.state()]
+    decode_scales = [cache.scalers()]
+    self.assertEqual(decode_scales[0][0].shape, (1, 20, 4, 1))
+
+    k = jnp.arange(12, dtype=jnp.float32).reshape(1, 1, 6, 2) - 5
+    v = -jnp.arange(12, dtype=jnp.float32).reshape(1, 1, 6, 2)
+    num_pages, update_indexes = pam.reserve_pages_insert(0, 6)
+    tep_kv = jnp.zeros((1, num_pages * 4, 2), dtype=jnp.float32)
+
+    caches, scales = pam.insert_prefill_cache_quantized(
+        prefill_caches=[(k, v)],
+        decode_caches=decode_caches,
+        decode_scales=decode_scales,
+        update_indexes=update_indexes,
+        tep_kv=tep_kv,
+        sharding=env.sharding,
+    )
+
+    self.assertEqual(caches[0][0].dtype, jnp.int8)
+    for cache, scale, expected in zip(caches[0], scales[0], (k, v)):
+      x = quantization_utils.from_int8(
+          cache[:, 0:2], scale[:, 0:2], dtype=jnp.float32
+      )
+      self.assertTrue(
+          jnp.allclose(x.reshape(8, 2)[0:6], expected.reshape(6, 2), atol=0.1)
+      )
+
   def test_reserve_pages_decode(self):
 
     env, _ = self._make_env()
@@ -202,6 +246,94 @@ class PageAttentionTest(parameterized.TestCase):
         np.array_equal(page_token_indices[1], expected_token_indices)
     )
 
+  def test_share_pages_copy_on_write(self):
+    pam = PageAttentionManager(
+        batch_size=3,
+        paged_attention_total_num_pages=20,
+        paged_attention_page_size=4,
+        max_pages_per_sequence=4,
+    )
+    pam.reserve_pages_insert(0, 10)
+    # Slot 1 shares the 2 full pages of the 9 common tokens with slot 0
+    num_pages, update_indexes = pam.reserve_pages_insert(
+        1, 11, shared_slot=0, shared_len=9
+    )
+    self.assertEqual(num_pages, 1)
+    self.assertTrue(np.array_equal(update_indexes, np.asarray([3])))
+    self.assertTrue(np.array_equal(pam.page_indices[1][0:3], [0, 1, 3]))
+    self.assertTrue(np.array_equal(pam.page_ref_counts[0:4], [2, 2, 1, 1]))
+
+    # Slot 2 forks slot 0, the last partial page is copied on write
+    pam.fork_pages(0, 2)
+    self.assertEqual(pam.page_ref_counts[2], 2)
+    pam.fill_new_pages(np.asarray([10, 11, 10]))
+    src_pages, dst_pages = pam.pop_page_copies()
+    self.assertTrue(np.array_equal(src_pages, [2]))
+    self.assertTrue(np.array_equal(dst_pages, [4]))
+    self.assertTrue(np.array_equal(pam.page_indices[0][0:3], [0, 1, 4]))
+    self.assertTrue(np.array_equal(pam.page_indices[2][0:3], [0, 1, 2]))
+    self.assertEqual(pam.pop_page_copies()[0].size, 0)
+
+    # Shared pages go back to the free list with the last slot using them
+    pam.free_pages_resource(0)
+    pam.free_pages_resource(2)
+    self.assertTrue(np.array_equal(pam.page_ref_counts[0:5], [1, 1, 0, 1, 0]))
+    pam.free_pages_resource(1)
+    self.assertEqual(pam.page_ref_counts.sum(), 0)
+    self.assertEqual(pam.num_free_pages, 19)
+
+  def test_share_pages_validation(self):
+    pam = PageAttentionManager(
+        batch_size=3,
+        paged_attention_total_num_pages=20,
+        paged_attention_page_size=4,
+        max_pages_per_sequence=4,
+    )
+    pam.reserve_pages_insert(0, 6)
+    with self.assertRaises(ValueError):
+      pam.reserve_pages_insert(0, 6, shared_slot=0, shared_len=4)
+    # Slot 0 holds 2 pages, slot 2 holds none
+    with self.assertRaises(ValueError):
+      pam.reserve_pages_insert(1, 12, shared_slot=0, shared_len=12)
+    with self.assertRaises(ValueError):
+      pam.reserve_pages_insert(1, 8, shared_slot=2, shared_len=4)
+    self.assertEqual(pam.num_slot_pages[1], 0)
+    self.assertEqual(pam.lengths[1], 0)
+    self.assertTrue(np.array_equal(pam.page_ref_counts[0:3], [1, 1, 0]))
+
+    num_pages, _ = pam.reserve_pages_insert(1, 12, shared_slot=0, shared_len=8)
+    self.assertEqual(num_pages, 1)
+
+  def test_copy_pages(self):
+    pam = PageAttentionManager(
+        batch_size=3,
+        paged_attention_total_num_pages=4,
+        paged_attention_page_size=2,
+        max_pages_per_sequence=2,
+    )
+    k = jnp.arange(8, dtype=jnp.float32).reshape(1, 4, 2, 1)
+    caches = pam.copy_pages([(k, k)], jnp.asarray([1]), jnp.asarray([3]))
+    expected = jnp.asarray([0, 1, 2, 3, 4, 5, 2, 3], dtype=jnp.float32)
+    self.assertTrue(jnp.array_equal(caches[0][0].reshape(-1), expected))
+
+  def test_preemption_victim(self):
+    pam = PageAttentionManager(
+        batch_size=3,
+        paged_attention_total_num_pages=8,
+        paged_attention_page_size=4,
+        max_pages_per_sequence=4,
+    )
+    self.assertIsNone(pam.select_preemption_victim())
+    pam.reserve_pages_insert(0, 4)
+    pam.reserve_pages_insert(1, 9)
+    self.assertEqual(pam.select_preemption_victim(), 1)
+    self.assertEqual(pam.select_preemption_victim(exclude=(1,)), 0)
+    self.assertIsNone(pam.select_preemption_victim(exclude=(0, 1)))
+
+    # Slot 0 crosses a page boundary, slot 1 writes to its last page
+    self.assertEqual(pam.num_pages_needed_decode(np.asarray([4, 9, 0])), 1)
+    self.assertEqual(pam.num_free_pages, 3)
+
 
 if __name__ == "__main__":
   unittest.main()
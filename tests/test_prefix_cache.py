@@ -0,0 +1,149 @@
+import unittest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import torch
+import torch_xla2
+from torch.utils import _pytree as pytree
+
+from jetstream_pt.engine import PyTorchEngine
+from jetstream_pt.environment import QuantizationConfig
+from jetstream_pt.prefix_cache import PrefixCache
+from jetstream_pt.third_party.llama import model_exportable
+from tests import helpers
+
+
+def _make_caches(seq_len, num_layers=2):
+  # (batch, kv_heads, seqlen, dim), the value is the position
+  k = jnp.broadcast_to(
+      jnp.arange(seq_len, dtype=jnp.float32)[None, None, :, None],
+      (1, 2, seq_len, 4),
+  )
+  return [(k, k + 1) for _ in range(num_layers)]
+
+
+class PrefixCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    jax.config.update("jax_platform_name", "cpu")
+
+  def test_lookup_longest_prefix(self):
+    cache = PrefixCache(block_size=4, max_bytes=1 << 20)
+    tokens = np.arange(10)
+    cache.insert(tokens, _make_caches(16))
+    self.assertEqual(len(cache), 1)
+
+    # Only full blocks are cached
+    length, caches = cache.lookup(np.arange(10))
+    self.assertEqual(length, 8)
+    self.assertEqual(caches[0][0].shape, (1, 2, 8, 4))
+    self.assertTrue(jnp.array_equal(caches[0][0][0, 0, :, 0], jnp.arange(8)))
+
+    # Shorter prompt with the same prefix
+    length, caches = cache.lookup(np.array([0, 1, 2, 3, 7, 7, 7, 7]))
+    self.assertEqual(length, 4)
+    self.assertEqual(caches[1][1].shape, (1, 2, 4, 4))
+
+    length, caches = cache.lookup(np.array([1, 1, 2, 3, 4, 5, 6, 7]))
+    self.assertEqual(length, 0)
+    self.assertIsNone(caches)
+
+  def test_insert_covered_prefix(self):
+    cache = PrefixCache(block_size=4, max_bytes=1 << 20)
+    cache.insert(np.arange(8), _make_caches(8))
+    nbytes = cache.nbytes
+    cache.insert(np.arange(4), _make_caches(4))
+    self.assertEqual(len(cache), 1)
+    self.assertEqual(cache.nbytes, nbytes)
+
+  def test_lru_eviction(self):
+    # Each entry takes 2 layers * (k, v) * 2 * 4 * 4 floats = 512 bytes
+    cache = PrefixCache(block_size=4, max_bytes=1024)
+    cache.insert(np.arange(4), _make_caches(4))
+    cache.insert(np.arange(4) + 10, _make_caches(4))
+    self.assertEqual(cache.nbytes, 1024)
+
+    # Touch the first one so the second one is evicted
+    self.assertEqual(cache.lookup(np.arange(4))[0], 4)
+    cache.insert(np.arange(4) + 20, _make_caches(4))
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.nbytes, 1024)
+    self.assertEqual(cache.lookup(np.arange(4))[0], 4)
+    self.assertEqual(cache.lookup(np.arange(4) + 10)[0], 0)
+    self.assertEqual(cache.lookup(np.arange(4) + 20)[0], 4)
+
+  def test_entry_over_budget_is_skipped(self):
+    cache = PrefixCache(block_size=4, max_bytes=100)
+    cache.insert(np.arange(4), _make_caches(4))
+    self.assertEqual(len(cache), 0)
+    self.assertEqual(cache.nbytes, 0)
+
+
+class PrefixCacheEngineTest(unittest.TestCase):
+
+  def setUp(self):
+    jax.config.update("jax_platform_name", "cpu")
+    jax.config.update("jax_default_matmul_precision", "highest")
+
+  def _make_engine(self, prefix_cache_max_bytes):
+    def update_env_data(env_data):
+      env_data.quant_config = QuantizationConfig()
+      env_data.prefix_cache_max_bytes = prefix_cache_max_bytes
+      env_data.prefix_cache_block_size = 4
+
+    env, model_arg = helpers.make_env_tiny(
+        bf16_enable=False, env_data_update_fn=update_env_data
+    )
+    torch.manual_seed(0)
+    model = model_exportable.Transformer(model_arg, env)
+    return PyTorchEngine(pt_model=model, env=env)
+
+  def _prefill_and_decode(self, engine, params, tokens):
+    padded_tokens = jnp.array(np.pad(tokens, (0, 16 - len(tokens))))
+    prefix, result = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=len(tokens)
+    )
+    out_tokens = [result.get_result_at_slot(0).tokens[0, 0]]
+    decode_state = engine.insert(prefix, engine.init_decode_state(), slot=0)
+    for _ in range(3):
+      decode_state, result_tokens = engine.generate(params, decode_state)
+      out_tokens.append(result_tokens.get_result_at_slot(0).tokens[0, 0])
+    return out_tokens
+
+  def test_prefill_computes_only_the_suffix(self):
+    engine = self._make_engine(prefix_cache_max_bytes=1 << 24)
+    params = pytree.tree_map_only(
+        torch.Tensor, torch_xla2.tensor.t2j, engine.pt_model.state_dict()
+    )
+    first = np.arange(10, dtype=np.int32) + 1
+    second = np.concatenate([first[:8], np.array([20, 21, 22], np.int32)])
+
+    # Record the calls of the jitted prefill behind the cache lookup
+    calls = []
+    # pylint: disable-next=protected-access
+    jitted_prefill = engine._prefill
+
+    def recording_prefill(**kwargs):
+      calls.append(kwargs)
+      return jitted_prefill(**kwargs)
+
+    engine._prefill = recording_prefill  # pylint: disable=protected-access
+    self._prefill_and_decode(engine, params, first)
+    self.assertNotIn("existing_prefix", calls[0])
+    self.assertEqual(calls[0]["true_length"], 10)
+
+    # The first two blocks are shared, the suffix is padded to a full block
+    out_tokens = self._prefill_and_decode(engine, params, second)
+    self.assertEqual(calls[1]["existing_prefix"].seq_len, 8)
+    self.assertEqual(calls[1]["true_length"], 3)
+    self.assertEqual(calls[1]["padded_tokens"].shape, (4,))
+
+    expected = self._prefill_and_decode(
+        self._make_engine(prefix_cache_max_bytes=0), params, second
+    )
+    self.assertEqual(out_tokens, expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -12,11 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import dataclasses
 import functools
+import glob
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 import jax
 import jax.numpy as jnp
+import safetensors.torch
 import torch
 import torch_xla2
 from absl.testing import parameterized
@@ -24,14 +30,24 @@ from tests import helpers
 
 
 from jetstream_pt import cache_manager, layers, torchjax, environment
+from jetstream_pt import kv_calibration, quantization_planner
 from jetstream_pt.environment import QuantizationConfig
 from jetstream_pt.layers import (
     WeightOnlyBlockwiseQuantizedLinear,
     WeightOnlyPerChannelQuantizedLinear,
 )
-from jetstream_pt.quantize_model import quantize_model
-from jetstream_pt.quantize import dequantize_tensor, quantize_tensor
-
+from jetstream_pt.quantize_model import (
+    apply_layer_configs,
+    load_quantization_config,
+    quantize_model,
+    save_quantized_checkpoint,
+)
+from jetstream_pt.attention_kernel import ragged_mha as ragged_mha_kernel
+from jetstream_pt.quantize import (
+    dequantize_tensor,
+    quantize_tensor,
+    unpack_int4,
+)
 
 torch.manual_seed(12345)
 
@@ -152,6 +168,213 @@ class QuantizationTest(parameterized.TestCase):
       update_finalize_compare(k, v, in_layer=1, in_pos=58)
       update_finalize_compare(k, v, in_layer=2, in_pos=3)
 
+  @parameterized.named_parameters(
+      ("ring_buffer", True),
+      ("left_aligned", False),
+  )
+  def test_int4_kv_cache(self, ring_buffer):
+    """test int4 kv cache with per channel keys and per token values"""
+
+    def update_env_data(env_data):
+      env_data.ring_buffer = ring_buffer
+      env_data.lazy_cache_update = not ring_buffer
+      # A new config, the default one is shared by all the env data
+      env_data.quant_config = QuantizationConfig(
+          enable_kv_quantization=True, num_bits_kv=4
+      )
+      env_data.batch_size = 4
+
+    env, _ = helpers.make_env_tiny(False, update_env_data)
+    self.assertFalse(env.generate_cache_stacked)
+
+    batch = env.batch_size
+    cache_shape = (batch, 2, 16, 4)  # bs, num heads, seqlen, dim
+    with jax.default_device(jax.devices("cpu")[0]):
+      cache = cache_manager.Int4KVCacheGenerate.empty(cache_shape, None, env)
+      self.assertEqual(cache.cache_k.shape, (batch, 2, 16, 2))
+      prompt = jax.random.normal(jax.random.key(0), (batch, 2, 8, 4))
+      _, k_scale = cache_manager.quantize_keys_int4(prompt)
+      cache.k_scaler = torchjax.to_torch(k_scale)
+
+      k = torchjax.to_torch(prompt[:, :, 0:1])
+      v = torchjax.to_torch(prompt[:, :, 1:2])
+      in_pos = 5
+      cache.input_pos = (
+          [in_pos] if env.ring_buffer else jnp.array([in_pos] * batch)
+      )
+      cache.update(k, v, layer_id=0)
+      cache.finalize()
+
+      cache_k, cache_v = cache.state()
+      k_scaler, v_scaler = cache.scalers()
+      new_k = unpack_int4(cache_k, -1) * k_scaler
+      new_v = unpack_int4(cache_v, -1) * v_scaler
+      self.assertTrue(
+          jnp.allclose(k.jax(), new_k[:, :, in_pos : (in_pos + 1), :], atol=0.3)
+      )
+      self.assertTrue(
+          jnp.allclose(v.jax(), new_v[:, :, in_pos : (in_pos + 1), :], atol=0.3)
+      )
+
+  @parameterized.named_parameters(
+      ("ring_buffer", True),
+      ("left_aligned", False),
+  )
+  def test_int4_kv_cache_short_prompt(self, ring_buffer):
+    """test int4 keys out of the range of a short prompt"""
+
+    def update_env_data(env_data):
+      env_data.ring_buffer = ring_buffer
+      env_data.lazy_cache_update = not ring_buffer
+      env_data.quant_config = QuantizationConfig(
+          enable_kv_quantization=True, num_bits_kv=4
+      )
+      env_data.batch_size = 2
+
+    env, _ = helpers.make_env_tiny(False, update_env_data)
+    batch = env.batch_size
+    cache_shape = (batch, 2, 16, 4)  # bs, num heads, seqlen, dim
+    with jax.default_device(jax.devices("cpu")[0]):
+      # A 2 tokens prompt, the padding after it is ignored
+      prompt = jax.random.normal(jax.random.key(0), (batch, 2, 8, 4))
+      prompt = prompt.at[:, :, 2:].set(100)
+      prompt_quant, k_scale = cache_manager.quantize_keys_int4(prompt, length=2)
+      self.assertTrue(
+          jnp.allclose(
+              k_scale,
+              jnp.max(jnp.abs(prompt[:, :, :2]), axis=-2, keepdims=True) / 7,
+          )
+      )
+
+      cache = cache_manager.Int4KVCacheGenerate.empty(cache_shape, None, env)
+      cache_k = torchjax.from_torch(cache.cache_k)
+      cache.cache_k = torchjax.to_torch(cache_k.at[:, :, 0:8].set(prompt_quant))
+      cache.k_scaler = torchjax.to_torch(k_scale)
+
+      # Decode keys of slot 0 are 5 times out of the range of the prompt,
+      # the ones of slot 1 fit in it
+      k = jnp.concatenate(
+          [
+              5
+              * jnp.max(jnp.abs(prompt[0:1, :, :2]))
+              * jnp.sign(prompt[0:1, :, 0:1]),
+              prompt[1:2, :, 0:1],
+          ]
+      )
+      k = torchjax.to_torch(k)
+      in_pos = 2
+      cache.input_pos = (
+          [in_pos] if env.ring_buffer else jnp.array([in_pos] * batch)
+      )
+      cache.update(k, k, layer_id=0)
+      cache.finalize()
+
+      cache_k, _ = cache.state()
+      k_scaler, _ = cache.scalers()
+      new_k = unpack_int4(cache_k, -1) * k_scaler
+      # Half a step of the new scale, and of the old one for the requantized
+      # prompt keys
+      atol = jnp.max(k_scaler) / 2 + jnp.max(k_scale) / 2 + 1e-5
+      self.assertTrue(jnp.allclose(k.jax(), new_k[:, :, 2:3], atol=atol))
+      self.assertTrue(
+          jnp.allclose(prompt[:, :, :2], new_k[:, :, :2], atol=atol)
+      )
+      self.assertTrue(jnp.all(k_scaler[0] > k_scale[0]))
+      self.assertTrue(jnp.array_equal(k_scaler[1], k_scale[1]))
+
+  @parameterized.named_parameters(
+      ("ring_buffer", True),
+      ("left_aligned", False),
+  )
+  def test_static_kv_cache(self, ring_buffer):
+    """test int8 kv cache with static calibrated scales"""
+    heads = 2
+    k_scales = jnp.asarray([[0.02, 0.03], [0.04, 0.05]])
+    v_scales = jnp.asarray([[0.03, 0.02], [0.05, 0.04]])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, "kv_scales.json")
+      kv_calibration.save_kv_scales(path, k_scales, v_scales)
+
+      def update_env_data(env_data):
+        env_data.ring_buffer = ring_buffer
+        env_data.lazy_cache_update = not ring_buffer
+        env_data.quant_config = QuantizationConfig(
+            enable_kv_quantization=True, kv_scales_path=path
+        )
+        env_data.batch_size = 4
+
+      env, _ = helpers.make_env_tiny(False, update_env_data)
+    self.assertTrue(env.kv_quantize_static)
+
+    batch = env.batch_size
+    cache_shape = (batch, heads, 16, 4)  # bs, num heads, seqlen, dim
+    with jax.default_device(jax.devices("cpu")[0]):
+      cache = cache_manager.KVCacheGenerate.empty(cache_shape, None, env)
+      self.assertEqual(cache.cache_k.dtype, torch.int8)
+      kv = jax.random.uniform(
+          jax.random.key(0), (2, batch, heads, 1, 4), minval=-2, maxval=2
+      )
+      k, v = torchjax.to_torch((kv[0], kv[1]))
+      in_pos = 5
+      cache.input_pos = (
+          [in_pos] if env.ring_buffer else jnp.array([in_pos] * batch)
+      )
+      cache.update(k, v, layer_id=1)
+      cache.finalize()
+
+      cache_k, cache_v = cache.state()
+      new_k = cache_k[:, :, in_pos : (in_pos + 1)] * k_scales[1].reshape(
+          -1, 1, 1
+      )
+      new_v = cache_v[:, :, in_pos : (in_pos + 1)] * v_scales[1].reshape(
+          -1, 1, 1
+      )
+      # The error is at most half a quantization step
+      self.assertTrue(jnp.allclose(k.jax(), new_k, atol=0.03))
+      self.assertTrue(jnp.allclose(v.jax(), new_v, atol=0.03))
+
+  def test_int4_kv_ragged_attention(self):
+    """test the ragged kernel on int4 kv against the dequantized kv"""
+    batch, heads, seqlen, dim = 2, 2, 16, 8
+    keys = jax.random.split(jax.random.key(0), 3)
+    xq = jax.random.normal(keys[0], (batch, 2 * heads, 1, dim))
+    k = jax.random.normal(keys[1], (batch, heads, seqlen, dim))
+    v = jax.random.normal(keys[2], (batch, heads, seqlen, dim))
+    k_quant, k_scaler = cache_manager.quantize_keys_int4(k)
+    v_quant, v_scaler = cache_manager.quantize_values_int4(v)
+
+    start = jnp.zeros((batch,), dtype=jnp.int32)
+    end = jnp.asarray([10, 16])
+    bk = 8
+    ragged_batch_index = jnp.repeat(jnp.arange(batch), seqlen // bk)
+    ragged_block_index = jnp.tile(jnp.arange(seqlen // bk), batch)
+    ragged_mha = functools.partial(
+        ragged_mha_kernel,
+        layer=0,
+        start=start,
+        end=end,
+        ragged_batch_index=ragged_batch_index,
+        ragged_block_index=ragged_block_index,
+        bk=bk,
+        q_shard_axis=1,
+        kv_shard_axis=1,
+        testing=True,
+    )
+    out, _ = ragged_mha(
+        xq,
+        k_quant,
+        v_quant,
+        k_scaler=k_scaler,
+        v_scaler=v_scaler,
+        kv_int4=True,
+    )
+    expected, _ = ragged_mha(
+        xq,
+        unpack_int4(k_quant, -1) * k_scaler,
+        unpack_int4(v_quant, -1) * v_scaler,
+    )
+    self.assertTrue(jnp.allclose(out, expected, atol=1e-5))
+
   @parameterized.named_parameters(
       ("ring_buffer", True),
       ("left_aligned", False),
@@ -396,6 +619,41 @@ class QuantizationTest(parameterized.TestCase):
     state_dict_torch = torchjax.to_torch(state_dict_jax)
     self.assertTrue(state_dict_torch["weight"].jax().dtype == jnp.int4)
 
+  def test_packed_int4_blockwise_quant(self):
+    """Test packed int4 weights match the int4 weights in int8."""
+    out_features = 256
+    in_features = 512
+
+    arg = torch.randn(2, 16, in_features).to(torch.bfloat16)
+    nn_linear = torch.nn.Linear(
+        in_features, out_features, bias=False, dtype=torch.bfloat16
+    )
+    for symmetric in [True, False]:
+      with self.subTest(symmetric=symmetric):
+        quant_config = QuantizationConfig(
+            num_bits_weight=4,
+            is_blockwise_weight=True,
+            is_symmetric_weight=symmetric,
+        )
+        block_q_linear = WeightOnlyBlockwiseQuantizedLinear(
+            in_features, out_features, quant_config=quant_config
+        )
+        res, _, _ = self._nn_linear_run_and_compare(
+            nn_linear, block_q_linear, arg
+        )
+        packed_q_linear = WeightOnlyBlockwiseQuantizedLinear(
+            in_features,
+            out_features,
+            quant_config=dataclasses.replace(quant_config, pack_weight=True),
+        )
+        packed_res, _, _ = self._nn_linear_run_and_compare(
+            nn_linear, packed_q_linear, arg
+        )
+        self.assertEqual(
+            packed_q_linear.weight.numel() * 2, block_q_linear.weight.numel()
+        )
+        self.assertTrue(torch.allclose(packed_res, res, atol=0.05))
+
   def test_blockwise_quantized_linear_sharding(self):
     """Test blockwise quantized linear sharding."""
 
@@ -463,6 +721,40 @@ class QuantizationTest(parameterized.TestCase):
     )
     self.assertGreater(self._calc_cosine_dist(res, torch_res), 0.9999)
 
+  def test_activation_quant_blockwise(self):
+    """Test int8 x int8 blockwise matmul with per token and static scales."""
+    out_features = 256
+    in_features = 512
+
+    arg = torch.randn(2, 16, in_features).to(torch.bfloat16)
+    nn_linear = torch.nn.Linear(
+        in_features, out_features, bias=False, dtype=torch.bfloat16
+    )
+    for pack_weight in [False, True]:
+      with self.subTest(pack_weight=pack_weight):
+        quant_config = QuantizationConfig(
+            enable_weight_quantization=True,
+            enable_activation_quantization=True,
+            num_bits_weight=4,
+            is_blockwise_weight=True,
+            pack_weight=pack_weight,
+        )
+        block_q_linear = WeightOnlyBlockwiseQuantizedLinear(
+            in_features, out_features, quant_config=quant_config
+        )
+        res, torch_res, _ = self._nn_linear_run_and_compare(
+            nn_linear, block_q_linear, arg
+        )
+        self.assertGreater(self._calc_cosine_dist(res, torch_res), 0.99)
+
+        block_q_linear.static_activation_scales = {
+            "input": arg.abs().max().item() / 127
+        }
+        static_res, _, _ = self._nn_linear_run_and_compare(
+            nn_linear, block_q_linear, arg
+        )
+        self.assertGreater(self._calc_cosine_dist(static_res, torch_res), 0.99)
+
   def test_quant_creator(self):
     """Test quantization creator."""
     out_features = 8
@@ -528,6 +820,131 @@ class QuantizationTest(parameterized.TestCase):
     res = helpers.call_xla_model(qm, qm.state_dict(), arg)
     self.assertGreater(self._calc_cosine_dist(res, torch_res), 0.997)
 
+  def test_save_quantized_checkpoint(self):
+    def make_model():
+      m = torch.nn.Sequential(
+          torch.nn.Linear(256, 512, bias=False),
+          torch.nn.Linear(512, 256, bias=False),
+      )
+      return m.to(torch.bfloat16)
+
+    quant_config = QuantizationConfig(
+        enable_weight_quantization=True,
+        num_bits_weight=4,
+        is_blockwise_weight=True,
+        is_symmetric_weight=False,
+    )
+    qm = quantize_model(make_model(), quant_config)
+    arg = torch.randn(2, 16, 256).to(torch.bfloat16)
+    expected = helpers.call_xla_model(qm, qm.state_dict(), arg)
+
+    with tempfile.TemporaryDirectory() as path:
+      save_quantized_checkpoint(qm, quant_config, path, max_shard_bytes=1024)
+      shards = sorted(glob.glob(os.path.join(path, "*.safetensors")))
+      self.assertGreater(len(shards), 1)
+      state_dict = {}
+      for shard in shards:
+        state_dict.update(safetensors.torch.load_file(shard))
+      loaded_config = load_quantization_config(path, QuantizationConfig())
+
+    self.assertEqual(loaded_config, quant_config)
+    loaded = quantize_model(make_model(), quant_config)
+    loaded.load_state_dict(state_dict, assign=True)
+    res = helpers.call_xla_model(loaded, loaded.state_dict(), arg)
+    self.assertTrue(torch.equal(res, expected))
+
+  def test_layer_configs(self):
+    """Test per layer quantization configs."""
+
+    def make_model():
+      m = torch.nn.Sequential(
+          torch.nn.Linear(256, 512, bias=False),
+          torch.nn.Linear(512, 256, bias=False),
+          torch.nn.Linear(256, 256, bias=False),
+      )
+      return m.to(torch.bfloat16)
+
+    quant_config = QuantizationConfig(
+        enable_weight_quantization=True,
+        layer_configs={
+            "0": {"enable_weight_quantization": False},
+            "1": {
+                "num_bits_weight": 4,
+                "is_blockwise_weight": True,
+                "pack_weight": True,
+            },
+        },
+    )
+    m = make_model()
+    arg = torch.randn(2, 16, 256).to(torch.bfloat16)
+    torch_res = m(arg)
+    qm = quantize_model(m, quant_config)
+    self.assertIsInstance(qm[0], torch.nn.Linear)
+    self.assertIsInstance(qm[1], WeightOnlyBlockwiseQuantizedLinear)
+    self.assertTrue(qm[1].pack_weight)
+    self.assertIsInstance(qm[2], WeightOnlyPerChannelQuantizedLinear)
+    res = helpers.call_xla_model(qm, qm.state_dict(), arg)
+    self.assertGreater(self._calc_cosine_dist(res, torch_res), 0.99)
+
+    # A model constructed with quantized layers gets the layers of the plan
+    constructed = torch.nn.Sequential(
+        *[
+            WeightOnlyPerChannelQuantizedLinear(
+                mod.in_features, mod.out_features, device="meta"
+            )
+            for mod in make_model()
+        ]
+    )
+    apply_layer_configs(constructed, quant_config)
+    state_dict = qm.state_dict()
+    self.assertEqual(constructed.state_dict().keys(), state_dict.keys())
+    for key, value in constructed.state_dict().items():
+      self.assertEqual(value.shape, state_dict[key].shape)
+
+  def test_quantization_planner(self):
+    """Test the settings picked by the quantization planner."""
+    inputs = torch.randn(64, 512).numpy()
+    weight = torch.randn(256, 512).numpy()
+    errors = quantization_planner.layer_errors(weight, inputs, block_size=128)
+    self.assertAlmostEqual(errors["float"], 0, places=5)
+    self.assertLess(errors["int8_blockwise"], errors["int4_blockwise"])
+    self.assertLess(errors["int8_per_channel"], errors["int4_blockwise"])
+
+    # pylint: disable-next=protected-access
+    weight_bytes = quantization_planner._weight_bytes
+    scale_bytes = 2 * 256 * 512 // 128
+    self.assertEqual(
+        weight_bytes((256, 512), "int4_blockwise", 128),
+        256 * 512 // 2 + scale_bytes,
+    )
+    # Unpacked int4 takes an int8 per value
+    unpacked = dict(quantization_planner.CANDIDATES["int4_blockwise"])
+    unpacked["pack_weight"] = False
+    with mock.patch.dict(
+        quantization_planner.CANDIDATES, {"int4_unpacked": unpacked}
+    ):
+      self.assertEqual(
+          weight_bytes((256, 512), "int4_unpacked", 128),
+          weight_bytes((256, 512), "int8_blockwise", 128),
+      )
+
+    errors = {
+        "a": {"int4": 0.01, "int8": 0.0001, "float": 0.0},
+        "b": {"int4": 0.001, "int8": 0.0001, "float": 0.0},
+    }
+    sizes = {
+        "a": {"int4": 1, "int8": 2, "float": 4},
+        "b": {"int4": 1, "int8": 2, "float": 4},
+    }
+    select = functools.partial(quantization_planner.select_settings, errors)
+    self.assertEqual(select(sizes, 0.01), {"a": "int4", "b": "int4"})
+    # Upgrading a reduces the error most per byte
+    self.assertEqual(select(sizes, 0.001), {"a": "int8", "b": "int4"})
+    self.assertEqual(select(sizes, 0), {"a": "float", "b": "float"})
+    # int8 of a is not worth its size if it is as large as float
+    sizes["a"]["int8"] = 4
+    self.assertEqual(select(sizes, 0.001), {"a": "float", "b": "int4"})
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from safetensors.numpy import save_file
+
+from jetstream_pt import safetensors_loader
+
+
+class SafetensorsLoaderTest(unittest.TestCase):
+
+  def setUp(self):
+    jax.config.update("jax_platform_name", "cpu")
+
+  def test_load_sharded_multi_file(self):
+    a = np.arange(32, dtype=np.float32).reshape(4, 8)
+    b = np.arange(6, dtype=np.int8)
+    with tempfile.TemporaryDirectory() as path:
+      save_file({"a": a}, os.path.join(path, "model-00001.safetensors"))
+      save_file({"b": b}, os.path.join(path, "model-00002.safetensors"))
+      checkpoint = safetensors_loader.SafetensorsCheckpoint(path)
+      self.assertEqual(set(checkpoint.keys()), {"a", "b"})
+
+      mesh = jax.sharding.Mesh(np.array(jax.devices()), axis_names=("x",))
+      shardings = {
+          "a": jax.sharding.NamedSharding(
+              mesh, jax.sharding.PartitionSpec(None, "x")
+          ),
+          "b": jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec()),
+      }
+      weights = safetensors_loader.load_sharded(
+          checkpoint, ["a", "b"], shardings.get, dtype=jnp.bfloat16
+      )
+
+    self.assertEqual(weights["a"].dtype, jnp.bfloat16)
+    self.assertEqual(weights["a"].sharding, shardings["a"])
+    self.assertTrue(np.array_equal(np.asarray(weights["a"], np.float32), a))
+    # Integer tensors are not cast
+    self.assertEqual(weights["b"].dtype, jnp.int8)
+    self.assertTrue(np.array_equal(np.asarray(weights["b"]), b))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,155 @@
+import types
+import unittest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import torch
+import torch_xla2
+from torch.utils import _pytree as pytree
+from jetstream.engine import token_utils
+
+from jetstream_pt.engine import PyTorchEngine
+from jetstream_pt.environment import QuantizationConfig
+from jetstream_pt.speculative import SpeculativeEngine, lookup_ngram
+from jetstream_pt.speculative import _commit_tokens
+from jetstream_pt.third_party.llama import model_exportable
+from tests import helpers
+
+
+class SpeculativeEngineTest(unittest.TestCase):
+
+  def setUp(self):
+    jax.config.update("jax_platform_name", "cpu")
+    jax.config.update("jax_default_matmul_precision", "highest")
+
+  def _make_engine(self, seed, batch_size=1):
+    def update_env_data(env_data):
+      # Other tests change the shared default quantization config
+      env_data.quant_config = QuantizationConfig()
+      env_data.batch_size = batch_size
+      env_data.cache_shape = (batch_size,) + env_data.cache_shape[1:]
+
+    env, model_arg = helpers.make_env_tiny(False, update_env_data)
+    torch.manual_seed(seed)
+    model = model_exportable.Transformer(model_arg, env)
+    return PyTorchEngine(pt_model=model, env=env)
+
+  def _params(self, engine):
+    return pytree.tree_map_only(
+        torch.Tensor, torch_xla2.tensor.t2j, engine.pt_model.state_dict()
+    )
+
+  def _insert(self, engine, params):
+    padded_tokens = jnp.array(np.pad(np.arange(10, dtype=np.int32) + 1, (0, 6)))
+    prefix, _ = engine.prefill(
+        params=params, padded_tokens=padded_tokens, true_length=10
+    )
+    return engine.insert(prefix, engine.init_decode_state(), slot=0)
+
+  def _decode(self, engine, params, num_tokens):
+    """Decodes slot 0 the way the orchestrator does, a request ends at its
+    first invalid token."""
+    decode_state = self._insert(engine, params)
+    tokenizer = types.SimpleNamespace(stop_tokens=set())
+    complete = np.zeros((1,), dtype=np.bool_)
+    out_tokens = []
+    steps = 0
+    while len(out_tokens) < num_tokens:
+      decode_state, result_tokens = engine.generate(params, decode_state)
+      samples, complete = token_utils.process_result_tokens(
+          tokenizer=tokenizer,
+          slot=0,
+          slot_max_length=engine.max_decode_length,
+          result_tokens=result_tokens.convert_to_numpy(),
+          complete=complete,
+          is_client_side_tokenization=True,
+      )
+      self.assertFalse(complete[0])
+      out_tokens.extend(samples[0].token_ids)
+      steps += 1
+    return out_tokens[:num_tokens], steps
+
+  def _assert_rejects(self, engine, params):
+    """Asserts the first speculative step of slot 0 rejects a proposal."""
+    decode_state = self._insert(engine, params)
+    # pylint: disable-next=protected-access
+    decode_state = jax.jit(engine._speculate)(params, decode_state)
+    self.assertLess(
+        int(decode_state.num_pending[0]), engine.num_speculative_tokens + 1
+    )
+
+  def test_same_draft_accepts_everything(self):
+    target = self._make_engine(seed=0)
+    params = self._params(target)
+    expected, _ = self._decode(target, params, 12)
+
+    engine = SpeculativeEngine(target, target, num_speculative_tokens=3)
+    out_tokens, steps = self._decode(engine, (params, params), 12)
+    self.assertEqual(out_tokens, expected)
+    self.assertEqual(steps, 3)
+
+  def test_greedy_output_matches_target(self):
+    target = self._make_engine(seed=0)
+    draft = self._make_engine(seed=1)
+    params = self._params(target)
+    expected, _ = self._decode(target, params, 12)
+
+    engine = SpeculativeEngine(target, draft, num_speculative_tokens=3)
+    params = (params, self._params(draft))
+    # The draft disagrees with the target, yet no request ends early
+    self._assert_rejects(engine, params)
+    out_tokens, _ = self._decode(engine, params, 12)
+    self.assertEqual(out_tokens, expected)
+
+  def test_commit_tokens_advances_by_kept_tokens(self):
+    engine = self._make_engine(seed=0, batch_size=2)
+    decode_state = engine.init_decode_state()
+    decode_state = decode_state.replace(
+        current_position=jnp.int32(5),
+        input_pos=jnp.full_like(decode_state.input_pos, 5),
+    )
+    num_kept = jnp.ones_like(decode_state.input_pos).at[0].set(2).at[1].set(0)
+    next_token = jnp.ones_like(decode_state.tokens)
+    new_state = _commit_tokens(
+        decode_state, decode_state.caches, next_token, num_kept, 4, 128
+    )
+    # The rejected columns after the longest kept run are reused
+    self.assertEqual(int(new_state.current_position), 7)
+    self.assertEqual(int(new_state.input_pos[0]), 7)
+    self.assertEqual(new_state.mask[0, 5:9].tolist(), [0, 0, -np.inf, -np.inf])
+    # A slot keeping no column stays where it was
+    self.assertEqual(int(new_state.input_pos[1]), 5)
+    self.assertEqual(int(new_state.tokens[1, 0]), 0)
+    self.assertEqual(new_state.mask[1, 5:9].tolist(), [-np.inf] * 4)
+
+  def test_lookup_ngram(self):
+    history = jnp.array(
+        [
+            [1, 2, 3, 4, 5, 9, 2, 3, 0, 0],
+            [1, 2, 3, 4, 1, 2, 3, 7, 1, 2],
+            [5, 6, 7, 8, 0, 0, 0, 0, 0, 0],
+        ],
+        dtype=jnp.int32,
+    )
+    length = jnp.array([8, 10, 4], dtype=jnp.int32)
+    proposals = lookup_ngram(history, length, max_ngram_size=3, num_tokens=2)
+    # [2, 3] matches at 1, the latest [1, 2] match is at 4, no match repeats
+    # the last token
+    expected = [[4, 5], [3, 7], [8, 8]]
+    self.assertEqual(proposals.tolist(), expected)
+
+  def test_prompt_lookup_matches_target(self):
+    target = self._make_engine(seed=0)
+    params = self._params(target)
+    expected, _ = self._decode(target, params, 12)
+
+    engine = SpeculativeEngine(target, num_speculative_tokens=3)
+    # The prompt has no repeated n-gram, the lookup misses
+    self._assert_rejects(engine, (params, None))
+    out_tokens, _ = self._decode(engine, (params, None), 12)
+    self.assertEqual(out_tokens, expected)
+
+
+if __name__ == "__main__":
+  unittest.main()